@@ -1,4 +1,4 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Header
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import pandas as pd
@@ -18,6 +18,7 @@ import threading
 import logging
 import time
 import traceback
+import hmac
 from fastapi.logger import logger as fastapi_logger
 
 # log to a file 
@@ -40,6 +41,8 @@ def setup_logging():
 from matchmaker import MHCMatchmaker
 import database
 import utils.data_exporter as data_exporter
+from utils.haplotype_cache import get_haplotype_cache
+from utils.pair_cache import get_pair_cache
 from datetime import datetime, timedelta
 
 
@@ -66,8 +69,8 @@ app.mount("/static", StaticFiles(directory="frontend/build/static"), name="react
 app.mount("/docs", StaticFiles(directory="docs/build/html", html=True), name="docs")
 
 
-# Initialise the database
-db = database.get_database()
+# Initialise the database, the handle is shared by all requests and jobs of this worker
+database.get_database()
 
 # Unitialise the job store and job queue
 job_store = {}
@@ -75,6 +78,8 @@ job_queue = Queue()
 
 MAX_JOBS_STORED = 1  # Adjust based on your needs
 JOB_RETENTION_HOURS = 1  # How long to keep completed jobs
+RSA_SWEEP_THRESHOLDS = [round(0.05 * i, 2) for i in range(21)]  # RSA thresholds of /api/rsa_sweep when none are given
+ADMIN_TOKEN_ENV = "MHC_ADMIN_TOKEN"  # environment variable with the token of the admin endpoints, disabled if unset
 
 
 def cleanup_old_jobs():
@@ -135,10 +140,11 @@ async def get_allele(allele_id: str):
     Returns:
     dict: The database entry for the given allele.
     """
-    if allele_id not in db.get_all_ids():
+    allele_data = database.get_database().find_dict(allele_id)
+    if allele_data is None:
         raise HTTPException(status_code=404, detail="Allele ID not found in database")
     else:
-        return db.find_dict(allele_id)
+        return allele_data
     
 
 @app.get("/api/eplets/{allele_id}")
@@ -152,10 +158,11 @@ async def get_eplets(allele_id: str):
     Returns:
     list: The eplets for the given allele.
     """
-    if allele_id not in db.get_all_ids():
+    allele_data = database.get_database().find(allele_id)
+    if allele_data is None:
         raise HTTPException(status_code=404, detail="Allele ID not found in database")
     else:
-        return db.find(allele_id).eplets
+        return allele_data.eplets
 
 @app.get("/api/allele_ids")
 async def get_all_allele_ids():
@@ -165,7 +172,7 @@ async def get_all_allele_ids():
     Returns:
     list: A list of all allele IDs in the database.
     """
-    return db.get_all_ids_filtered()
+    return database.get_database().get_all_ids_filtered()
 
 
 @app.get("/api/consensus_seq/{allele_class}")
@@ -183,7 +190,7 @@ async def get_consensus_sequence(allele_class:str):
         raise HTTPException(status_code=400, detail="Invalid allele class")
     else:
         print("Getting consensus sequence for class: ",allele_class)
-        return db.get_consensus_seq(allele_class)
+        return database.get_database().get_consensus_seq(allele_class)
 
 
 @app.get("/api/consensus_distribution/{allele_class}")
@@ -199,6 +206,7 @@ async def get_consensus_distribution(allele_class:str):
     """
     distribution = {}
     
+    db = database.get_database()
     dist_list = db.get_consensus_distribution(allele_class)
     consensus_seq = db.get_consensus_seq(allele_class)
 
@@ -209,6 +217,60 @@ async def get_consensus_distribution(allele_class:str):
 
     return distribution
 
+def require_admin(token):
+    """
+    Check the token of a request to an admin endpoint against the MHC_ADMIN_TOKEN environment variable.
+    The admin endpoints are not served at all when the variable is not set.
+
+    Exceptions:
+    404: No admin token is configured.
+    403: The token is missing or wrong.
+    """
+    admin_token = os.environ.get(ADMIN_TOKEN_ENV)
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if token is None or not hmac.compare_digest(token.encode("utf-8"), admin_token.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/api/reload_database")
+def reload_database(x_admin_token: str = Header(None)):
+    """
+    Re-opens the shared database, e.g. after the database was updated or its snapshot recompiled.
+    Jobs that are already running finish with the database they started with.
+    Admin endpoint: the request must carry the MHC_ADMIN_TOKEN value in the X-Admin-Token header.
+    A plain def, so FastAPI runs the reload in its threadpool.
+
+    Returns:
+    dict: The version (fingerprint) of the reloaded database.
+
+    Exceptions:
+    404: No admin token is configured.
+    403: The token is missing or wrong.
+    """
+    require_admin(x_admin_token)
+    db = database.reload_database()
+    return {"status": "reloaded", "version": db.version}
+
+@app.get("/api/haplotype_cache")
+async def get_haplotype_cache_stats():
+    """
+    Used to get the statistics of the haplotype cache shared by the jobs of this worker.
+
+    Returns:
+    dict: The number of cached haplotypes and the hit/miss counters per cached value.
+    """
+    return get_haplotype_cache().stats()
+
+@app.get("/api/pair_cache")
+async def get_pair_cache_stats():
+    """
+    Used to get the statistics of the pair result cache shared by the jobs of this worker.
+
+    Returns:
+    dict: The number of cached pairs and the hit/miss counters per cached value.
+    """
+    return get_pair_cache().stats()
+
 @app.get("/api/output_files/{information}")
 async def get_output_files(information: str):
     # turn the information from a JSON Sringify to a dictionary
@@ -223,7 +285,8 @@ async def get_output_files(information: str):
 @app.post("/job_submission")
 async def job_submission(file: UploadFile = File(None), 
                      rsa: float = Form(...),
-                     created_data: str = Form(None)):
+                     created_data: str = Form(None),
+                     lazy: bool = Form(False)):
     """
     Handles a job submission by parsing the input data and adding it to the job queue.
     The initial status of the job is "queued".
@@ -232,6 +295,10 @@ async def job_submission(file: UploadFile = File(None),
     file (UploadFile, optional): The CSV file to upload.
     rsa (float): The RSA threshold to use for filtering.
     created_data (str, optional): The created data to use for the job.
+    lazy (bool, optional): If True, the result only holds the mismatch scores of the pairs, the mismatch details
+                           and known eplets of a pair are only calculated when fetched from /api/pair_details
+                           (the result has no eplets_found, no updated_mismatches in the ranking, and no mismatches
+                           and eplets output files).
 
     Returns:
     dict: The status of the job and its ID.
@@ -249,7 +316,7 @@ async def job_submission(file: UploadFile = File(None),
     
     fastapi_logger.info(f"Queueing upload for job {job_id}")
 
-    job_queue.put((file_contents, file_extension, rsa, created_data, job_id))
+    job_queue.put((file_contents, file_extension, rsa, created_data, lazy, job_id))
 
     fastapi_logger.info(f"Job {job_id} added to queue")
 
@@ -286,13 +353,160 @@ async def poll_results(job_id: str):
     return {"status": job["status"], "result": job.get("result"), "queue_position": queue_position}
 
 
-def process_job(file, file_extension, rsa, created_data, job_id):
+@app.get("/api/pair_details/{job_id}/{recipient_id}/{donor_id}")
+def get_pair_details(job_id: str, recipient_id: str, donor_id: str):
+    """
+    Used to get the mismatch details and known eplets of one recipient-donor pair of a completed job.
+    For jobs submitted with lazy=True they are only calculated here (a plain def, so FastAPI runs it in its threadpool).
+
+    Parameters:
+    job_id (str): The ID of the job.
+    recipient_id (str): The ID of the recipient.
+    donor_id (str): The ID of the donor.
+
+    Returns:
+    dict: The mismatch details of the pair per class, with the known eplets of the class under "known_eplets".
+
+    Exceptions:
+    404: The job is not found or not completed, or the pair is not in the job.
+    """
+    job = job_store.get(job_id)
+    if job is None or job["status"] != "completed":
+        raise HTTPException(status_code=404, detail="Completed job not found")
+
+    matchmaker = job["matchmaker"]
+    try:
+        details = matchmaker.pair_details(recipient_id, donor_id)
+        eplets = matchmaker.pair_known_eplets(donor_id, recipient_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Recipient-donor pair not found in job")
+    for clas, class_details in details.items():
+        class_details["known_eplets"] = eplets.get(clas, {})
+    return details
+
+
+@app.get("/api/rsa_sweep/{job_id}")
+def get_rsa_sweep(job_id: str, thresholds: str = None):
+    """
+    Used to get the solvent accessibility filtered mismatch counts of every pair of a completed job
+    for several RSA thresholds, without running a new job. The counts are only calculated on request,
+    from the scores of the pairs (a plain def, so FastAPI runs it in its threadpool).
+
+    Parameters:
+    job_id (str): The ID of the job.
+    thresholds (str, optional): Comma separated RSA thresholds, defaults to 0, 0.05, ..., 1.
+
+    Returns:
+    dict: The thresholds and the counts per threshold of every pair and class.
+
+    Exceptions:
+    404: The job is not found or not completed.
+    400: The thresholds are not numbers.
+    """
+    job = job_store.get(job_id)
+    if job is None or job["status"] != "completed":
+        raise HTTPException(status_code=404, detail="Completed job not found")
+
+    rsa_thresholds = RSA_SWEEP_THRESHOLDS
+    if thresholds is not None:
+        try:
+            rsa_thresholds = [float(t) for t in thresholds.split(",")]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Thresholds must be comma separated numbers")
+    return job["matchmaker"].filter_by_sas_sweep(rsa_thresholds)
+
+
+def parse_class_weights(weights: str = None):
+    """Parse comma separated class:weight pairs (e.g. "I:1,IIDRB:2"), None if no weights are given"""
+    if weights is None:
+        return None
+    try:
+        return {clas: float(weight) for clas, weight in (item.split(":") for item in weights.split(","))}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Weights must be comma separated class:weight pairs")
+
+
+@app.get("/api/best_donors/{job_id}/{recipient_id}")
+def get_best_donors(job_id: str, recipient_id: str, k: int = 10, weights: str = None):
+    """
+    Used to get the k donors of a completed job with the fewest solvent accessibility filtered mismatches for a recipient.
+    A plain def, so FastAPI runs the search in its threadpool.
+
+    Parameters:
+    job_id (str): The ID of the job.
+    recipient_id (str): The ID of the recipient.
+    k (int, optional): The number of donors, defaults to 10.
+    weights (str, optional): Comma separated class weights, e.g. "I:1,IIDRB:2", classes that are not listed are left out.
+                             Defaults to a weight of 1 for all classes.
+
+    Returns:
+    list: The top k donors with their score, mismatches and known eplets per class, best first.
+
+    Exceptions:
+    404: The job is not found or not completed, or the recipient is not in the job.
+    400: The weights are not valid.
+    """
+    job = job_store.get(job_id)
+    if job is None or job["status"] != "completed":
+        raise HTTPException(status_code=404, detail="Completed job not found")
+
+    class_weights = parse_class_weights(weights)
+    try:
+        return job["matchmaker"].best_donors(recipient_id, k, class_weights, rsa_threshold=job["rsa_threshold"])
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Recipient not found in job")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/allocation/{job_id}")
+def get_allocation(job_id: str, weights: str = None, eplet_weight: float = 0.0, capacity: int = 1,
+                   forbidden: str = None):
+    """
+    Used to get the donor-recipient assignment of a completed job with the minimal total cost,
+    the cost of a pair being its weighted SAS filtered donor mismatches plus its weighted donor eplet load
+    (a plain def, so FastAPI runs the assignment in its threadpool).
+
+    Parameters:
+    job_id (str): The ID of the job.
+    weights (str, optional): Comma separated class weights, e.g. "I:1,IIDRB:2", classes that are not listed are left out.
+                             Defaults to a weight of 1 for all classes.
+    eplet_weight (float, optional): The weight of the donor eplet load, defaults to 0.
+    capacity (int, optional): The maximum number of recipients per donor, defaults to 1.
+    forbidden (str, optional): Comma separated recipient:donor pairs that must not be assigned.
+
+    Returns:
+    dict: The assignments with their cost, the unassigned recipients and the total cost.
+
+    Exceptions:
+    404: The job is not found or not completed.
+    400: The weights, capacity or forbidden pairs are not valid.
+    """
+    job = job_store.get(job_id)
+    if job is None or job["status"] != "completed":
+        raise HTTPException(status_code=404, detail="Completed job not found")
+
+    class_weights = parse_class_weights(weights)
+    forbidden_pairs = []
+    if forbidden is not None:
+        forbidden_pairs = [tuple(item.split(":")) for item in forbidden.split(",")]
+        if any(len(pair) != 2 for pair in forbidden_pairs):
+            raise HTTPException(status_code=400, detail="Forbidden pairs must be comma separated recipient:donor pairs")
+
+    try:
+        return job["matchmaker"].allocate_donors(class_weights, eplet_weight, capacity, forbidden_pairs,
+                                                 rsa_threshold=job["rsa_threshold"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def process_job(file, file_extension, rsa, created_data, lazy, job_id):
     fastapi_logger.info(f"Starting process_upload for job {job_id}")
     
     job_store[job_id]["status"] = "processing"
     start_time = time.time()
 
-    mhc_compare = MHCMatchmaker()
+    mhc_compare = MHCMatchmaker(lazy=lazy)
 
     # For the methods handling the input data, we need to catch any errors and return a detailed error message
     # Methods with detailed outside error handling: set_inputs_csv, set_inputs_excel
@@ -373,15 +587,25 @@ def process_job(file, file_extension, rsa, created_data, job_id):
         #print("RSA: ", rsa)
         mhc_compare.filter_by_sas(rsa)
         
-        fastapi_logger.info(f"Job {job_id}: Checking known eplets")
-        eplets_found = mhc_compare.check_known_eplets()
-        with open(f"results/eplets_found.json", "w") as f:
-            json.dump(eplets_found, f)
+        if lazy:
+            # like the mismatch details, the known eplets of a pair are only checked on request (/api/pair_details)
+            eplets_found = {}
+        else:
+            fastapi_logger.info(f"Job {job_id}: Checking known eplets")
+            eplets_found = mhc_compare.check_known_eplets()
+            with open(f"results/eplets_found.json", "w") as f:
+                json.dump(eplets_found, f)
+
+        fastapi_logger.info(f"Job {job_id}: Calculating eplet mismatch loads")
+        mhc_compare.calc_eplet_mismatch_matrix()
+        eplet_load = data_exporter.generate_eplet_load_data(mhc_compare.eplet_mismatch_matrix)
 
         ### Gather results ###
 
         fastapi_logger.info(f"Job {job_id}: Generating ranking data")
-        ranking_data = data_exporter.generate_ranking_data(mhc_compare.donors, mhc_compare.recipients, mhc_compare.difference_scoring)
+        # a lazy job only keeps the scores of the pairs, its ranking is built from them without the mismatch details
+        scoring = mhc_compare.compact_scoring() if lazy else mhc_compare.difference_scoring
+        ranking_data = data_exporter.generate_ranking_data(mhc_compare.donors, mhc_compare.recipients, scoring, compact=lazy)
         # write the ranking data to a json file
         with open(f"results/ranking_data.json", "w") as f:
             json.dump(ranking_data, f)
@@ -400,10 +624,12 @@ def process_job(file, file_extension, rsa, created_data, job_id):
         output_files = {
             "input": data_exporter.export_input(mhc_compare.donors, mhc_compare.recipients, relevant_classes),
             "alignment": data_exporter.export_alignment(mhc_compare.donors, mhc_compare.recipients, relevant_classes),
-            "sas_scores": data_exporter.export_sas_scores(mhc_compare.sas_scores, relevant_classes),
-            "mismatches": data_exporter.export_mismatches(mhc_compare.difference_scoring, relevant_classes),
-            "eplets": data_exporter.export_known_eplets(eplets_found, relevant_classes)
+            "sas_scores": data_exporter.export_sas_scores(mhc_compare.sas_scores, relevant_classes)
         }
+        if not lazy:
+            # the exports of all pairs would calculate the mismatch details of every pair of a lazy job
+            output_files["mismatches"] = data_exporter.export_mismatches(mhc_compare.difference_scoring, relevant_classes)
+            output_files["eplets"] = data_exporter.export_known_eplets(eplets_found, relevant_classes)
 
 
         stop_time = time.time()
@@ -412,7 +638,7 @@ def process_job(file, file_extension, rsa, created_data, job_id):
         fastapi_logger.info(f"Job {job_id}: Preparing result")
         result = {
             "message": "File uploaded successfully", 
-            "data": mhc_compare.difference_scoring,
+            "data": scoring,
             "donors": mhc_compare.donors,
             "recipients": mhc_compare.recipients,
             "alignment": alignment_data,
@@ -421,16 +647,22 @@ def process_job(file, file_extension, rsa, created_data, job_id):
             "execution_time": execution_time,
             "grouped_sas_scores": mhc_compare.sas_scores,
             "eplets_found": eplets_found,
+            "eplet_load": eplet_load,
             "classes_to_show": relevant_classes,
             "output_files": output_files,
             "invalid_alleles": mhc_compare.invalid_alleles,
             "transformed_alleles": mhc_compare.transformed_alleles
         }
 
+        # the matchmaker is kept to calculate the mismatch details of a pair, RSA sweeps and top donors on request
         job_store[job_id] = {"status": "completed", 
                              "result": result,
-                             "completion_time": datetime.now()}
+                             "completion_time": datetime.now(),
+                             "matchmaker": mhc_compare,
+                             "rsa_threshold": rsa}
         fastapi_logger.info(f"Job {job_id} completed successfully")
+        fastapi_logger.info(f"Haplotype cache: {get_haplotype_cache().stats()}")
+        fastapi_logger.info(f"Pair cache: {get_pair_cache().stats()}")
     except Exception as e:
         error_message = f"Error in process_upload for job {job_id}: {str(e)}"
         fastapi_logger.error(error_message)
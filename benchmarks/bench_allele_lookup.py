@@ -0,0 +1,83 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from tinydb import where
+
+# project imports
+from database import TinyDBDatabase
+from benchmarks.synthetic import make_alleles, write_tinydb
+
+"""
+Micro-benchmark comparing the indexes of TinyDBDatabase with the linear scans they replace:
+- find (primary-key index) against a TinyDB query on _id
+- find_alleles_with_prefix (prefix index) against str_in_allele
+
+Usage (from the repository root):
+    python -m benchmarks.bench_allele_lookup --alleles 5000 --lookups 2000
+"""
+
+
+def scan_find(db: TinyDBDatabase, allele_id: str):
+    """The previous implementation of find: a full scan of the alleles table"""
+    return db.alleles.get(where('_id') == allele_id)
+
+
+def run(n_alleles: int, n_lookups: int, seed: int = 0) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = write_tinydb(make_alleles(n_alleles, seed=seed), os.path.join(tmp, "alleles_db.json"))
+
+        start = time.perf_counter()
+        db = TinyDBDatabase(db_path=db_path)
+        open_time = time.perf_counter() - start
+
+        rng = random.Random(seed)
+        ids = db.get_all_ids()
+        queries = [rng.choice(ids) for _ in range(n_lookups)]
+
+        start = time.perf_counter()
+        for allele_id in queries:
+            scan_find(db, allele_id)
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for allele_id in queries:
+            db.find(allele_id)
+        index_time = time.perf_counter() - start
+
+        # sanity check: both lookups return the same document
+        for allele_id in queries[:100]:
+            assert dict(scan_find(db, allele_id)) == db.find_dict(allele_id)
+
+        # base alleles, e.g. SLA-1*04:01
+        prefixes = [":".join(allele_id.split(":")[:2]) for allele_id in queries[:n_lookups // 10]]
+
+        start = time.perf_counter()
+        for prefix in prefixes:
+            db.str_in_allele(prefix)
+        regex_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for prefix in prefixes:
+            db.find_alleles_with_prefix(prefix)
+        prefix_time = time.perf_counter() - start
+
+    print(f"alleles: {len(ids)}, lookups: {n_lookups}")
+    print(f"open (incl. index build): {open_time * 1000:.1f} ms")
+    print(f"scan  find: {scan_time * 1000:.1f} ms ({scan_time / n_lookups * 1e6:.1f} us/lookup)")
+    print(f"index find: {index_time * 1000:.1f} ms ({index_time / n_lookups * 1e6:.1f} us/lookup)")
+    print(f"speedup: {scan_time / index_time:.0f}x")
+    print(f"str_in_allele:            {regex_time * 1000:.1f} ms for {len(prefixes)} prefixes")
+    print(f"find_alleles_with_prefix: {prefix_time * 1000:.1f} ms for {len(prefixes)} prefixes")
+    print(f"speedup: {regex_time / prefix_time:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Allele lookup benchmark")
+    parser.add_argument("--alleles", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.alleles, args.lookups, args.seed)
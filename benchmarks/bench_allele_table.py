@@ -0,0 +1,75 @@
+import argparse
+import random
+import time
+
+import numpy as np
+
+# project imports
+from utils.allele_store import AlleleStore
+from utils.allele_table import AlleleTables
+from utils.mismatch_engine import encode_grouped, stack_masks, score_matrix
+from benchmarks.bench_mismatch_engine import group
+from benchmarks.synthetic import make_alleles
+
+"""
+Benchmark of the batched scores composed from the allele pair difference tables against the
+batched scores of the grouped bitmasks, on class I haplotypes drawn from a working set of alleles.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_allele_table --donors 2000 --recipients 200 --alleles 100
+"""
+
+
+def run(n_donors: int, n_recipients: int, n_alleles: int, memory_budget: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    alleles = make_alleles(2500, seed=seed, mutation_rate=0.1)
+    store = AlleleStore.from_alleles(alleles)
+    working_set = rng.sample(store["I"].ids, n_alleles)
+
+    def haplotypes(n):
+        return [rng.sample(working_set, rng.randint(1, 4)) for _ in range(n)]
+
+    donors, recipients = haplotypes(n_donors), haplotypes(n_recipients)
+    widths = {len(alleles[a]["aligned_seq"]) for a in working_set}
+    donor_keep = np.array([[rng.random() > 0.3 for _ in range(max(widths))] for _ in range(n_donors)])
+    recip_keep = np.array([[rng.random() > 0.3 for _ in range(max(widths))] for _ in range(n_recipients)])
+
+    start = time.perf_counter()
+    donor_masks = stack_masks([encode_grouped(group([alleles[a]["aligned_seq"] for a in d])) for d in donors])
+    recip_masks = stack_masks([encode_grouped(group([alleles[a]["aligned_seq"] for a in r])) for r in recipients])
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = score_matrix(*donor_masks, *recip_masks, donor_keep, recip_keep)
+    bitmask_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tables = AlleleTables.build(store, {"I": donors + recipients}, memory_budget)
+    build_time = time.perf_counter() - start
+    table = tables.get("I")
+    if table is None or not all(table.covers(h) for h in donors + recipients):
+        print(f"the working set does not fit in the memory budget of {memory_budget} bytes")
+        return
+
+    start = time.perf_counter()
+    scores = table.score_matrix(donors, recipients, donor_keep, recip_keep)
+    table_time = time.perf_counter() - start
+    for key, matrix in expected.items():
+        assert np.array_equal(matrix, scores[key]), f"{key} differs"
+
+    n_pairs = n_donors * n_recipients
+    print(f"pairs: {n_pairs} ({n_recipients} recipients x {n_donors} donors), {n_alleles} alleles in the working set")
+    print(f"table: {len(table)} alleles, {table.nbytes / 2**20:.1f} MiB, built in {build_time:.2f} s")
+    print(f"grouped bitmasks:    {bitmask_time:8.2f} s (+ {encode_time:.2f} s to group and encode the haplotypes)")
+    print(f"allele pair table:   {table_time:8.2f} s")
+    print(f"speedup: {bitmask_time / table_time:.1f}x, scores equal")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Allele pair difference table benchmark")
+    parser.add_argument("--donors", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=200)
+    parser.add_argument("--alleles", type=int, default=100)
+    parser.add_argument("--budget", type=int, default=64 * 2**20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.donors, args.recipients, args.alleles, args.budget, args.seed)
@@ -0,0 +1,125 @@
+import argparse
+import random
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# project imports
+from utils.donor_index import DonorIndex
+from utils.mismatch_engine import encode_grouped, stack_masks, score_matrix
+from benchmarks.bench_mismatch_engine import group
+from benchmarks.synthetic import make_alleles
+
+"""
+Benchmark of the nearest donor index against scoring every donor of a registry.
+
+The donors and recipients are drawn from a colony: every haplotype is made of two founder haplotypes,
+sometimes with an allele of one class replaced by another allele of the pool, as in a breeding population.
+Every query is checked against the brute force top k.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_donor_index --donors 1000 4000 16000 --queries 50
+"""
+
+RSA_THRESHOLD = 0.25
+
+
+class Colony:
+    """Synthetic colony of founder haplotypes, with the grouped bitmasks and SAS keep masks per class"""
+
+    def __init__(self, n_founders: int, seed: int = 0):
+        self.rng = random.Random(seed)
+        alleles = make_alleles(1000, seed=seed, mutation_rate=0.05)
+        self.pool = {}
+        for allele_id, allele in alleles.items():
+            clas = allele["allele_class"] if allele["allele_class"] == "I" else "II" + allele["locus"][5:8]
+            self.pool.setdefault(clas, []).append(allele)
+        self.classes = sorted(self.pool)
+        self.founders = [{clas: self.rng.randrange(len(self.pool[clas])) for clas in self.classes}
+                         for _ in range(n_founders)]
+        self.encoded = {}
+
+    def haplotype(self, mutation_rate: float = 0.1) -> Dict[str, Tuple[int, ...]]:
+        first, second = self.rng.sample(self.founders, 2)
+        haplotype = {clas: (first[clas], second[clas]) for clas in self.classes}
+        if self.rng.random() < mutation_rate:
+            clas = self.rng.choice(self.classes)
+            haplotype[clas] = (haplotype[clas][0], self.rng.randrange(len(self.pool[clas])))
+        return {clas: tuple(sorted(set(rows))) for clas, rows in haplotype.items()}
+
+    def encode(self, clas: str, rows: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        """Grouped bitmasks and keep mask (average RSA missing or above the threshold) of the alleles of a class"""
+        key = (clas, rows)
+        if key not in self.encoded:
+            alleles = [self.pool[clas][row] for row in rows]
+            mask = encode_grouped(group([a["aligned_seq"] for a in alleles]))
+            rsa = np.array([[np.nan if r is None else r for r in a["aligned_rsa"]] for a in alleles], dtype=np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                average = np.nansum(rsa, axis=0) / (~np.isnan(rsa)).sum(axis=0)
+            self.encoded[key] = (mask, ~(average < RSA_THRESHOLD))
+        return self.encoded[key]
+
+
+def stack(colony: Colony, haplotypes: List[Dict]) -> Tuple[Dict, Dict]:
+    masks, keep = {}, {}
+    for clas in colony.classes:
+        encoded = [colony.encode(clas, haplotype[clas]) for haplotype in haplotypes]
+        masks[clas] = stack_masks([mask for mask, _ in encoded])
+        keep[clas] = np.stack([class_keep for _, class_keep in encoded])
+    return masks, keep
+
+
+def brute_force(masks: Dict, keep: Dict, query: Dict, k: int) -> List[Tuple[int, float]]:
+    scores = np.zeros(len(next(iter(masks.values()))[0]))
+    for clas, (donor_masks, donor_lengths) in masks.items():
+        recip_masks, recip_lengths = stack_masks([query[clas]])
+        scores += score_matrix(donor_masks, donor_lengths, recip_masks, recip_lengths,
+                               donor_keep=keep[clas])["updated_mismatches_count"][0]
+    ranked = np.lexsort((np.arange(len(scores)), scores))[:k]
+    return [(int(j), float(scores[j])) for j in ranked]
+
+
+def run(donor_counts: List[int], n_queries: int, k: int, n_founders: int, n_pivots: int, seed: int = 0) -> None:
+    colony = Colony(n_founders, seed=seed)
+    recipients = [colony.haplotype() for _ in range(n_queries)]
+    queries = [{clas: colony.encode(clas, recipient[clas])[0] for clas in colony.classes} for recipient in recipients]
+
+    print(f"{n_founders} founder haplotypes, {n_queries} queries, k={k}, {n_pivots} pivots")
+    print(f"{'donors':>8} {'distinct':>9} {'build s':>8} {'scored':>8} {'scored %':>9} {'index ms':>9} {'brute ms':>9}")
+    for n_donors in donor_counts:
+        donors = [colony.haplotype() for _ in range(n_donors)]
+        masks, keep = stack(colony, donors)
+        donor_ids = [f"D{i}" for i in range(n_donors)]
+
+        start = time.perf_counter()
+        index = DonorIndex(donor_ids, masks, keep, n_pivots=n_pivots, rsa_threshold=RSA_THRESHOLD)
+        build_time = time.perf_counter() - start
+
+        scored, index_time, brute_time = 0, 0.0, 0.0
+        for query in queries:
+            start = time.perf_counter()
+            top = index.query(query, k)
+            index_time += time.perf_counter() - start
+            scored += index.last_scored
+
+            start = time.perf_counter()
+            expected = brute_force(masks, keep, query, k)
+            brute_time += time.perf_counter() - start
+            assert top == [(donor_ids[j], score) for j, score in expected], f"index top {k} differs: {top} {expected}"
+
+        print(f"{n_donors:>8} {len(index.sizes):>9} {build_time:>8.2f} {scored / n_queries:>8.0f} "
+              f"{100 * scored / n_queries / n_donors:>8.1f}% {1000 * index_time / n_queries:>9.2f} "
+              f"{1000 * brute_time / n_queries:>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nearest donor index benchmark")
+    parser.add_argument("--donors", type=int, nargs="+", default=[1000, 4000, 16000])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--founders", type=int, default=40)
+    parser.add_argument("--pivots", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.donors, args.queries, args.k, args.founders, args.pivots, args.seed)
@@ -0,0 +1,102 @@
+import argparse
+import random
+import time
+from operator import add
+from typing import List, Tuple
+
+import numpy as np
+
+# project imports
+from utils.mismatch_engine import (class_difference_python, class_difference_bitmask,
+                                   encode_grouped, same_class_difference)
+from benchmarks.synthetic import make_alleles
+
+"""
+Equivalence harness and benchmark of the bitmask mismatch engine against the python (set based) engine.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_mismatch_engine --pairs 2000
+"""
+
+
+def group(aligned_seqs: List[str]) -> List[str]:
+    """Group aligned sequences position by position, like MHCMatchmaker.group_alleles"""
+    if len(aligned_seqs) == 0:
+        return []
+    grouped = list(aligned_seqs[0])
+    for seq in aligned_seqs[1:]:
+        grouped = list(map(add, grouped, seq))
+    return grouped
+
+
+def random_pairs(n_pairs: int, seed: int = 0) -> List[Tuple[List[str], List[str]]]:
+    """
+    Random grouped donor and recipient haplotypes of one class, with 0 to 4 alleles each.
+    Some alleles are truncated so the grouped haplotypes have different lengths.
+    """
+    rng = random.Random(seed)
+    alleles = make_alleles(500, seed=seed, mutation_rate=0.1)
+    seqs = [a["aligned_seq"] for a in alleles.values() if a["allele_class"] == "I"]
+
+    def haplotype():
+        chosen = [rng.choice(seqs) for _ in range(rng.randint(0, 4))]
+        if chosen and rng.random() < 0.1:
+            chosen[0] = chosen[0][:rng.randint(1, len(chosen[0]))]
+        return group(chosen)
+
+    return [(haplotype(), haplotype()) for _ in range(n_pairs)]
+
+
+def check_equivalence(pairs) -> int:
+    """
+    Compare the output of both engines for every pair.
+
+    Returns:
+        int: The number of pairs checked
+
+    Raises:
+        AssertionError: If the engines disagree on a pair
+    """
+    for i, (donor, recipient) in enumerate(pairs):
+        reference = class_difference_python(donor, recipient)
+        result = class_difference_bitmask(donor, recipient)
+        assert same_class_difference(result, reference), f"Engines disagree on pair {i}"
+    return len(pairs)
+
+
+def run(n_pairs: int, seed: int = 0) -> None:
+    pairs = random_pairs(n_pairs, seed)
+    print(f"equivalence: {check_equivalence(pairs)} pairs identical")
+
+    start = time.perf_counter()
+    for donor, recipient in pairs:
+        class_difference_python(donor, recipient)
+    python_time = time.perf_counter() - start
+
+    # the matchmaker encodes every grouped haplotype once and reuses it for all of its pairs
+    masks = [(encode_grouped(donor), encode_grouped(recipient)) for donor, recipient in pairs]
+    start = time.perf_counter()
+    for (donor, recipient), (donor_mask, recipient_mask) in zip(pairs, masks):
+        class_difference_bitmask(donor, recipient, donor_mask, recipient_mask)
+    bitmask_time = time.perf_counter() - start
+
+    # scores only: the vectorised comparison without building the per position detail lists
+    start = time.perf_counter()
+    for donor_mask, recipient_mask in masks:
+        length = min(len(donor_mask), len(recipient_mask))
+        int(np.count_nonzero(donor_mask[:length] & ~recipient_mask[:length]))
+        int(np.count_nonzero(recipient_mask[:length] & ~donor_mask[:length]))
+    scores_time = time.perf_counter() - start
+
+    print(f"python  engine: {python_time * 1000:8.1f} ms ({python_time / n_pairs * 1e6:.0f} us/pair)")
+    print(f"bitmask engine: {bitmask_time * 1000:8.1f} ms ({bitmask_time / n_pairs * 1e6:.0f} us/pair)")
+    print(f"speedup: {python_time / bitmask_time:.1f}x")
+    print(f"bitmask scores only: {scores_time * 1000:8.1f} ms ({scores_time / n_pairs * 1e6:.0f} us/pair)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mismatch engine benchmark")
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.pairs, args.seed)
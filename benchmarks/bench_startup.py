@@ -0,0 +1,68 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# project imports
+from database import TinyDBDatabase, SnapshotDatabase, compile_snapshot, get_database
+from benchmarks.synthetic import make_alleles, write_tinydb
+
+"""
+Startup benchmark: opening the TinyDB JSON database against opening its compiled binary snapshot.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_startup --alleles 20000
+"""
+
+
+def time_open(open_db, queries, repeats):
+    best_open, best_first = float("inf"), float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        db = open_db()
+        opened = time.perf_counter()
+        for allele_id in queries:
+            db.find(allele_id)
+        done = time.perf_counter()
+        best_open = min(best_open, opened - start)
+        best_first = min(best_first, done - start)
+    return best_open, best_first
+
+
+def run(n_alleles: int, n_queries: int, repeats: int, seed: int = 0) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = write_tinydb(make_alleles(n_alleles, seed=seed), os.path.join(tmp, "alleles_db.json"))
+        json_size = os.path.getsize(db_path)
+
+        start = time.perf_counter()
+        snapshot_path = compile_snapshot(db_path)
+        compile_time = time.perf_counter() - start
+        assert isinstance(get_database(db_path), SnapshotDatabase)
+
+        ids = TinyDBDatabase(db_path=db_path).get_all_ids()
+        queries = random.Random(seed).sample(ids, min(n_queries, len(ids)))
+
+        json_open, json_first = time_open(lambda: TinyDBDatabase(db_path=db_path), queries, repeats)
+        snap_open, snap_first = time_open(lambda: SnapshotDatabase(snapshot_path, db_path=db_path), queries, repeats)
+
+        # sanity check: both return the same documents
+        json_db, snap_db = TinyDBDatabase(db_path=db_path), SnapshotDatabase(snapshot_path, db_path=db_path)
+        for allele_id in queries:
+            assert json_db.find_dict(allele_id) == snap_db.find_dict(allele_id)
+
+    print(f"alleles: {len(ids)}, json size: {json_size / 1e6:.1f} MB")
+    print(f"compile snapshot: {compile_time * 1000:.0f} ms (one-off)")
+    print(f"open json:     {json_open * 1000:8.1f} ms, open + {len(queries)} lookups: {json_first * 1000:8.1f} ms")
+    print(f"open snapshot: {snap_open * 1000:8.1f} ms, open + {len(queries)} lookups: {snap_first * 1000:8.1f} ms")
+    print(f"startup speedup: {json_open / snap_open:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database startup benchmark")
+    parser.add_argument("--alleles", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.alleles, args.queries, args.repeats, args.seed)
@@ -0,0 +1,96 @@
+import json
+import os
+import random
+from typing import Dict, List
+
+"""
+This module generates synthetic IMGT-like allele databases for the benchmarks.
+The generated documents have the same fields as the entries in data/alleles_db.json,
+so the benchmarks can run without downloading the MHC database.
+"""
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+# class -> (allele_class, loci, aligned length)
+CLASS_LAYOUT = {
+    "I": ("I", ["SLA-1", "SLA-2", "SLA-3"], 365),
+    "IIDQA": ("II", ["SLA-DQA"], 255),
+    "IIDQB": ("II", ["SLA-DQB1"], 260),
+    "IIDRA": ("II", ["SLA-DRA"], 250),
+    "IIDRB": ("II", ["SLA-DRB1"], 265),
+}
+
+
+def _mutate(seq: List[str], rng: random.Random, rate: float) -> List[str]:
+    return [rng.choice(AMINO_ACIDS) if (c != "-" and rng.random() < rate) else c for c in seq]
+
+
+def make_alleles(n_alleles: int = 2000, seed: int = 0, mutation_rate: float = 0.05) -> Dict[str, Dict]:
+    """
+    Generate synthetic allele documents.
+
+    Parameters:
+        n_alleles (int): Approximate number of alleles to generate (spread over all classes)
+        seed (int): Seed for the random generator
+        mutation_rate (float): Probability that a residue differs from the class consensus
+
+    Returns:
+        Dict[str, Dict]: {allele_id: allele document}
+    """
+    rng = random.Random(seed)
+    alleles = {}
+    per_class = max(1, n_alleles // len(CLASS_LAYOUT))
+
+    for clas, (allele_class, loci, length) in CLASS_LAYOUT.items():
+        consensus = [rng.choice(AMINO_ACIDS) for _ in range(length)]
+        # a few gap columns as in a real alignment
+        for pos in rng.sample(range(length), length // 20):
+            consensus[pos] = "-"
+
+        for i in range(per_class):
+            locus = loci[i % len(loci)]
+            group, protein, synonymous = i // 100 + 1, i % 100 + 1, i % 3 + 1
+            allele_id = f"{locus}*{group:02d}:{protein:02d}:{synonymous:02d}"
+            aligned = _mutate(consensus, rng, mutation_rate)
+            aligned_seq = "".join(aligned)
+            aligned_rsa = [None if c == "-" else round(rng.random(), 3) for c in aligned]
+            aligned_asa = [None if r is None else round(r * 200, 2) for r in aligned_rsa]
+            sequence = aligned_seq.replace("-", "")
+
+            alleles[allele_id] = {
+                "accession": f"SLA{len(alleles):05d}",
+                "sequence": sequence,
+                "aligned_seq": aligned_seq,
+                "asa": [a for a in aligned_asa if a is not None],
+                "rsa": [r for r in aligned_rsa if r is not None],
+                "status": "abandoned" if i % 50 == 49 else "Public",
+                "secondary_names": [f"{locus}*{group:02d}{protein:02d}"] if i % 4 == 0 else [],
+                "allele_class": allele_class,
+                "locus": locus,
+                "aligned_rsa": aligned_rsa,
+                "aligned_asa": aligned_asa,
+                "start_pos": 1,
+                "eplets": [],
+                "netsurfp_rsa_unaligned": None,
+            }
+    return alleles
+
+
+def write_tinydb(alleles: Dict[str, Dict], db_path: str) -> str:
+    """
+    Write the allele documents in the TinyDB JSON layout used by data/alleles_db.json.
+
+    Parameters:
+        alleles (Dict[str, Dict]): {allele_id: allele document}
+        db_path (str): Path of the TinyDB JSON file to write
+
+    Returns:
+        str: The db_path
+    """
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    table = {}
+    for doc_id, (allele_id, doc) in enumerate(alleles.items(), start=1):
+        table[str(doc_id)] = {**doc, "_id": allele_id}
+    with open(db_path, "w") as f:
+        json.dump({"alleles": table}, f)
+    return db_path
@@ -4,10 +4,21 @@ from tinydb.middlewares import CachingMiddleware
 import re
 import os
 import json
+import shutil
+import tempfile
+import threading
+from bisect import bisect_left
 from dataclasses import dataclass, field
 from typing import List, Optional, Tuple, Dict
+from collections.abc import Mapping
+import numpy as np
 from loguru import logger as logger
 
+# project imports
+from utils.utils import parse_allele_name
+from utils.allele_store import AlleleStore, ClassStore, CLASSES
+from utils.eplet_registry import EPLET_PATHS, get_eplet_registry
+
 @dataclass
 class Allele:
     """
@@ -38,10 +49,16 @@ class TinyDBDatabase():
     def __init__(self, db_path="data/alleles_db.json"):
         """Initialize the TinyDB database with caching for better performance"""
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        # serialises writes and lazy initialisation, reads are lock-free dictionary probes
+        self._lock = threading.RLock()
         self.db = TinyDB(db_path, storage=CachingMiddleware(JSONStorage))
         self.alleles = self.db.table('alleles')
         self._setup_db(db_path=db_path)
         #self.db = TinyDB(db_path, storage=CachingMiddleware(JSONStorage))
+        self._build_index()
+        # identifies the content of the database file, e.g. to check if a snapshot is up to date
+        self.version = source_fingerprint(db_path)
         
     def _setup_db(self, db_path):
         """Set up the database if it's empty by importing data from original_db.json"""
@@ -64,13 +81,52 @@ class TinyDBDatabase():
                 self.db.close()
 
                 self.db = TinyDB(db_path, storage=CachingMiddleware(JSONStorage))
+                self.alleles = self.db.table('alleles')
 
             except (FileNotFoundError, json.JSONDecodeError) as e:
                 logger.error(f"Error loading original database: {e}")
 
+    def _build_index(self):
+        """
+        Build the in-memory indexes in a single pass over the table:
+        - primary-key index (_id -> document)
+        - inverted secondary name index (secondary name -> _id)
+        - prefix index: sorted (allele fields, table position, _id) entries of the usable alleles
+        Afterwards lookups by _id or secondary name are O(1) dictionary probes,
+        and prefix lookups are a binary search.
+        """
+        self._index = {}
+        self._secondary_index = {}
+        self._prefix_index = []
+        for position, doc in enumerate(self.alleles):
+            if '_id' not in doc:
+                continue
+            # keep the first document for an _id, like alleles.get() does
+            self._index.setdefault(doc['_id'], doc)
+
+            # only alleles that can replace an input allele go in the prefix index
+            if doc.get('status') != "abandoned" and doc.get('aligned_seq') != "":
+                self._prefix_index.append((tuple(parse_allele_name(doc['_id'])), position, doc['_id']))
+
+            secondary_names = doc.get('secondary_names') or []
+            if isinstance(secondary_names, str):
+                secondary_names = [secondary_names]
+            for name in secondary_names:
+                self._secondary_index.setdefault(name, doc['_id'])
+
+        self._prefix_index.sort()
+
+    def _documents(self):
+        """Iterate over all the documents of the alleles table"""
+        return iter(self.alleles)
+
+    def _search(self, cond) -> List[Dict]:
+        """Get all the documents of the alleles table that match cond (a TinyDB query or any callable)"""
+        return self.alleles.search(cond)
+
     def find(self, allele_id: str) -> Allele:
         """Find an allele by its ID"""
-        result = self.alleles.get(where('_id') == allele_id)
+        result = self._index.get(allele_id)
         if result:
             # Create a copy of the result and remove the _id field
             allele_data = result.copy()
@@ -80,7 +136,9 @@ class TinyDBDatabase():
     
     def find_dict(self, allele_id: str) -> Dict[str, str]:
         """Find an allele by its ID and return as a dictionary"""
-        return self.alleles.get(where('_id') == allele_id)
+        result = self._index.get(allele_id)
+        # return a copy so callers cannot modify the index
+        return dict(result) if result is not None else None
     
     def specific_find(self, attribute, value):
         """Find an allele by a specific attribute and value"""
@@ -91,14 +149,45 @@ class TinyDBDatabase():
         """Find alleles that contain a specific string in their ID"""
         # TinyDB doesn't have a direct regex search, so we'll filter manually
         results = []
-        for doc in self.alleles:
+        for doc in self._documents():
             if '_id' in doc and re.search(re.escape(s), doc.get('_id', '')):
                 results.append(doc)
         return results
     
+    def find_alleles_with_prefix(self, prefix: str) -> List[Dict[str, str]]:
+        """
+        Find all usable alleles whose fields start with the fields of prefix,
+        e.g. "SLA-1*04:01" matches "SLA-1*04:01:01" and "SLA-1*04:01:02" but not "SLA-1*04:010".
+
+        Abandoned alleles and alleles without an aligned sequence are left out.
+        The results are sorted by the length of their ID (ties keep the table order).
+        """
+        fields = tuple(parse_allele_name(prefix))
+        n_fields = len(fields)
+
+        results = []
+        i = bisect_left(self._prefix_index, (fields,))
+        while i < len(self._prefix_index) and self._prefix_index[i][0][:n_fields] == fields:
+            results.append(self._prefix_index[i])
+            i += 1
+
+        results.sort(key=lambda entry: (len(entry[2]), entry[1]))
+        return [self.find_dict(allele_id) for _, _, allele_id in results]
+
+    def get_allele_store(self) -> AlleleStore:
+        """
+        Get the columnar store (aligned residue and RSA/ASA matrices per class) of all alleles.
+        The store is built on first use and kept for the lifetime of the database object.
+        """
+        with self._lock:
+            if getattr(self, "_allele_store", None) is None:
+                self._allele_store = AlleleStore.from_alleles(self._index)
+                logger.info(f"Allele store built: {len(self._allele_store)} alleles, {self._allele_store.nbytes / 1e6:.1f} MB")
+        return self._allele_store
+
     def get_all_ids(self) -> List[str]:
         """Get all allele IDs in the database"""
-        return [doc.get('_id', '') for doc in self.alleles]
+        return [doc.get('_id', '') for doc in self._documents()]
     
     def get_all_ids_filtered(self) -> List[str]:
         """Get filtered allele IDs for all classes"""
@@ -113,7 +202,7 @@ class TinyDBDatabase():
         
         if allele_class == "I":
             # Filter for class I alleles that aren't abandoned and have valid sequences
-            results = self.alleles.search(
+            results = self._search(
                 (Allele.allele_class == allele_class) & 
                 (Allele.status != "abandoned") & 
                 (Allele.sequence != "X") & 
@@ -126,7 +215,7 @@ class TinyDBDatabase():
             locus_prefix = allele_class[2:]  # Extract DQA, DQB, DRA, or DRB
             
             # Filter for class II alleles with specific locus
-            results = self.alleles.search(
+            results = self._search(
                 (Allele.allele_class == "II") & 
                 (Allele.status != "abandoned") & 
                 (Allele.sequence != "X") & 
@@ -188,18 +277,10 @@ class TinyDBDatabase():
             raise FileNotFoundError(f"Distribution file for {allele_class} not found")
     
     def get_eplet_dict(self, allele_class: str) -> Dict[int, str]:
-        """Get eplet dictionary for a specific class"""
-        eplet_paths = {
-            "IIDRB": "data/eplets/eplets_DRB.json",
-            "IIDQ": "data/eplets/eplets_DQ.json",
-            "I": "data/eplets/eplets_I.json"
-        }
-        
-        if allele_class in eplet_paths:
+        """Get eplet dictionary for a specific class, shared with the eplet registry so it should not be modified"""
+        if allele_class in EPLET_PATHS:
             try:
-                with open(eplet_paths[allele_class], "r") as f:
-                    eplet_dict = json.load(f)
-                return eplet_dict
+                return get_eplet_registry().get(allele_class).eplets
             except FileNotFoundError:
                 logger.warning(f"Eplet file for {allele_class} not found")
                 return None
@@ -212,16 +293,16 @@ class TinyDBDatabase():
         
         if species == "hla":
             species = "HLA"
-            results = self.alleles.search(lambda doc: species in doc.get('accession', ''))
+            results = self._search(lambda doc: species in doc.get('accession', ''))
         elif species == "sla":
             species = "SLA"
-            results = self.alleles.search(lambda doc: species in doc.get('accession', ''))
+            results = self._search(lambda doc: species in doc.get('accession', ''))
         elif species == "mamu":
             species = "Mamu"
-            results = self.alleles.search(lambda doc: "Mamu" in doc.get('_id', ''))
+            results = self._search(lambda doc: "Mamu" in doc.get('_id', ''))
         elif species == "mafa":
             species = "Mafa"
-            results = self.alleles.search(lambda doc: "Mafa" in doc.get('_id', ''))
+            results = self._search(lambda doc: "Mafa" in doc.get('_id', ''))
         else:
             raise ValueError(f"Invalid species: {species}")
         
@@ -231,7 +312,7 @@ class TinyDBDatabase():
     
     def get_allele_class(self, allele_id: str) -> str:
         """Get the class of a specific allele"""
-        result = self.alleles.get(where('_id') == allele_id)
+        result = self._index.get(allele_id)
         if not result:
             raise ValueError(f"Allele {allele_id} not found")
         
@@ -254,7 +335,34 @@ class TinyDBDatabase():
     
     def update_eplet_presence(self, allele_id: str, eplet_ids: List[str]):
         """Update the eplet presence for a specific allele"""
-        self.alleles.update({'eplets': eplet_ids}, where('_id') == allele_id)
+        with self._lock:
+            self.alleles.update({'eplets': eplet_ids}, where('_id') == allele_id)
+            # keep the primary-key index in sync with the table
+            if allele_id in self._index:
+                self._index[allele_id]['eplets'] = eplet_ids
+
+    def update_eplet_presence_bulk(self, eplets: Dict[str, List[str]]) -> int:
+        """
+        Update the eplet presence of many alleles in one batched write, flushed to disk.
+
+        Parameters:
+            eplets (Dict[str, List[str]]): {allele_id: eplet_ids}, unknown allele IDs are ignored
+
+        Returns:
+            int: The number of updated alleles
+        """
+        with self._lock:
+            doc_ids = [self._index[allele_id].doc_id for allele_id in eplets if allele_id in self._index]
+
+            def set_eplets(doc):
+                doc['eplets'] = eplets[doc['_id']]
+
+            self.alleles.update(set_eplets, doc_ids=doc_ids)
+            self.db.storage.flush()
+            for allele_id, eplet_ids in eplets.items():
+                if allele_id in self._index:
+                    self._index[allele_id]['eplets'] = eplet_ids
+        return len(doc_ids)
     
     def bson_to_dataclass(self, bson_data) -> Allele:
         """Convert BSON data to an Allele dataclass instance"""
@@ -262,21 +370,327 @@ class TinyDBDatabase():
         data.pop("_id", None)
         return Allele(**data)
 
+    def find_by_secondary_name(self, name: str) -> Dict[str, str]:
+        """Find the allele that has name as one of its secondary names and return it as a dictionary"""
+        allele_id = self._secondary_index.get(name)
+        if allele_id is None:
+            return None
+        return self.find_dict(allele_id)
+
     def check_secondary_names(self, allele_id: str):
         """Check if the allele_id is a secondary name of another allele"""
 
         # Check if the allele is a secondary name match of another allele
-        secondary_name_match = self.alleles.get(where("secondary_names").contains(allele_id))
-        if secondary_name_match: # not None
-            return secondary_name_match["_id"]
-        else:
-            return None
+        return self._secondary_index.get(allele_id)
+
+
+
+### Binary snapshot ###
+
+# bump when the layout of the snapshot changes, older snapshots are then ignored
+SNAPSHOT_FORMAT_VERSION = 2
+STORE_ARRAYS = ["seqs", "lengths", "rsa", "asa", "sas_lengths"]
+
+
+def source_fingerprint(db_path: str) -> Optional[str]:
+    """Fingerprint (size and modification time) of a database file, None if the file does not exist"""
+    try:
+        stat = os.stat(db_path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def default_snapshot_path(db_path: str) -> str:
+    """The snapshot of data/alleles_db.json is stored in the data/alleles_db.snapshot directory"""
+    return os.path.splitext(db_path)[0] + ".snapshot"
+
+
+def read_snapshot_manifest(snapshot_path: str) -> Optional[Dict]:
+    """The manifest of a snapshot, None if the snapshot is missing or incomplete"""
+    try:
+        with open(os.path.join(snapshot_path, "manifest.json"), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def compile_snapshot(db_path: str = "data/alleles_db.json", snapshot_path: Optional[str] = None) -> str:
+    """
+    Compile the JSON database into a binary snapshot that can be memory mapped at startup.
+
+    Every compile writes a new version directory in the snapshot directory, of uncompressed .npy files
+    (an .npz archive can't be memory mapped):
+    - ids.npy: the allele IDs, in table order
+    - docs.npy + offsets.npy: the JSON encoded documents, concatenated in one byte buffer
+    - <class>.<array>.npy: the columnar allele store of every class
+    - indexes.json: the secondary name and prefix indexes
+    The manifest.json of the snapshot directory points to the current version directory, with the format version
+    and the fingerprint of the JSON database it was compiled from. It is replaced atomically once the new version
+    is complete, so files that an open SnapshotDatabase has memory mapped are never overwritten.
+    The previous version directories are then removed: open handles keep their (unlinked) mapped files.
+
+    Parameters:
+        db_path (str): Path to the TinyDB JSON database
+        snapshot_path (str, optional): Output directory, defaults to default_snapshot_path(db_path)
+
+    Returns:
+        str: The snapshot path
+    """
+    snapshot_path = snapshot_path or default_snapshot_path(db_path)
+    db = TinyDBDatabase(db_path=db_path)
+    os.makedirs(snapshot_path, exist_ok=True)
+    version_dir = tempfile.mkdtemp(prefix="v-", dir=snapshot_path)
+    version_path = lambda name: os.path.join(version_dir, name)
+
+    ids = list(db._index.keys())
+    encoded = [json.dumps(db._index[allele_id]).encode("utf-8") for allele_id in ids]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(doc) for doc in encoded])
+    np.save(version_path("ids.npy"), np.array(ids, dtype=str))
+    np.save(version_path("docs.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(version_path("offsets.npy"), offsets)
+
+    store = db.get_allele_store()
+    for clas, class_store in store.classes.items():
+        np.save(version_path(f"{clas}.ids.npy"), np.array(class_store.ids, dtype=str))
+        for name in STORE_ARRAYS:
+            np.save(version_path(f"{clas}.{name}.npy"), getattr(class_store, name))
+
+    with open(version_path("indexes.json"), "w") as f:
+        json.dump({"secondary_names": db._secondary_index, "prefix": db._prefix_index}, f)
+
+    # switch over: the manifest is written to a temporary file and renamed over the previous one
+    manifest_tmp = os.path.join(snapshot_path, f"manifest.{os.path.basename(version_dir)}.tmp")
+    with open(manifest_tmp, "w") as f:
+        json.dump({"format_version": SNAPSHOT_FORMAT_VERSION,
+                   "data": os.path.basename(version_dir),
+                   "source": os.path.basename(db_path),
+                   "source_fingerprint": db.version,
+                   "n_alleles": len(ids)}, f)
+    os.replace(manifest_tmp, os.path.join(snapshot_path, "manifest.json"))
+
+    for name in os.listdir(snapshot_path):
+        if name.startswith("v-") and name != os.path.basename(version_dir):
+            # ignore_errors: mapped files can't be removed on every platform, they are retried on the next compile
+            shutil.rmtree(os.path.join(snapshot_path, name), ignore_errors=True)
+
+    logger.info(f"Compiled snapshot of {len(ids)} alleles to {version_dir}")
+    return snapshot_path
+
+
+def is_snapshot_fresh(snapshot_path: str, db_path: str) -> bool:
+    """
+    Check if a snapshot can be used instead of the JSON database:
+    it must be complete, have the current format version and be compiled from the current database file.
+    A snapshot without its JSON database next to it is also used.
+    """
+    manifest = read_snapshot_manifest(snapshot_path)
+    if manifest is None or manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        return False
+    fingerprint = source_fingerprint(db_path)
+    return fingerprint is None or fingerprint == manifest.get("source_fingerprint")
 
 
+class _SnapshotIndex(Mapping):
+    """
+    Primary-key index (_id -> document) over the memory mapped documents of a snapshot.
+    Documents are decoded on first access and then cached.
+    """
+
+    def __init__(self, ids, docs, offsets):
+        self._rows = {allele_id: row for row, allele_id in enumerate(ids)}
+        self._docs = docs
+        self._offsets = offsets
+        self._decoded = {}
+
+    def __getitem__(self, allele_id):
+        doc = self._decoded.get(allele_id)
+        if doc is None:
+            row = self._rows[allele_id]
+            doc = json.loads(self._docs[self._offsets[row]:self._offsets[row + 1]].tobytes())
+            self._decoded[allele_id] = doc
+        return doc
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, allele_id):
+        return allele_id in self._rows
 
-def get_database():
+
+class SnapshotDatabase(TinyDBDatabase):
+    """
+    Read-mostly database backed by a binary snapshot of the TinyDB JSON database (see compile_snapshot).
+    The snapshot is memory mapped, so opening it does not parse the JSON database.
+    Writes are forwarded to the TinyDB database, which is only opened when needed.
+    """
+
+    def __init__(self, snapshot_path: str, db_path="data/alleles_db.json"):
+        self.db_path = db_path
+        self.snapshot_path = snapshot_path
+        self._lock = threading.RLock()
+        self.db = None
+        self.alleles = None
+        self._backend = None
+
+        manifest = read_snapshot_manifest(snapshot_path)
+        if manifest is None:
+            raise FileNotFoundError(f"No complete snapshot in {snapshot_path}")
+        self.version = manifest["source_fingerprint"]
+        # the version directory is resolved once: a recompile switches the manifest to a new directory
+        # and leaves the files mapped by this object untouched
+        self.data_path = os.path.join(snapshot_path, manifest["data"])
+        data_path = lambda name: os.path.join(self.data_path, name)
+
+        self._ids = np.load(data_path("ids.npy"), mmap_mode="r")
+        self._index = _SnapshotIndex(self._ids.tolist(),
+                                     np.load(data_path("docs.npy"), mmap_mode="r"),
+                                     np.load(data_path("offsets.npy"), mmap_mode="r"))
+
+        with open(data_path("indexes.json"), "r") as f:
+            indexes = json.load(f)
+        self._secondary_index = indexes["secondary_names"]
+        self._prefix_index = [(tuple(fields), position, allele_id) for fields, position, allele_id in indexes["prefix"]]
+        # mapping the class arrays is cheap, they are mapped now so the version directory can be removed later
+        self._class_arrays = {clas: {name: np.load(data_path(f"{clas}.{name}.npy"), mmap_mode="r")
+                                     for name in STORE_ARRAYS}
+                              for clas in CLASSES}
+        self._class_ids = {clas: np.load(data_path(f"{clas}.ids.npy")).tolist() for clas in CLASSES}
+        self._allele_store = None
+
+    def _documents(self):
+        return iter(self._index.values())
+
+    def _search(self, cond) -> List[Dict]:
+        return [doc for doc in self._documents() if cond(doc)]
+
+    def specific_find(self, attribute, value):
+        """Find an allele by a specific attribute and value"""
+        results = self._search(where(attribute) == value)
+        return results[0] if results else None
+
+    def get_all_ids(self) -> List[str]:
+        """Get all allele IDs in the database"""
+        return list(self._index.keys())
+
+    def get_allele_store(self) -> AlleleStore:
+        """Get the columnar store of all alleles, memory mapped from the snapshot"""
+        with self._lock:
+            if self._allele_store is None:
+                self._allele_store = AlleleStore({clas: ClassStore(allele_class=clas, ids=self._class_ids[clas],
+                                                                   **self._class_arrays[clas])
+                                                  for clas in CLASSES})
+        return self._allele_store
+
+    def update_eplet_presence(self, allele_id: str, eplet_ids: List[str]):
+        """Update the eplet presence for a specific allele, in the JSON database and in this snapshot view"""
+        with self._lock:
+            if self._backend is None:
+                self._backend = TinyDBDatabase(db_path=self.db_path)
+            self._backend.update_eplet_presence(allele_id, eplet_ids)
+            if allele_id in self._index:
+                self._index[allele_id]['eplets'] = eplet_ids
+
+    def update_eplet_presence_bulk(self, eplets: Dict[str, List[str]]) -> int:
+        """Update the eplet presence of many alleles, in the JSON database and in this snapshot view"""
+        with self._lock:
+            if self._backend is None:
+                self._backend = TinyDBDatabase(db_path=self.db_path)
+            updated = self._backend.update_eplet_presence_bulk(eplets)
+            for allele_id, eplet_ids in eplets.items():
+                if allele_id in self._index:
+                    self._index[allele_id]['eplets'] = eplet_ids
+        return updated
+
+
+class SessionDatabase():
+    """
+    Read-only in-memory database of a fixed set of alleles, e.g. the alleles of one matching session.
+    It is small enough to be shipped to worker processes instead of the whole database,
+    and keeps the version of the database it was taken from, so cache keys stay the same.
+    """
+
+    def __init__(self, alleles: Dict[str, Allele], version: str):
+        """
+        Parameters:
+            alleles (Dict[str, Allele]): {allele_id: Allele}, None for alleles that were not found
+            version (str): Version (fingerprint) of the database the alleles were read from
+        """
+        self.alleles = dict(alleles)
+        self.version = version
+
+    def find(self, allele_id: str) -> Allele:
+        """Find an allele by its ID, None if it is not in the session"""
+        return self.alleles.get(allele_id)
+
+    def __contains__(self, allele_id: str) -> bool:
+        return self.alleles.get(allele_id) is not None
+
+    def __len__(self) -> int:
+        return len(self.alleles)
+
+
+def open_database(db_path="data/alleles_db.json"):
+    """
+    Open a new database object for db_path.
+    A compiled snapshot of the TinyDB database is used when it is present and up to date.
+    """
+    snapshot_path = default_snapshot_path(db_path)
+    if is_snapshot_fresh(snapshot_path, db_path):
+        try:
+            return SnapshotDatabase(snapshot_path, db_path=db_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not load snapshot {snapshot_path}, falling back to {db_path}: {e}")
+    return TinyDBDatabase(db_path=db_path)
+
+
+### Shared database handle ###
+
+# one database object per db_path, shared by every caller (and thread) in the process
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_path="data/alleles_db.json"):
     """
     Return a database object:
     (MongoDB used for the demo/prod., TinyDB for local deployment)
+    The database is opened once per process and the same object is returned on every call,
+    use reload_database() to pick up changes to the database files.
     """
-    return TinyDBDatabase()
\ No newline at end of file
+    database = _databases.get(db_path)
+    if database is None:
+        with _databases_lock:
+            # another thread may have opened it while we waited for the lock
+            database = _databases.get(db_path)
+            if database is None:
+                database = open_database(db_path)
+                _databases[db_path] = database
+    return database
+
+
+def reload_database(db_path="data/alleles_db.json"):
+    """
+    Re-open the shared database object of db_path, e.g. after the database or its snapshot was updated.
+    Callers that still hold the previous object keep using it, new get_database() calls return the new one.
+    """
+    database = open_database(db_path)
+    with _databases_lock:
+        _databases[db_path] = database
+    logger.info(f"Database {db_path} reloaded")
+    return database
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile the allele database into a binary snapshot")
+    parser.add_argument("--db_path", default="data/alleles_db.json", type=str)
+    parser.add_argument("--snapshot_path", default=None, type=str)
+    args = parser.parse_args()
+
+    compile_snapshot(args.db_path, args.snapshot_path)
\ No newline at end of file
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+from typing import Dict, Iterable, List
+
+# project imports
+from database import get_database
+from matchmaker import MHCMatchmaker
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains a persistent registry of pre-processed donors.
+A donor colony changes slowly, so instead of validating, classifying and grouping every donor again for
+every job, the registry keeps the result of that work on disk: the validated and classified haplotype,
+the grouped sequences and their bitmask encoding, the average SAS scores and the data of the alleles.
+A new recipient is matched against the whole registry with only the recipient side work and a batched comparison.
+
+The registry is a directory with:
+    - manifest.json: the format version, the version of the database the donors were processed with and the donor IDs
+    - donors/<sha1 of the donor ID>.pkl: the processed donor
+When the database changes, the donors are processed again from their input haplotypes on load.
+The pickle files should only be read from a directory the registry owns.
+"""
+
+REGISTRY_FORMAT_VERSION = 1
+
+
+class DonorRegistry:
+    """
+    Persistent registry of pre-processed donors, with incremental add and remove.
+
+    Usage:
+        registry = DonorRegistry("data/donor_registry")
+        registry.add_donors({"D1": ["A*01:01", ...], ...})
+        matchmaker = registry.match({"R1": ["A*02:01", ...]})
+        matchmaker.best_donors("R1", k=10)
+    """
+
+    def __init__(self, path: str, db=None):
+        """
+        Parameters:
+            path (str): Directory of the registry, created if it does not exist
+            db: Database object, defaults to the shared database (get_database)
+        """
+        self.path = path
+        self.db = db if db is not None else get_database()
+        self.donors = {}
+        os.makedirs(os.path.join(path, "donors"), exist_ok=True)
+        self._load()
+
+    def _donor_path(self, donor_id: str) -> str:
+        digest = hashlib.sha1(donor_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, "donors", f"{digest}.pkl")
+
+    def _load(self) -> None:
+        manifest_path = os.path.join(self.path, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != REGISTRY_FORMAT_VERSION:
+            logger.warning(f"Donor registry {self.path} has format version {manifest.get('format_version')}, "
+                           f"expected {REGISTRY_FORMAT_VERSION}, starting empty")
+            return
+
+        for donor_id in manifest["donors"]:
+            with open(self._donor_path(donor_id), "rb") as f:
+                self.donors[donor_id] = pickle.load(f)
+
+        if manifest["db_version"] != self.db.version:
+            logger.info(f"The database changed since donor registry {self.path} was built, processing the donors again")
+            self.add_donors({donor_id: entry["input_haplotype"] for donor_id, entry in self.donors.items()})
+        logger.info(f"Donor registry {self.path} loaded with {len(self.donors)} donors")
+
+    def _write(self, path: str, write) -> None:
+        # write to a temporary file first, so a crash never leaves a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _save_manifest(self) -> None:
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump({"format_version": REGISTRY_FORMAT_VERSION, "db_version": self.db.version,
+                           "donors": list(self.donors.keys())}, f)
+        self._write(os.path.join(self.path, "manifest.json"), write)
+
+    def _save_donor(self, donor_id: str) -> None:
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self.donors[donor_id], f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._write(self._donor_path(donor_id), write)
+
+    def add_donors(self, donors: Dict[str, List[str]]) -> None:
+        """
+        Process donors and add them to the registry, donors that are already in the registry are replaced.
+        The alleles are validated (check_alleles), classified, grouped, bitmask encoded and their SAS scores averaged.
+
+        Parameters:
+            donors (Dict[str, List[str]]): {donor_id: haplotype (list of allele IDs)}
+
+        Raises:
+            ValueError: If an allele can not be classified or has no aligned RSA/ASA values
+        """
+        if not donors:
+            return
+        matchmaker = MHCMatchmaker(output_path=self.path, db=self.db)
+        matchmaker.donors = {donor_id: {"Haplotype": list(haplotype)} for donor_id, haplotype in donors.items()}
+        matchmaker.recipients = {}
+        matchmaker.check_alleles()
+        matchmaker.classify_haplotypes()
+        matchmaker.group_alleles()
+
+        invalid_alleles = set(matchmaker.invalid_alleles)
+        for donor_id, donor in matchmaker.donors.items():
+            masks = {}
+            for clas in donor["classified"]:
+                try:
+                    masks[clas] = matchmaker.grouped_mask(donor_id, clas)
+                except ValueError as e:
+                    # compared with the python engine when matched
+                    logger.warning(f"Grouped haplotype of donor {donor_id} in class {clas} can not be encoded: {e}")
+                    masks[clas] = None
+            self.donors[donor_id] = {
+                "input_haplotype": list(donors[donor_id]),
+                "Haplotype": donor["Haplotype"],
+                "classified": donor["classified"],
+                "haplotypeClassGrouped": donor["haplotypeClassGrouped"],
+                "masks": masks,
+                "sas": matchmaker.average_entity_sas_scores(donor),
+                "alleles": {allele: matchmaker.local_db[allele] for allele in donor["Haplotype"]},
+                "invalid_alleles": [allele for allele in donors[donor_id] if allele in invalid_alleles],
+                "transformed_alleles": {allele: new_allele for allele, new_allele in matchmaker.transformed_alleles.items()
+                                        if allele in donors[donor_id]}
+            }
+            self._save_donor(donor_id)
+        self._save_manifest()
+        logger.info(f"{len(donors)} donors added to donor registry {self.path}")
+
+    def remove_donors(self, donor_ids: Iterable[str]) -> None:
+        """
+        Remove donors from the registry.
+
+        Raises:
+            KeyError: If a donor is not in the registry
+        """
+        donor_ids = list(donor_ids)
+        for donor_id in donor_ids:
+            if donor_id not in self.donors:
+                raise KeyError(f"Donor {donor_id} not in the donor registry")
+        for donor_id in donor_ids:
+            del self.donors[donor_id]
+        # the manifest goes first, so it never lists a donor without a file
+        self._save_manifest()
+        for donor_id in donor_ids:
+            os.remove(self._donor_path(donor_id))
+        logger.info(f"{len(donor_ids)} donors removed from donor registry {self.path}")
+
+    def __len__(self) -> int:
+        return len(self.donors)
+
+    def __contains__(self, donor_id: str) -> bool:
+        return donor_id in self.donors
+
+    def match(self, recipients: Dict[str, List[str]], rsa_threshold: float = 0.25,
+              output_path: str = "results/", allele_table_budget: int = None) -> MHCMatchmaker:
+        """
+        Match new recipients against all the donors of the registry.
+        Only the recipients are validated, classified, grouped and averaged, the donors are taken from the registry,
+        and the scores of all pairs are calculated in one batch (calc_score_matrix).
+
+        Parameters:
+            recipients (Dict[str, List[str]]): {recipient_id: haplotype (list of allele IDs)}
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+            output_path (str): Output directory of the matchmaker. Defaults to "results/".
+            allele_table_budget (int, optional): If given, the scores are composed from allele pair difference tables
+                                                 of at most this many bytes (see MHCMatchmaker.build_allele_tables)
+
+        Returns:
+            MHCMatchmaker: The matchmaker with the registry donors and the recipients, with its score_matrix calculated.
+                           Its pair methods (best_donors, pair_details, iter_pairs, allocate_donors, ...) can be used.
+                           The average SAS scores of the registry donors are SasAverages, which index like the
+                           dictionary of average_sas_scores.
+
+        Raises:
+            ValueError: If the registry is empty, or an allele can not be classified or has no aligned RSA/ASA values
+        """
+        if not self.donors:
+            raise ValueError(f"Donor registry {self.path} is empty")
+
+        matchmaker = MHCMatchmaker(output_path=output_path, db=self.db)
+        matchmaker.donors = {}
+        matchmaker.recipients = {recip_id: {"Haplotype": list(haplotype)} for recip_id, haplotype in recipients.items()}
+        matchmaker.check_alleles()
+        matchmaker.classify_haplotypes()
+        matchmaker.group_alleles()
+        for recip_id, recipient in matchmaker.recipients.items():
+            matchmaker.sas_arrays[recip_id] = matchmaker.average_entity_sas_scores(recipient)
+            matchmaker.sas_scores[recip_id] = {clas: averages.to_dict()
+                                               for clas, averages in matchmaker.sas_arrays[recip_id].items()}
+
+        for donor_id, entry in self.donors.items():
+            matchmaker.donors[donor_id] = {"Haplotype": entry["Haplotype"], "classified": entry["classified"],
+                                           "haplotypeClassGrouped": entry["haplotypeClassGrouped"]}
+            matchmaker.grouped_masks[donor_id] = {clas: mask for clas, mask in entry["masks"].items() if mask is not None}
+            matchmaker.sas_arrays[donor_id] = entry["sas"]
+            matchmaker.sas_scores[donor_id] = entry["sas"]
+            matchmaker.local_db.update(entry["alleles"])
+
+        if allele_table_budget is not None:
+            matchmaker.build_allele_tables(allele_table_budget)
+        try:
+            matchmaker.calc_score_matrix(rsa_threshold)
+        except ValueError as e:
+            logger.warning(f"Score matrix not usable, the pairs can only be scored one by one: {e}")
+        logger.info(f"{len(recipients)} recipients matched against {len(self.donors)} registry donors")
+        return matchmaker
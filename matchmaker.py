@@ -1,18 +1,31 @@
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 import logging
 # from dotenv import load_dotenv
 import json
 import os
 import pandas as pd
+import numpy as np
 from ast import literal_eval
 import openpyxl
 import time
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from operator import add
 
 # project imports
-from database import get_database
+from database import SessionDatabase, get_database
 from utils.utils import parse_allele_name
-from utils.epletMatching import create_eplet_dict
+from utils.eplet_registry import EpletTable, get_eplet_registry
+from utils.haplotype_cache import HaplotypeCache, get_haplotype_cache, haplotype_key
+from utils.pair_cache import PairCache, get_pair_cache, pair_key
+from utils.allele_store import AlleleStore, SasAverages
+from utils.allele_table import AlleleTables
+from utils.allocation import allocate, allocation_costs
+from utils.donor_index import DonorIndex
+from utils.mismatch_engine import (class_difference_python, class_difference_bitmask, encode_grouped, stack_masks, score_matrix,
+                                   sweep_score_matrix, LazyClassDifference, SCORE_KEYS, FILTERED_COUNT_KEYS,
+                                   sparse_class_difference, iter_mismatches, count_mismatches, to_dense)
 
 # set up logging
 logging.basicConfig(level=logging.INFO, 
@@ -34,26 +47,73 @@ class MHCMatchmaker:
         output_path (str): Path to the output directory. Defaults to "results/".
         db: Database connection object.
         local_db (Dict): Local cache of allele data from the database.
+        allele_store (AlleleStore): Columnar (NumPy) view of the alleles in local_db.
         invalid_alleles (List): List of alleles that were found to be invalid.
         transformed_alleles (Dict): Dictionary mapping original allele names to transformed names.
         known_eplets (Dict): Dictionary storing information about known eplets found in the analysis.
+        mismatch_engine (str): Engine used to compare grouped haplotypes, "bitmask" (default) or "python".
+        grouped_masks (Dict): Residue bitmasks of the grouped haplotypes, {id: {class: np.ndarray}}, filled on demand.
+        donor_masks (Dict): Stacked bitmasks of the grouped haplotypes of all donors, {class: (stacked, lengths)},
+                            filled on demand (see stacked_donor_masks) and reset when the donors change.
+        score_matrix (Dict): Batched donor x recipient x class scores, see calc_score_matrix.
+        lazy (bool): If True, difference_scoring holds LazyClassDifference results that only keep the scores
+                     and compute the per position details of a pair when they are read. Defaults to False.
+        sparse (bool): If True, the per position vectors of difference_scoring (donor_diff, updated_mismatches, ...)
+                       are sparse {position: entry} dicts of the mismatched positions, see utils.mismatch_engine.
+                       Defaults to False.
+        eplet_bitsets (Dict): Known eplet bitsets of the haplotypes, {id: {class: np.ndarray}}, filled on demand.
+        eplet_mismatch_matrix (Dict): Batched donor x recipient x class eplet mismatch loads, see calc_eplet_mismatch_matrix.
+        donor_index (DonorIndex): Nearest donor index of the donors, see build_donor_index, None before.
+        allele_tables (AlleleTables): Allele pair difference tables of the batched scores, see build_allele_tables,
+                                      None before (the batched scores are compared on the grouped bitmasks).
+        haplotype_cache (HaplotypeCache): Cache of the grouped sequences, bitmasks and SAS averages per haplotype,
+                                          shared by all matchmakers of the process unless another one is given.
+        pair_cache (PairCache): Cache of the class differences, SAS filtered mismatches and known eplets per pair
+                                of haplotypes, shared by all matchmakers of the process unless another one is given.
+        rsa_threshold (float): RSA threshold of the last solvent accessibility filter (filter_by_sas), None before.
+        workers (int): Number of worker processes of perform_matching, the pairwise stages are sharded by recipient
+                       (see match_pairs_parallel). Defaults to 1 (no worker processes).
     """
 
-    def __init__(self, output_path:str = "results/"):
+    def __init__(self, output_path:str = "results/", mismatch_engine: str = "bitmask", lazy: bool = False,
+                 sparse: bool = False, haplotype_cache: HaplotypeCache = None, pair_cache: PairCache = None,
+                 workers: int = 1, db=None):
+        assert mismatch_engine in ["bitmask", "python"], f"Unknown mismatch engine: {mismatch_engine}"
+        assert workers >= 1, f"Invalid number of workers: {workers}"
+        self.mismatch_engine = mismatch_engine
+        self.lazy = lazy
+        self.sparse = sparse
+        self.haplotype_cache = haplotype_cache if haplotype_cache is not None else get_haplotype_cache()
+        self.pair_cache = pair_cache if pair_cache is not None else get_pair_cache()
+        self.workers = workers
+        self.grouped_masks = {}
+        self.donor_masks = {}
+        self.score_matrix = {}
+        self.eplet_bitsets = {}
+        self.eplet_mismatch_matrix = {}
+        self.donor_index = None
+        self.allele_tables = None
+
         self.donors = {}
         self.recipients = {}
         self.difference_scoring = {}
         self.sas_scores = {}
+        self.sas_arrays = {}
+        self.known_eplets = {}
+        self.invalid_alleles = []
+        self.transformed_alleles = {}
+        self.rsa_threshold = None
 
         self.output_path = output_path
         # make the output directory if it does not exist
         os.makedirs(self.output_path, exist_ok=True)
 
-        # Setup the database, either local of mongoD
-        self.db = get_database()
+        # Setup the database, either local of mongoD, unless one is given (e.g. the SessionDatabase of a worker)
+        self.db = db if db is not None else get_database()
 
         # put all the relevant information from the database in a local dictionary
         self.local_db = {}
+        self.allele_store = None
     
     def load_local_db(self):
         """
@@ -73,6 +133,9 @@ class MHCMatchmaker:
                 allele_data = self.db.find(allele)
                 self.local_db[allele] = allele_data
 
+        # columnar view of the session alleles, the SAS matrices are kept in double precision
+        self.allele_store = AlleleStore.from_alleles(self.local_db, sas_dtype=np.float64)
+
         logger.info(f"Local database loaded with {len(self.local_db)} alleles")
         return None
 
@@ -258,7 +321,7 @@ class MHCMatchmaker:
 
                     # Check if the allele is in the secondary names of any other allele
                     #secondary_name_match = self.collection.find_one({"secondary_names": allele})
-                    secondary_name_match = self.db.specific_find("secondary_names", allele)
+                    secondary_name_match = self.db.find_by_secondary_name(allele)
 
                     if secondary_name_match:
                         # Replace with the known name
@@ -282,38 +345,20 @@ class MHCMatchmaker:
                         # If the allele is not found in the database, check if the allele can be changed with a similar base allele
                         base_allele = parse_allele_name(allele)[:3]
                         base_allele = base_allele[0] + "*" + ":".join(base_allele[1:])
-                        # find all alleles that have base_allele in their name (_id)
+                        # find all usable alleles under base_allele, sorted by the length of their name
                         #similar_alleles = self.collection.find({"$text": {"$search": base_allele}})
-                        similar_alleles = self.db.str_in_allele(base_allele)
-                        similar_alleles = list(similar_alleles)
-
-                        # if there is only one similar allele, use it
-                        if len(similar_alleles) == 1 and similar_alleles[0]["status"] != "abandoned" and similar_alleles[0]["aligned_seq"] != "":
-                            logger.info(f"Allele {allele} not found in database, but similar allele {similar_alleles[0]['_id']} found")
-                            new_allele_id = similar_alleles[0]["_id"]
-                            if id in self.donors:
-                                # replace the allele in the haplotype
-                                self.donors[id]["Haplotype"].remove(allele)
-                                self.donors[id]["Haplotype"].append(new_allele_id)
-                            elif id in self.recipients:
-                                self.recipients[id]["Haplotype"].remove(allele)
-                                self.recipients[id]["Haplotype"].append(new_allele_id)
-                            allele_data = self.db.bson_to_dataclass(similar_alleles[0])
-                            self.transformed_alleles[allele] = new_allele_id
+                        similar_alleles = self.db.find_alleles_with_prefix(base_allele)
 
-                        # if there are multiple similar alleles,use the shortest one
-                        elif len(similar_alleles) > 1:
-                            logger.info(f"Allele {allele} not found in database, but multiple similar alleles found: {[allele['_id'] for allele in similar_alleles]}")
-                            # find the shortest allele
-                            sorted_similar_alleles = sorted(similar_alleles, key=lambda x: len(x["_id"]))
-                            #print("Sorted similar alleles: ", sorted_similar_alleles)
-                            # choose the first one if the status is not "abandoned" and the sequence is not empty
-                            for similar_allele in sorted_similar_alleles:
-                                if similar_allele["status"] != "abandoned" and similar_allele["aligned_seq"] != "":
-                                    shortest_allele = similar_allele
-                                    break
+                        if similar_alleles:
+                            if len(similar_alleles) == 1:
+                                logger.info(f"Allele {allele} not found in database, but similar allele {similar_alleles[0]['_id']} found")
+                            else:
+                                # if there are multiple similar alleles, use the shortest one
+                                logger.info(f"Allele {allele} not found in database, but multiple similar alleles found: {[allele['_id'] for allele in similar_alleles]}")
+                            shortest_allele = similar_alleles[0]
                             new_allele_id = shortest_allele["_id"]
                             if id in self.donors:
+                                # replace the allele in the haplotype
                                 self.donors[id]["Haplotype"].remove(allele)
                                 self.donors[id]["Haplotype"].append(new_allele_id)
                             elif id in self.recipients:
@@ -438,33 +483,65 @@ class MHCMatchmaker:
             # loop over all classes
             for allele_class in donors_and_recips[id]["classified"]:
                 haplotype = donors_and_recips[id]["classified"][allele_class]   
-                # if the haplotype is empty, add an empty list
-                if len(haplotype) == 0:
-                    haplotypeClassGrouped[allele_class] = []
-                elif len(haplotype) == 1:
-                    #allele_data = self.collection.find_one({"_id": haplotype[0]})
-                    allele_data = self.local_db[haplotype[0]]
-                    base_sequence = allele_data.aligned_seq
-                    haplotypeClassGrouped[allele_class] = list(base_sequence)
-                else:
-                    #allele_data = self.collection.find_one({"_id": haplotype[0]})
-                    allele_data = self.local_db[haplotype[0]]
-                    base_sequence = allele_data.aligned_seq
-                    for allele in haplotype[1:]:
-                        #allele_data = self.collection.find_one({"_id": allele})
-                        allele_data = self.local_db[allele]
-                        base_sequence = list(map(add, base_sequence, allele_data.aligned_seq))
-                    haplotypeClassGrouped[allele_class] = base_sequence
+                # identical haplotypes are grouped once, the copy keeps the cached list unmodified
+                grouped = self.haplotype_cache.lookup(self.haplotype_key(allele_class, haplotype), "grouped",
+                                                      partial(self.group_haplotype, haplotype))
+                haplotypeClassGrouped[allele_class] = list(grouped)
             
             if id in self.donors:
                 self.donors[id]["haplotypeClassGrouped"] = haplotypeClassGrouped
             elif id in self.recipients:
                 self.recipients[id]["haplotypeClassGrouped"] = haplotypeClassGrouped
+            # the bitmasks of the previous grouping are outdated
+            self.grouped_masks.pop(id, None)
+        self.donor_masks = {}
         
         # logging
         logger.info("Alleles have been grouped")
         
         return self.donors, self.recipients
+
+    def haplotype_key(self, clas: str, haplotype: List[str]) -> Tuple:
+        """Get the haplotype cache key of the alleles of a class, see utils.haplotype_cache"""
+        return haplotype_key(self.db.version, clas, haplotype)
+
+    def pair_key(self, donor_id: str, recipient_id: str, clas: str, rsa_threshold: float = None,
+                 eplets: str = None) -> Tuple:
+        """
+        Get the pair cache key of a donor and recipient for a class, see utils.pair_cache.
+        eplets is the fingerprint of the eplet table, for the results that depend on the known eplets.
+        """
+        variant = (self.mismatch_engine, self.sparse) if eplets is None else (self.mismatch_engine, self.sparse, eplets)
+        return pair_key(self.db.version, clas, self.donors[donor_id]["classified"][clas],
+                        self.recipients[recipient_id]["classified"][clas], rsa_threshold, variant=variant)
+
+    def group_haplotype(self, haplotype: List[str]) -> List[str]:
+        """
+        Combines the aligned sequences of the alleles of one class by position.
+
+        Parameters:
+            haplotype (List[str]): The alleles of the class
+
+        Returns:
+            List[str]: For every position, the residues of all alleles at that position
+        """
+        # if the haplotype is empty, add an empty list
+        if len(haplotype) == 0:
+            return []
+        elif len(haplotype) == 1:
+            #allele_data = self.collection.find_one({"_id": haplotype[0]})
+            allele_data = self.local_db[haplotype[0]]
+            base_sequence = allele_data.aligned_seq
+            return list(base_sequence)
+        else:
+            #allele_data = self.collection.find_one({"_id": haplotype[0]})
+            allele_data = self.local_db[haplotype[0]]
+            base_sequence = allele_data.aligned_seq
+            for allele in haplotype[1:]:
+                #allele_data = self.collection.find_one({"_id": allele})
+                allele_data = self.local_db[allele]
+                base_sequence = list(map(add, base_sequence, allele_data.aligned_seq))
+            return base_sequence
                 
     def calcSingleDifference(self, donor_id: str, recipient_id: str) -> Dict:
         """
@@ -488,6 +565,7 @@ class MHCMatchmaker:
                 - all_donor_diff_ratios: Ratios of each differing element in donor
                 - all_recip_diff_counts: Counts of each differing element in recipient
                 - all_recip_diff_ratios: Ratios of each differing element in recipient
+                - length: Number of compared positions (sparse representation only)
         
         Raises:
             AssertionError: If donor or recipient is not found, or if they have different classes
@@ -501,61 +579,68 @@ class MHCMatchmaker:
         # Loop over all classes and calculate the difference scores
         class_scores = {}
         for clas in self.recipients[recipient_id]["classified"].keys():
-            donor_grouped = self.donors[donor_id]["haplotypeClassGrouped"][clas]
-            recipient_grouped = self.recipients[recipient_id]["haplotypeClassGrouped"][clas]
-            
-            # in the case that the donor and recipient have different lengths, we need to pad the shorter one with '-'
-            donor_grouped = [allele if i < len(donor_grouped) else '-' for i, allele in enumerate(donor_grouped)]
-            recipient_grouped = [allele if i < len(recipient_grouped) else '-' for i, allele in enumerate(recipient_grouped)]
+            class_scores[clas] = self.calcSingleClassDifference(donor_id, recipient_id, clas)
 
-            # calculate the difference between the donor and recipient grouped haplotypes
-            all_donor_diff_counts = []
-            all_donor_diff_ratios = []
-            all_recip_diff_counts = []
-            all_recip_diff_ratios = []
-
-            for a1, a2 in zip(donor_grouped, recipient_grouped):
-                donor_diff_elems = set(a1).difference(set(a2)) # elements in a1 that are not in a2
-
-                donor_diff_counts = {elem: a1.count(elem) for elem in donor_diff_elems} 
-                donor_diff_ratios = {elem: a1.count(elem) / len(a1) for elem in donor_diff_elems}
-                
-                all_donor_diff_counts.append(donor_diff_counts)
-                all_donor_diff_ratios.append(donor_diff_ratios)
-
-                recip_diff_elems = set(a2).difference(set(a1))
-                recip_diff_counts = {elem: a2.count(elem) for elem in recip_diff_elems}
-                recip_diff_ratios = {elem: a2.count(elem) / len(a2) for elem in recip_diff_elems}
+        return class_scores
 
-                all_recip_diff_counts.append(recip_diff_counts)
-                all_recip_diff_ratios.append(recip_diff_ratios)
+    def calcSingleClassDifference(self, donor_id: str, recipient_id: str, clas: str, store: bool = True) -> Dict:
+        """
+        Calculates the mismatches between a specific donor and recipient for one class,
+        see calcSingleDifference. Pairs of identical haplotypes are compared once (see pair_cache).
+        If store is False, a result that is not cached yet is not added to the pair cache.
+        """
+        # the copy keeps the cached result unmodified when filter_by_sas adds its keys
+        result = self.pair_cache.lookup(self.pair_key(donor_id, recipient_id, clas), "difference",
+                                        partial(self.compare_class, donor_id, recipient_id, clas), store)
+        return dict(result)
 
+    def compare_class(self, donor_id: str, recipient_id: str, clas: str) -> Dict:
+        """
+        Compares the grouped haplotypes of a donor and recipient for one class with the mismatch engine.
+        """
+        donor_grouped = self.donors[donor_id]["haplotypeClassGrouped"][clas]
+        recipient_grouped = self.recipients[recipient_id]["haplotypeClassGrouped"][clas]
+
+        if self.mismatch_engine == "bitmask":
+            try:
+                return class_difference_bitmask(donor_grouped, recipient_grouped,
+                                                self.grouped_mask(donor_id, clas),
+                                                self.grouped_mask(recipient_id, clas),
+                                                sparse=self.sparse)
+            except ValueError as e:
+                logger.warning(f"Bitmask engine not usable for donor {donor_id} and recipient {recipient_id} in class {clas}, using the python engine: {e}")
+
+        result = class_difference_python(donor_grouped, recipient_grouped)
+        return sparse_class_difference(result) if self.sparse else result
+    
+    def grouped_mask(self, id: str, clas: str) -> np.ndarray:
+        """
+        Get the residue bitmasks of the grouped haplotype of a donor or recipient for a class.
+        The bitmasks are computed on first use and cached in self.grouped_masks.
 
-            donor_diff = [set(a1).difference(set(a2)) for a1, a2 in zip(donor_grouped, recipient_grouped)] # set(donor_grouped) - set(recipient_grouped)  elements present in donor_grouped but not in recipient_grouped
-            recip_diff = [set(a2).difference(set(a1)) for a1, a2 in zip(donor_grouped, recipient_grouped)] # set(recipient_grouped) - set(donor_grouped)  elements present in recipient_grouped but not in donor_grouped
-        
-            # use a mapping function to map the list to different values:
-            # if the set is empty, map to []
-            # if the set is not empty, map to the list of the set
-            donor_diff = list(map(lambda x: [] if x == set() else list(x), donor_diff))
-            recip_diff = list(map(lambda x: [] if x == set() else list(x), recip_diff))
-
-            # calculate the difference scores: if ther diff list is not empty, add 1 to the score
-            donor_diff_score = sum([1 for diff in donor_diff if diff != list()])
-            recip_diff_score = sum([1 for diff in recip_diff if diff != list()])
-
-            class_scores[clas] = {"donor_diff": donor_diff,
-                                  "recip_diff": recip_diff,
-                                  "donor_diff_score": donor_diff_score,
-                                  "recip_diff_score": recip_diff_score,
-                                  "all_donor_diff_counts": all_donor_diff_counts,
-                                  "all_donor_diff_ratios": all_donor_diff_ratios,
-                                  "all_recip_diff_counts": all_recip_diff_counts,
-                                  "all_recip_diff_ratios": all_recip_diff_ratios}
+        Raises:
+            ValueError: If a residue of the grouped haplotype can not be encoded
+        """
+        masks = self.grouped_masks.setdefault(id, {})
+        if clas not in masks:
+            entity = self.donors[id] if id in self.donors else self.recipients[id]
+            masks[clas] = self.haplotype_cache.lookup(self.haplotype_key(clas, entity["classified"][clas]), "mask",
+                                                      partial(encode_grouped, entity["haplotypeClassGrouped"][clas]))
+        return masks[clas]
+
+    def stacked_donor_masks(self, clas: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the stacked bitmasks of the grouped haplotypes of all donors (in donor order) for a class,
+        see mismatch_engine.stack_masks. They do not depend on the recipient, so they are stacked on first use
+        and cached in self.donor_masks until the donors change.
 
+        Raises:
+            ValueError: If a residue of a grouped haplotype can not be encoded
+        """
+        if clas not in self.donor_masks:
+            self.donor_masks[clas] = stack_masks([self.grouped_mask(id, clas) for id in self.donors])
+        return self.donor_masks[clas]
 
-        return class_scores
-    
     def calcMHCDifference(self) -> Dict:
         """
         Calculates difference scores for all donor-recipient pairs.
@@ -563,24 +648,447 @@ class MHCMatchmaker:
         This method iterates through all possible donor-recipient combinations and
         calculates their mismatch scores using calcSingleDifference. The results
         are stored in the self.difference_scoring dictionary.
+        In lazy mode the scores of all pairs are calculated in one batch (calc_score_matrix)
+        and the details of a pair are only calculated when they are read.
         
         Returns:
             Dict: Dictionary mapping recipient IDs to dictionaries of donor IDs and their
                  corresponding difference scores
         """
 
+        if self.lazy:
+            return self.calcLazyMHCDifference()
+
         # Loop over all possible recipient and donor pairs
         for recip_id in self.recipients.keys():
+            self.difference_scoring[recip_id] = self.calcRecipientDifference(recip_id)
+
+        logger.info("Difference scoring calculated for %d recipients and %d donors", len(self.recipients), len(self.donors))
+        
+        return self.difference_scoring
+
+    def calcRecipientDifference(self, recipient_id: str) -> Dict:
+        """
+        Calculates the difference scores of a recipient against all donors, see calcMHCDifference.
+
+        Returns:
+            Dict: {donor_id: {class: {...}}}, see calcSingleDifference
+        """
+        scores_dict = {}
+        for donor_id in self.donors.keys():
+            scores_dict[donor_id] = self.calcSingleDifference(donor_id, recipient_id)
+
+            logger.debug("Difference scoring calculated for donor_id: %s and recipient_id: %s", donor_id, recipient_id)
+        return scores_dict
+
+    def calcLazyMHCDifference(self) -> Dict:
+        """
+        Lazy variant of calcMHCDifference: stores a LazyClassDifference for every pair and class,
+        holding only the scores of the batched score matrix.
+
+        Returns:
+            Dict: {recipient_id: {donor_id: {class: LazyClassDifference}}}
+        """
+        try:
+            matrix = self.calc_score_matrix()
+        except ValueError as e:
+            logger.warning(f"Score matrix not usable, calculating the scores pair by pair: {e}")
+            matrix = None
+
+        for i, recip_id in enumerate(self.recipients.keys()):
             scores_dict = {}
-            for donor_id in self.donors.keys():
-                class_scores = self.calcSingleDifference(donor_id, recip_id)
+            for j, donor_id in enumerate(self.donors.keys()):
+                class_scores = {}
+                for clas in self.recipients[recip_id]["classified"].keys():
+                    compute = partial(self.calcSingleClassDifference, donor_id, recip_id, clas)
+                    if matrix is not None:
+                        scores = {key: int(matrix["classes"][clas][key][i, j]) for key in SCORE_KEYS}
+                    else:
+                        result = compute()
+                        scores = {key: result[key] for key in SCORE_KEYS}
+                    if self.sparse:
+                        scores["length"] = min(len(self.donors[donor_id]["haplotypeClassGrouped"][clas]),
+                                               len(self.recipients[recip_id]["haplotypeClassGrouped"][clas]))
+                    class_scores[clas] = LazyClassDifference(scores, compute)
                 scores_dict[donor_id] = class_scores
-
-                logger.info("Difference scoring calculated for donor_id: %s and recipient_id: %s", donor_id, recip_id)
             self.difference_scoring[recip_id] = scores_dict
-        
+
+        logger.info("Lazy difference scoring calculated for %d recipients and %d donors", len(self.recipients), len(self.donors))
+
         return self.difference_scoring
 
+    def pair_details(self, recipient_id: str, donor_id: str) -> Dict:
+        """
+        Get the full (materialized) difference scoring of one recipient-donor pair,
+        also in lazy mode.
+
+        Returns:
+            Dict: {class: {donor_diff: [...], recip_diff: [...], ...}}, see calcSingleDifference and filter_by_sas
+
+        Raises:
+            KeyError: If the pair has not been scored
+        """
+        return {clas: dict(result) for clas, result in self.difference_scoring[recipient_id][donor_id].items()}
+
+    def compact_scoring(self) -> Dict:
+        """
+        Get the scores of all pairs, without the per position details.
+
+        Returns:
+            Dict: {recipient_id: {donor_id: {class: {donor_diff_score, recip_diff_score,
+                                                     updated_mismatches_count, updated_recip_mismatches_count}}}}
+                  the updated counts only after filter_by_sas
+        """
+        keys = SCORE_KEYS + FILTERED_COUNT_KEYS
+        return {recip_id: {donor_id: {clas: {key: result[key] for key in keys if key in result}
+                                      for clas, result in classes.items()}
+                           for donor_id, classes in donors.items()}
+                for recip_id, donors in self.difference_scoring.items()}
+
+    def sas_keep(self, ids: List[str], clas: str, rsa_threshold: float) -> np.ndarray:
+        """
+        Get, for every position of the grouped haplotypes of ids, if a mismatch at that position
+        survives the solvent accessibility filter (see filter_by_sas): the average RSA is missing
+        or at least rsa_threshold. Positions past the averaged positions are kept as well.
+        Needs the average SAS scores (average_sas_scores).
+
+        Returns:
+            np.ndarray: (len(ids), width) bool matrix
+        """
+        class_scores = [self.sas_arrays[id][clas] for id in ids]
+        width = max([len(scores) for scores in class_scores], default=0)
+        keep = np.ones((len(ids), width), dtype=bool)
+        for row, scores in enumerate(class_scores):
+            # NaN (no average RSA) compares False, so those positions are kept
+            keep[row, :len(scores)] = ~(scores.rsa < rsa_threshold)
+        return keep
+
+    def calc_score_matrix(self, rsa_threshold: float = None) -> Dict:
+        """
+        Calculates the mismatch scores of all donor-recipient pairs in one batched call.
+
+        Instead of comparing the pairs one by one (calcSingleDifference), the grouped haplotypes
+        of a class are stacked into bitmask matrices and compared with array operations.
+        Only the scores are computed, the per position details of a pair can be computed on demand
+        with calcSingleDifference.
+
+        Parameters:
+            rsa_threshold (float, optional): If given, the solvent accessibility filtered counts
+                                             are computed as well (needs average_sas_scores)
+
+        Returns:
+            Dict: {"recipients": [recipient_id, ...], "donors": [donor_id, ...],
+                   "classes": {class: {donor_diff_score: np.ndarray, recip_diff_score: np.ndarray,
+                                       updated_mismatches_count: np.ndarray, updated_recip_mismatches_count: np.ndarray}}}
+                  with (n_recipients, n_donors) matrices, the filtered counts only if rsa_threshold is given,
+                  no classes without donors
+
+        Raises:
+            ValueError: If a grouped haplotype contains residues that can not be encoded as a bitmask
+        """
+        recipients = list(self.recipients.keys())
+        donors = list(self.donors.keys())
+        classes = self.donors[donors[0]]["classified"].keys() if donors else []
+
+        self.score_matrix = {"recipients": recipients, "donors": donors, "rsa_threshold": rsa_threshold, "classes": {}}
+        for clas in classes:
+            self.score_matrix["classes"][clas] = self.class_score_matrix(donors, recipients, clas, rsa_threshold)
+
+        logger.info("Score matrix calculated for %d recipients and %d donors", len(recipients), len(donors))
+        return self.score_matrix
+
+    def class_score_matrix(self, donors: List[str], recipients: List[str], clas: str, rsa_threshold: float = None) -> Dict:
+        """
+        Calculates the mismatch scores of all pairs of some donors and recipients for one class in one batched call,
+        see calc_score_matrix. The pairs of haplotypes in the allele table of the class (build_allele_tables) are
+        composed from the table, the others are compared on the grouped bitmasks.
+
+        Returns:
+            Dict[str, np.ndarray]: (n_recipients, n_donors) matrices, see mismatch_engine.score_matrix
+
+        Raises:
+            ValueError: If a grouped haplotype outside the allele table contains residues that can not be encoded as a bitmask
+        """
+        donor_keep, recip_keep = None, None
+        if rsa_threshold is not None:
+            donor_keep = self.sas_keep(donors, clas, rsa_threshold)
+            recip_keep = self.sas_keep(recipients, clas, rsa_threshold)
+
+        # the stacked masks of all donors are cached, other donor lists are stacked per call
+        all_donors_listed = donors == list(self.donors)
+
+        def bitmask_scores(donor_rows, recip_rows):
+            if all_donors_listed:
+                donor_masks, donor_lengths = self.stacked_donor_masks(clas)
+                donor_masks, donor_lengths = donor_masks[donor_rows], donor_lengths[donor_rows]
+            else:
+                donor_masks, donor_lengths = stack_masks([self.grouped_mask(donors[j], clas) for j in donor_rows])
+            recip_masks, recip_lengths = stack_masks([self.grouped_mask(recipients[i], clas) for i in recip_rows])
+            return score_matrix(donor_masks, donor_lengths, recip_masks, recip_lengths,
+                                None if donor_keep is None else donor_keep[donor_rows],
+                                None if recip_keep is None else recip_keep[recip_rows])
+
+        table = self.allele_tables.get(clas) if self.allele_tables is not None else None
+        all_donors, all_recipients = np.arange(len(donors)), np.arange(len(recipients))
+        if table is None:
+            return bitmask_scores(all_donors, all_recipients)
+
+        donor_haplotypes = [self.donors[id]["classified"][clas] for id in donors]
+        recip_haplotypes = [self.recipients[id]["classified"][clas] for id in recipients]
+        covered_donors = np.flatnonzero([table.covers(haplotype) for haplotype in donor_haplotypes])
+        covered_recips = np.flatnonzero([table.covers(haplotype) for haplotype in recip_haplotypes])
+        scores = table.score_matrix([donor_haplotypes[j] for j in covered_donors],
+                                    [recip_haplotypes[i] for i in covered_recips],
+                                    None if donor_keep is None else donor_keep[covered_donors],
+                                    None if recip_keep is None else recip_keep[covered_recips])
+        if len(covered_donors) == len(donors) and len(covered_recips) == len(recipients):
+            return scores
+
+        # the pairs with an allele outside the table are compared on the grouped bitmasks
+        uncovered_donors = np.setdiff1d(all_donors, covered_donors)
+        uncovered_recips = np.setdiff1d(all_recipients, covered_recips)
+        merged = {key: np.zeros((len(recipients), len(donors)), dtype=np.int32) for key in scores}
+        for recip_rows, donor_rows, part in [(covered_recips, covered_donors, scores),
+                                             (covered_recips, uncovered_donors, None),
+                                             (uncovered_recips, all_donors, None)]:
+            if len(recip_rows) == 0 or len(donor_rows) == 0:
+                continue
+            if part is None:
+                part = bitmask_scores(donor_rows, recip_rows)
+            for key, matrix in part.items():
+                merged[key][np.ix_(recip_rows, donor_rows)] = matrix
+        return merged
+
+    def build_allele_tables(self, memory_budget: int = 64 * 2**20) -> AlleleTables:
+        """
+        Builds the allele pair difference tables of the alleles of the donors and recipients (see utils.allele_table),
+        used by the batched scores (calc_score_matrix, best_donors). The tables are kept in self.allele_tables.
+        If the tables of all alleles do not fit in the memory budget, they hold the alleles used most, and the pairs
+        with other alleles are compared on the grouped bitmasks. Needs the classified haplotypes (classify_haplotypes).
+
+        Parameters:
+            memory_budget (int): Maximum size of all the tables in bytes. Defaults to 64 MiB.
+
+        Returns:
+            AlleleTables: The tables
+        """
+        entities = list(self.donors.values()) + list(self.recipients.values())
+        # alleles added to local_db after it was loaded (e.g. the donors of a registry)
+        self.allele_store.add_alleles({allele: self.local_db.get(allele) for entity in entities
+                                       for allele in entity["Haplotype"] if allele not in self.allele_store})
+        classes = entities[0]["classified"].keys() if entities else []
+        haplotypes = {clas: [entity["classified"][clas] for entity in entities] for clas in classes}
+        self.allele_tables = AlleleTables.build(self.allele_store, haplotypes, memory_budget)
+        return self.allele_tables
+
+    def best_donors(self, recipient_id: str, k: int = 10, class_weights: Dict[str, float] = None,
+                    rsa_threshold: float = 0.25) -> List[Dict]:
+        """
+        Finds the k donors with the fewest solvent accessibility filtered donor mismatches for a recipient.
+        The score of a donor is the sum over the classes of the class weight times its updated_mismatches_count
+        (see filter_by_sas), lower is better, ties are ranked in donor order.
+
+        The exact scores of all donors are computed in one batched call per class (class_score_matrix with
+        the solvent accessibility filter), and the detail of the pairs is only calculated for the donors that
+        score at most the k-th smallest score (the top k with its ties), the eplets for the top k.
+        If a class can not be encoded as bitmasks, the detail is calculated for all donors.
+        If the donor index is built with the same RSA threshold (build_donor_index), the top k is taken from
+        the index instead, without scoring every donor.
+        Needs the grouped haplotypes (group_alleles) and the average SAS scores (average_sas_scores).
+
+        Parameters:
+            recipient_id (str): The recipient identifier
+            k (int): Number of donors. Defaults to 10.
+            class_weights (Dict[str, float], optional): Weight of every class, classes that are not in the
+                                                        dictionary are left out. Defaults to a weight of 1 for all classes.
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+
+        Returns:
+            List[Dict]: The top k donors, best first:
+                        [{"donor_id": str, "score": float, "scores": {class: {...}}, "eplets": {class: {...}}}]
+                        with the scores and eplets of the pair as in iter_pairs
+
+        Raises:
+            KeyError: If the recipient is not found
+            ValueError: If a class weight is negative
+        """
+        donors = list(self.donors.keys())
+        classes = list(self.recipients[recipient_id]["classified"].keys())
+        if class_weights is None:
+            class_weights = {clas: 1.0 for clas in classes}
+        if any(weight < 0 for weight in class_weights.values()):
+            raise ValueError(f"Class weights must not be negative: {class_weights}")
+        weights = {clas: class_weights[clas] for clas in classes if class_weights.get(clas, 0) != 0}
+        if k <= 0 or not donors:
+            return []
+
+        candidates = None
+        if self.donor_index is not None and self.donor_index.rsa_threshold == rsa_threshold:
+            try:
+                positions = {donor_id: j for j, donor_id in enumerate(donors)}
+                candidates = [positions[top["donor_id"]] for top in self.nearest_donors(recipient_id, k, weights, rsa_threshold)]
+            except ValueError as e:
+                logger.warning(f"Donor index not usable for recipient {recipient_id}, using the batched scores: {e}")
+
+        if candidates is None:
+            batched = np.zeros(len(donors))
+            try:
+                for clas, weight in weights.items():
+                    batched += weight * self.class_score_matrix(donors, [recipient_id], clas,
+                                                                rsa_threshold)["updated_mismatches_count"][0]
+                # the top k are the donors that score at most the k-th smallest score, with its ties
+                kth = np.partition(batched, min(k, len(donors)) - 1)[min(k, len(donors)) - 1]
+                candidates = np.flatnonzero(batched <= kth).tolist()
+            except ValueError as e:
+                logger.warning(f"No batched scores for recipient {recipient_id}, the detail of all donors is calculated: {e}")
+                candidates = list(range(len(donors)))
+
+        ranked = []
+        for j in candidates:
+            donor_id = donors[j]
+            scores = {}
+            for clas in weights:
+                pair_scores = self.calcSingleClassDifference(donor_id, recipient_id, clas)
+                pair_scores.update(self.cached_filter_pair_by_sas(recipient_id, donor_id, clas, rsa_threshold, pair_scores))
+                scores[clas] = pair_scores
+            score = sum(weight * scores[clas]["updated_mismatches_count"] for clas, weight in weights.items())
+            ranked.append((score, j, scores))
+        ranked.sort(key=lambda item: (item[0], item[1]))
+
+        top = []
+        for score, j, scores in ranked[:k]:
+            donor_id = donors[j]
+            eplets = {}
+            for clas, pair_scores in scores.items():
+                eplet_table = get_eplet_registry().get(clas)
+                if eplet_table is None:
+                    continue
+                class_eplets = self.cached_known_class_eplets(donor_id, recipient_id, clas, eplet_table, pair_scores)
+                if class_eplets:
+                    eplets[clas] = class_eplets
+            top.append({"donor_id": donor_id, "score": score, "scores": scores, "eplets": eplets})
+
+        logger.info("Top %d donors of recipient %s: detail calculated for %d of %d donors",
+                    k, recipient_id, len(candidates), len(donors))
+        return top
+
+    def build_donor_index(self, rsa_threshold: float = 0.25, n_pivots: int = 16) -> DonorIndex:
+        """
+        Builds the nearest donor index over the bitmask encoded grouped haplotypes of the donors (see utils.donor_index),
+        used by nearest_donors and best_donors. The index is kept in self.donor_index.
+        Needs the grouped haplotypes (group_alleles) and the average SAS scores (average_sas_scores).
+
+        Parameters:
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+            n_pivots (int): Number of pivot haplotypes of the index. Defaults to 16.
+
+        Returns:
+            DonorIndex: The index
+
+        Raises:
+            ValueError: If a grouped haplotype contains residues that can not be encoded as a bitmask
+        """
+        donors = list(self.donors.keys())
+        classes = list(next(iter(self.donors.values()))["classified"].keys()) if donors else []
+        masks = {clas: self.stacked_donor_masks(clas) for clas in classes}
+        keep = {clas: self.sas_keep(donors, clas, rsa_threshold) for clas in classes}
+        self.donor_index = DonorIndex(donors, masks, keep, n_pivots=n_pivots, rsa_threshold=rsa_threshold)
+        return self.donor_index
+
+    def nearest_donors(self, recipient_id: str, k: int = 10, class_weights: Dict[str, float] = None,
+                       rsa_threshold: float = 0.25) -> List[Dict]:
+        """
+        Finds the k donors with the fewest solvent accessibility filtered donor mismatches for a recipient
+        with the donor index, which only scores the donors its lower bounds can not rule out.
+        The scores and ranking are those of best_donors, without the detail and eplets of the pairs.
+        The index is built first if there is none for rsa_threshold (build_donor_index).
+
+        Parameters:
+            recipient_id (str): The recipient identifier
+            k (int): Number of donors. Defaults to 10.
+            class_weights (Dict[str, float], optional): Weight of every class, classes that are not in the
+                                                        dictionary are left out. Defaults to a weight of 1 for all classes.
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+
+        Returns:
+            List[Dict]: The top k donors, best first: [{"donor_id": str, "score": float}]
+
+        Raises:
+            KeyError: If the recipient is not found
+            ValueError: If a class weight is negative or a grouped haplotype can not be encoded as a bitmask
+        """
+        classes = list(self.recipients[recipient_id]["classified"].keys())
+        if class_weights is None:
+            class_weights = {clas: 1.0 for clas in classes}
+        weights = {clas: class_weights[clas] for clas in classes if clas in class_weights}
+        if self.donor_index is None or self.donor_index.rsa_threshold != rsa_threshold:
+            self.build_donor_index(rsa_threshold)
+        recipient_masks = {clas: self.grouped_mask(recipient_id, clas) for clas, weight in weights.items() if weight != 0}
+        return [{"donor_id": donor_id, "score": score}
+                for donor_id, score in self.donor_index.query(recipient_masks, k, weights)]
+
+    def allocate_donors(self, class_weights: Dict[str, float] = None, eplet_weight: float = 0.0, capacity=1,
+                        forbidden_pairs: List[Tuple[str, str]] = None, rsa_threshold: float = 0.25) -> Dict:
+        """
+        Assigns the donors to the recipients such that the total cost of the assigned pairs is minimal,
+        instead of ranking the donors of every recipient on its own (see utils.allocation).
+        The cost of a pair is the weighted sum over the classes of its SAS filtered donor mismatch count
+        plus eplet_weight times its donor eplet load (see calc_eplet_mismatch_matrix).
+        Needs the grouped haplotypes (group_alleles) and the average SAS scores (average_sas_scores).
+
+        Parameters:
+            class_weights (Dict[str, float], optional): Weight of every class, classes that are not in the
+                                                        dictionary are left out. Defaults to a weight of 1 for all classes.
+            eplet_weight (float): Weight of the donor eplet load. Defaults to 0.
+            capacity (int or Dict[str, int]): Maximum number of recipients per donor, one value or one per donor
+                                              (donors that are not in the dictionary have capacity 1). Defaults to 1.
+            forbidden_pairs (List[Tuple[str, str]], optional): (recipient_id, donor_id) pairs that must not be assigned
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+
+        Returns:
+            Dict: {"assignments": [{"recipient_id": str, "donor_id": str, "cost": float}, ...],
+                   "unassigned": [recipient_id, ...], "total_cost": float}
+                  every recipient gets a donor if the capacities and forbidden pairs allow it
+
+        Raises:
+            ValueError: If a weight or capacity is negative, a forbidden pair is unknown, or the grouped
+                        haplotypes can not be encoded as bitmasks
+        """
+        recipients = list(self.recipients.keys())
+        donors = list(self.donors.keys())
+
+        # the batched scores and eplet loads are reused if they are of the current donors, recipients and threshold
+        matrix = self.score_matrix
+        if (matrix.get("recipients") != recipients or matrix.get("donors") != donors
+                or matrix.get("rsa_threshold") != rsa_threshold):
+            matrix = self.calc_score_matrix(rsa_threshold)
+        eplet_matrix = None
+        if eplet_weight != 0:
+            eplet_matrix = self.eplet_mismatch_matrix
+            if eplet_matrix.get("recipients") != recipients or eplet_matrix.get("donors") != donors:
+                eplet_matrix = self.calc_eplet_mismatch_matrix()
+        costs = allocation_costs(matrix, class_weights, eplet_matrix, eplet_weight)
+
+        if isinstance(capacity, dict):
+            capacity = [capacity.get(donor_id, 1) for donor_id in donors]
+        forbidden = np.zeros(costs.shape, dtype=bool)
+        recipient_index = {recip_id: i for i, recip_id in enumerate(recipients)}
+        donor_index = {donor_id: j for j, donor_id in enumerate(donors)}
+        for recip_id, donor_id in forbidden_pairs or []:
+            if recip_id not in recipient_index or donor_id not in donor_index:
+                raise ValueError(f"Unknown forbidden pair: recipient {recip_id} and donor {donor_id}")
+            forbidden[recipient_index[recip_id], donor_index[donor_id]] = True
+
+        pairs = allocate(costs, capacity, forbidden)
+        assignments = [{"recipient_id": recipients[i], "donor_id": donors[j], "cost": float(costs[i, j])}
+                       for i, j in pairs]
+        assigned = {recipients[i] for i, _ in pairs}
+
+        logger.info("Allocated %d of %d recipients to %d donors", len(assignments), len(recipients), len(donors))
+        return {"assignments": assignments,
+                "unassigned": [recip_id for recip_id in recipients if recip_id not in assigned],
+                "total_cost": float(sum(assignment["cost"] for assignment in assignments))}
+
     def average_sas_scores(self) -> Dict:
         """
         Calculates average solvent accessibility scores for each position in grouped alleles.
@@ -601,61 +1109,77 @@ class MHCMatchmaker:
 
         donors_and_recips = {**self.donors, **self.recipients}
         all_sas_scores = {}
+        all_sas_arrays = {}
         # loop over all donors and recipients
         for id in donors_and_recips:
-            sas_scores = {} 
-            # loop over all the classes
-            for clas in donors_and_recips[id]["classified"]:
-                class_scores = {}
-                # loop over all the allels in the classified haplotype
-                for allele in donors_and_recips[id]["classified"][clas]:
-
-                    # Fetch allele data 
-                    #allele_data = self.collection.find_one({"_id": allele})
-                    allele_data = self.local_db[allele]
-                    
-                    if allele_data is None:
-                        logger.warning(f"Allele {allele} not found in database")
-                        raise ValueError(f"Allele {allele} not found in database")
-                    
-                    rsa_scores = allele_data.aligned_rsa
-                    asa_scores = allele_data.aligned_asa
-                    
-                    if rsa_scores is None:
-                        logger.warning(f"Allele {allele} has no aligned rsa")
-                        raise ValueError(f"Allele {allele} has no aligned rsa")
-                    if asa_scores is None:
-                        logger.warning(f"Allele {allele} has no aligned asa")
-                        raise ValueError(f"Allele {allele} has no aligned asa")
-
-                    
-                    for i, (r, a) in enumerate(zip(rsa_scores, asa_scores)):
-                        if i not in class_scores:
-                            class_scores[i] = {"rsa": 0, "asa": 0, "total": 0}
-                        if r is not None and a is not None:
-                            class_scores[i]["rsa"] += r
-                            class_scores[i]["asa"] += a
-                            class_scores[i]["total"] += 1
-                
-                if class_scores:
-                    class_scores = {int(i): {
-                                                "rsa": valuedict["rsa"] / valuedict["total"] if valuedict["total"] != 0 else None,
-                                                "asa": valuedict["asa"] / valuedict["total"] if valuedict["total"] != 0 else None,
-                                                "total": valuedict["total"]
-                                                } for i, valuedict in class_scores.items()}
-                sas_scores[clas] = class_scores
-            all_sas_scores[id] = sas_scores
+            sas_arrays = self.average_entity_sas_scores(donors_and_recips[id])
+            all_sas_scores[id] = {clas: averages.to_dict() for clas, averages in sas_arrays.items()}
+            all_sas_arrays[id] = sas_arrays
         
         # write the results to a json file
         with open(os.path.join(self.output_path, "sas_scores.json"), "w") as f:
             json.dump(all_sas_scores, f)
         
         self.sas_scores = all_sas_scores
+        self.sas_arrays = all_sas_arrays
 
         # Logging
         logger.info("SAS scores calculated and saved to %s", self.output_path + "sas_scores.json")
 
         return self.sas_scores
+
+    def average_entity_sas_scores(self, entity: Dict) -> Dict[str, SasAverages]:
+        """
+        Calculates the average RSA and ASA scores of every class of a donor or recipient, see average_sas_scores.
+        Identical haplotypes are averaged once (see haplotype_cache).
+
+        Parameters:
+            entity (Dict): The donor or recipient, with its classified haplotype
+
+        Returns:
+            Dict[str, SasAverages]: {class: SasAverages}
+        """
+        sas_arrays = {}
+        for clas, haplotype in entity["classified"].items():
+            sas_arrays[clas] = self.haplotype_cache.lookup(self.haplotype_key(clas, haplotype), "sas",
+                                                           partial(self.average_class_sas_scores, clas, haplotype))
+        return sas_arrays
+
+    def average_class_sas_scores(self, clas: str, haplotype: List[str]) -> SasAverages:
+        """
+        Calculates the average RSA and ASA scores of every position of the alleles of one class,
+        see average_sas_scores. The aligned scores of the alleles are stacked from the allele store
+        and averaged in one call.
+
+        Parameters:
+            clas (str): The class of the alleles
+            haplotype (List[str]): The alleles of the class
+
+        Returns:
+            SasAverages: The averages as arrays, SasAverages.to_dict gives the shape of average_sas_scores
+
+        Raises:
+            ValueError: If an allele is not found or has no aligned RSA/ASA values
+        """
+        for allele in haplotype:
+            allele_data = self.local_db[allele]
+            
+            if allele_data is None:
+                logger.warning(f"Allele {allele} not found in database")
+                raise ValueError(f"Allele {allele} not found in database")
+            if allele_data.aligned_rsa is None:
+                logger.warning(f"Allele {allele} has no aligned rsa")
+                raise ValueError(f"Allele {allele} has no aligned rsa")
+            if allele_data.aligned_asa is None:
+                logger.warning(f"Allele {allele} has no aligned asa")
+                raise ValueError(f"Allele {allele} has no aligned asa")
+
+        store = self.allele_store[clas]
+        averages = SasAverages.from_rows(store, store.rows(haplotype))
+        # the averages are shared through the haplotype cache
+        for array in (averages.rsa, averages.asa, averages.total):
+            array.flags.writeable = False
+        return averages
     
     def filter_by_sas(self, rsa_threshold: float = 0.5) -> Dict:
         """
@@ -679,46 +1203,14 @@ class MHCMatchmaker:
                      updated_recip_mismatches_count: int
                  }}}}
         """
+
+        self.rsa_threshold = rsa_threshold
+        if self.lazy:
+            return self.filter_lazy_by_sas(rsa_threshold)
         
         # loop over each recipient and donor pair, and each class for that pair
         for recip in self.recipients:
-            for donor in self.donors:
-                for clas in self.difference_scoring[recip][donor]:
-                    # initial mismatches
-                    mismatches = self.difference_scoring[recip][donor][clas]["donor_diff"]
-                    updated_mismatches = []
-                    
-                    for index,value in enumerate(mismatches):
-                        if value != list():
-                            # check rsa from self.donor_sas_scores and self.recipient_sas_scores
-                            rsa = self.sas_scores[donor][clas][index]["rsa"]
-
-                            if rsa is not None and rsa < rsa_threshold:
-                                updated_mismatches.append([])
-                            else:
-                                updated_mismatches.append(value)
-                        else:
-                            updated_mismatches.append([])
-                    # updated mismatches is a list of lists: either an empty list (no mismatches) or a list of mismatches
-                    self.difference_scoring[recip][donor][clas]["updated_mismatches"] = updated_mismatches
-                    self.difference_scoring[recip][donor][clas]["updated_mismatches_count"] = sum([1 for diff in updated_mismatches if diff != list()])
-
-                    recip_mismatches = self.difference_scoring[recip][donor][clas]["recip_diff"]
-                    updated_recip_mismatches = []
-                    for index,value in enumerate(recip_mismatches):
-                        if value != list():
-                            rsa = self.sas_scores[recip][clas][index]["rsa"]
-                            if rsa is not None and rsa < rsa_threshold:
-                                updated_recip_mismatches.append([])
-                            else:
-                                updated_recip_mismatches.append(value)
-                        else:
-                            updated_recip_mismatches.append([])
-                    self.difference_scoring[recip][donor][clas]["updated_recip_mismatches"] = updated_recip_mismatches
-                    self.difference_scoring[recip][donor][clas]["updated_recip_mismatches_count"] = sum([1 for diff in updated_recip_mismatches if diff != list()])
-                    
-
-                logger.info("Solvent accessibile filtered mismatches for recipient %s and donor %s ", recip, donor)
+            self.filter_recipient_by_sas(recip, rsa_threshold)
 
         # write the results to a json file
         with open(os.path.join(self.output_path, "difference_scores.json"), "w") as f:
@@ -729,6 +1221,202 @@ class MHCMatchmaker:
 
         return self.difference_scoring
 
+    def filter_recipient_by_sas(self, recipient_id: str, rsa_threshold: float) -> None:
+        """
+        Filters the mismatches of a recipient against all donors by solvent accessibility, see filter_by_sas.
+        The difference scoring of the recipient is updated in place.
+        """
+        for donor in self.donors:
+            for clas, pair_scores in self.difference_scoring[recipient_id][donor].items():
+                pair_scores.update(self.cached_filter_pair_by_sas(recipient_id, donor, clas, rsa_threshold, pair_scores))
+
+            logger.info("Solvent accessibile filtered mismatches for recipient %s and donor %s ", recipient_id, donor)
+
+    def cached_filter_pair_by_sas(self, recipient_id: str, donor_id: str, clas: str, rsa_threshold: float,
+                                  pair_scores: Dict, store: bool = True) -> Dict:
+        """
+        filter_pair_by_sas through the pair cache: pairs of identical haplotypes are filtered once.
+        If store is False, a result that is not cached yet is not added to the pair cache.
+        """
+        return self.pair_cache.lookup(self.pair_key(donor_id, recipient_id, clas, rsa_threshold), "filtered",
+                                      partial(self.filter_pair_by_sas, recipient_id, donor_id, clas, rsa_threshold, pair_scores),
+                                      store)
+
+    def filter_by_sas_sweep(self, rsa_thresholds: List[float]) -> Dict:
+        """
+        Counts the solvent accessibility filtered mismatches of every pair for several RSA thresholds at once.
+
+        Unlike filter_by_sas, difference_scoring is not modified and the mismatch details of the pairs are not read,
+        so it does not materialize the pairs of a lazy matchmaker. The average RSA values of every donor and recipient
+        are ranked against the sorted thresholds once (sas_levels), and the mismatches of all pairs of a class are
+        counted for all thresholds in one batched pass over the grouped bitmasks (mismatch_engine.sweep_score_matrix).
+        A mismatch is kept at a threshold if its RSA is missing or at least the threshold (see filter_mismatches).
+        Classes that can not be encoded as bitmasks are counted pair by pair from their mismatches (sweep_mismatches).
+        Needs the grouped haplotypes (group_alleles) and the average SAS scores (average_sas_scores).
+
+        Parameters:
+            rsa_thresholds (List[float]): The RSA thresholds
+
+        Returns:
+            Dict: {"thresholds": [...], "counts": {recipient_id: {donor_id: {class: {
+                      updated_mismatches_count: [count per threshold],
+                      updated_recip_mismatches_count: [count per threshold]
+                  }}}}}
+        """
+        thresholds = list(rsa_thresholds)
+        levels = sorted(set(thresholds))
+        # the count at a threshold is the count at its rank among the distinct sorted thresholds
+        ranks = [levels.index(threshold) for threshold in thresholds]
+        recipients = list(self.recipients.keys())
+        donors = list(self.donors.keys())
+        classes = self.donors[donors[0]]["classified"].keys() if donors else []
+
+        counts = {recip: {donor: {} for donor in donors} for recip in recipients}
+        for clas in classes:
+            try:
+                donor_masks, donor_lengths = stack_masks([self.grouped_mask(id, clas) for id in donors])
+                recip_masks, recip_lengths = stack_masks([self.grouped_mask(id, clas) for id in recipients])
+            except ValueError as e:
+                logger.warning(f"RSA sweep of class {clas} counted pair by pair: {e}")
+                for recip in recipients:
+                    for donor in donors:
+                        pair_scores = self.calcSingleClassDifference(donor, recip, clas)
+                        counts[recip][donor][clas] = {
+                            "updated_mismatches_count": self.sweep_mismatches(pair_scores["donor_diff"], self.sas_scores[donor][clas], thresholds),
+                            "updated_recip_mismatches_count": self.sweep_mismatches(pair_scores["recip_diff"], self.sas_scores[recip][clas], thresholds)
+                        }
+                continue
+
+            class_counts = sweep_score_matrix(donor_masks, donor_lengths, recip_masks, recip_lengths,
+                                              self.sas_levels(donors, clas, levels), self.sas_levels(recipients, clas, levels),
+                                              len(levels))
+            donor_counts = class_counts["updated_mismatches_count"][ranks].transpose(1, 2, 0).tolist()
+            recip_counts = class_counts["updated_recip_mismatches_count"][ranks].transpose(1, 2, 0).tolist()
+            for i, recip in enumerate(recipients):
+                for j, donor in enumerate(donors):
+                    counts[recip][donor][clas] = {"updated_mismatches_count": donor_counts[i][j],
+                                                  "updated_recip_mismatches_count": recip_counts[i][j]}
+
+        logger.info("Solvent accessibility filtered mismatches counted for %d thresholds", len(thresholds))
+        return {"thresholds": thresholds, "counts": counts}
+
+    def sas_levels(self, ids: List[str], clas: str, rsa_thresholds: List[float]) -> np.ndarray:
+        """
+        Get, for every position of the grouped haplotypes of ids, the number of the sorted rsa_thresholds at which
+        a mismatch at that position survives the solvent accessibility filter, see sas_keep: all of them if the
+        average RSA is missing, else the number of thresholds at most the average RSA.
+
+        Returns:
+            np.ndarray: (len(ids), width) int matrix
+        """
+        class_scores = [self.sas_arrays[id][clas] for id in ids]
+        width = max([len(scores) for scores in class_scores], default=0)
+        levels = np.full((len(ids), width), len(rsa_thresholds), dtype=np.int64)
+        for row, scores in enumerate(class_scores):
+            known = ~np.isnan(scores.rsa)
+            levels[row, :len(scores)][known] = np.searchsorted(rsa_thresholds, scores.rsa[known], side="right")
+        return levels
+
+    def sweep_mismatches(self, mismatches, sas_scores: Dict, rsa_thresholds: List[float]) -> List[int]:
+        """
+        Counts the mismatches kept by filter_mismatches for every threshold of rsa_thresholds.
+
+        Returns:
+            List[int]: The number of kept mismatches per threshold
+        """
+        always_kept = 0
+        rsa_values = []
+        for index, _ in iter_mismatches(mismatches):
+            rsa = sas_scores[index]["rsa"] if index < len(sas_scores) else None
+            if rsa is None:
+                always_kept += 1
+            else:
+                rsa_values.append(rsa)
+        rsa_values.sort()
+        # the mismatches with rsa >= threshold are the ones from bisect_left onwards
+        return [always_kept + len(rsa_values) - bisect_left(rsa_values, threshold) for threshold in rsa_thresholds]
+
+    def filter_pair_by_sas(self, recipient_id: str, donor_id: str, clas: str, rsa_threshold: float,
+                           pair_scores: Dict = None) -> Dict:
+        """
+        Filters the mismatches of a recipient-donor pair for one class based on solvent accessibility scores,
+        see filter_by_sas.
+
+        Parameters:
+            pair_scores (Dict, optional): The class difference of the pair, read from difference_scoring if None
+
+        Returns:
+            Dict: {updated_mismatches, updated_mismatches_count, updated_recip_mismatches, updated_recip_mismatches_count}
+        """
+        if pair_scores is None:
+            pair_scores = self.difference_scoring[recipient_id][donor_id][clas]
+
+        # updated mismatches keep the representation of the initial mismatches (dense or sparse)
+        updated_mismatches = self.filter_mismatches(pair_scores["donor_diff"], self.sas_scores[donor_id][clas], rsa_threshold)
+        updated_recip_mismatches = self.filter_mismatches(pair_scores["recip_diff"], self.sas_scores[recipient_id][clas], rsa_threshold)
+
+        return {"updated_mismatches": updated_mismatches,
+                "updated_mismatches_count": count_mismatches(updated_mismatches),
+                "updated_recip_mismatches": updated_recip_mismatches,
+                "updated_recip_mismatches_count": count_mismatches(updated_recip_mismatches)}
+
+    def filter_mismatches(self, mismatches, sas_scores: Dict, rsa_threshold: float):
+        """
+        Empties the mismatches at the positions with an average RSA below rsa_threshold.
+        Positions without an average RSA, also the ones past the averaged positions, are kept (like sas_keep).
+
+        Parameters:
+            mismatches (List or Dict): Dense or sparse mismatch vector (e.g. donor_diff)
+            sas_scores (Dict): Average SAS scores of the class of the donor or recipient, see average_sas_scores
+            rsa_threshold (float): The RSA threshold
+
+        Returns:
+            List or Dict: The filtered mismatch vector, in the representation of mismatches
+        """
+        filtered = {}
+        for index, value in iter_mismatches(mismatches):
+            rsa = sas_scores[index]["rsa"] if index < len(sas_scores) else None
+            if rsa is None or rsa >= rsa_threshold:
+                filtered[index] = value
+        if isinstance(mismatches, dict):
+            return filtered
+        return to_dense(filtered, len(mismatches))
+
+    def filter_lazy_by_sas(self, rsa_threshold: float = 0.5) -> Dict:
+        """
+        Lazy variant of filter_by_sas: sets the solvent accessibility filter of every LazyClassDifference,
+        with the filtered counts of the batched score matrix. Only the scores are written to difference_scores.json.
+        """
+        # kept, so add_entities filters the pairs it adds with the same threshold
+        self.rsa_threshold = rsa_threshold
+        try:
+            matrix = self.calc_score_matrix(rsa_threshold)
+        except ValueError as e:
+            logger.warning(f"Score matrix not usable, filtering the mismatches pair by pair: {e}")
+            matrix = None
+
+        recipients = list(self.recipients.keys())
+        donors = list(self.donors.keys())
+        classes = self.donors[donors[0]]["classified"].keys() if donors else []
+        for clas in classes:
+            donor_keep = self.sas_keep(donors, clas, rsa_threshold)
+            recip_keep = self.sas_keep(recipients, clas, rsa_threshold)
+            for i, recip in enumerate(recipients):
+                for j, donor in enumerate(donors):
+                    counts = None
+                    if matrix is not None:
+                        counts = {key: int(matrix["classes"][clas][key][i, j]) for key in FILTERED_COUNT_KEYS}
+                    self.difference_scoring[recip][donor][clas].set_sas_filter(donor_keep[j], recip_keep[i], counts)
+
+        # write the results to a json file
+        with open(os.path.join(self.output_path, "difference_scores.json"), "w") as f:
+            json.dump(self.compact_scoring(), f)
+
+        logger.info("Solvent accessibile filtered mismatch counts for all recipient and donor pairs saved to %s",
+                    self.output_path + "difference_scores.json")
+
+        return self.difference_scoring
+
     def has_eplet(self, seq: str, eplet_data: Dict) -> bool:
         """
         Determines if a sequence contains a specific eplet.
@@ -759,7 +1447,7 @@ class MHCMatchmaker:
         This method checks if mismatch positions correspond to known eplet positions.
         If a match is found, it verifies if the complete eplet is present in the donor
         or recipient alleles. The analysis is performed for both donor-to-recipient and
-        recipient-to-donor differences.
+        recipient-to-donor differences. The result is kept in self.known_eplets.
         
         Returns:
             Dict: Dictionary mapping recipient IDs to dictionaries of donor IDs and
@@ -770,186 +1458,496 @@ class MHCMatchmaker:
                  }}}}
         """
 
-        file_paths = {
-            "IIDRB": "data/eplets/eplets_DRB.json",
-            "IIDQ": "data/eplets/eplets_DQ.json",
-            "I": "data/eplets/eplets_I.json"
-        }
-
-
         # This method assumes the eplet positions are the same for the mismatch positions        
         
-        random_donor_id = list(self.donors.keys())[0]
-        classes = self.donors[random_donor_id]["classified"].keys()
-
-        local_db = {}
+        eplets_found = {}
 
-        # load the local db with the recipient alleles
+        # Loop over all the recipients and donor pairings and check for known eplets
         for recip_id in self.recipients.keys():
-            for clas in classes:
-                for allele in self.recipients[recip_id]["classified"][clas]:
-                    allele_data = self.local_db[allele]
-                    local_db[allele] = allele_data
+            eplets_found[recip_id] = self.recipient_known_eplets(recip_id)
         
-        # load the local db with the donor alleles
+        with open(os.path.join(self.output_path, "eplets_found.json"), "w") as f:
+            json.dump(eplets_found, f)
+
+        # kept, so add_entities checks the eplets of the pairs it adds
+        self.known_eplets = eplets_found
+        return eplets_found
+
+    def recipient_known_eplets(self, recipient_id: str) -> Dict:
+        """
+        Identifies the known eplets in the mismatches of a recipient against all donors, see check_known_eplets.
+
+        Returns:
+            Dict: {donor_id: {class: {donor_diff: {...}, recip_diff: {...}}}}
+        """
+        classes = self.recipients[recipient_id]["classified"].keys()
+
+        # the known eplets of every class, loaded once per process by the eplet registry
+        eplet_tables = {clas: get_eplet_registry().get(clas) for clas in classes}
+
+        recipient_eplets = {}
         for donor_id in self.donors.keys():
-            for clas in classes:
-                for allele in self.donors[donor_id]["classified"][clas]:
-                    allele_data = self.local_db[allele]
-                    local_db[allele] = allele_data
+            recipient_eplets[donor_id] = self.pair_known_eplets(donor_id, recipient_id, eplet_tables)
+        return recipient_eplets
 
+    def pair_known_eplets(self, donor_id: str, recipient_id: str, eplet_tables: Dict[str, EpletTable] = None) -> Dict:
+        """
+        Identifies the known eplets in the mismatches of a donor-recipient pair, see check_known_eplets.
+        In lazy mode only the mismatch details of this pair are calculated.
 
-        eplets_found = {}
+        Parameters:
+            eplet_tables (Dict[str, EpletTable], optional): The known eplets of every class, None for classes without
+                                                            known eplets. Defaults to the eplet registry.
 
-        # Loop over all the recipients and donor pairings and check for known eplets
-        for recip_id in self.recipients.keys():
-            eplets_found[recip_id] = {}
-            for donor_id in self.donors.keys():
-                
-                class_eplets_found = {}
-                # loop over all the classes
-                for clas in classes:
-                    
-                    if clas not in file_paths:
-                        if clas == "IIDQA" or clas == "IIDQB":
-                            file_path = file_paths["IIDQ"]
+        Returns:
+            Dict: {class: {donor_diff: {...}, recip_diff: {...}}}, classes without known eplets are left out
+
+        Raises:
+            KeyError: If the pair has not been scored
+        """
+        pair_scores = self.difference_scoring[recipient_id][donor_id]
+        if eplet_tables is None:
+            eplet_tables = {clas: get_eplet_registry().get(clas) for clas in pair_scores}
+        class_eplets_found = {}
+        # loop over all the classes
+        for clas, eplet_table in eplet_tables.items():
+            
+            # no known eplets for the class
+            if eplet_table is None:
+                continue
+
+            class_eplets = self.cached_known_class_eplets(donor_id, recipient_id, clas, eplet_table, pair_scores[clas])
+            if class_eplets:
+                logger.info(f"Known eplets for recipient {recipient_id} and donor {donor_id} in class {clas})")
+                class_eplets_found[clas] = class_eplets
+        return class_eplets_found
+
+    def cached_known_class_eplets(self, donor_id: str, recipient_id: str, clas: str, eplet_table: EpletTable,
+                                  pair_scores: Dict, store: bool = True) -> Dict:
+        """
+        known_class_eplets through the pair cache: pairs of identical haplotypes are checked once,
+        until the eplet file of the class changes.
+        If store is False, a result that is not cached yet is not added to the pair cache.
+        """
+        return self.pair_cache.lookup(self.pair_key(donor_id, recipient_id, clas, eplets=eplet_table.fingerprint), "eplets",
+                                      partial(self.known_class_eplets, donor_id, recipient_id, clas, eplet_table, pair_scores),
+                                      store)
+
+    def known_class_eplets(self, donor_id: str, recipient_id: str, clas: str, eplet_table: EpletTable,
+                           pair_scores: Dict = None) -> Dict:
+        """
+        Identifies the known eplets in the mismatches of a donor-recipient pair for one class,
+        see check_known_eplets.
+
+        Parameters:
+            donor_id (str): The donor identifier
+            recipient_id (str): The recipient identifier
+            clas (str): The class
+            eplet_table (EpletTable): The known eplets of the class
+            pair_scores (Dict, optional): The class difference of the pair, read from difference_scoring if None
+
+        Returns:
+            Dict: {donor_diff: {eplet_id: {...}}, recip_diff: {eplet_id: {...}}}, or an empty dictionary
+                  if no known eplets are found
+        """
+        if pair_scores is None:
+            pair_scores = self.difference_scoring[recipient_id][donor_id][clas]
+        eplets_dict = eplet_table.eplets
+        # get all the positions where possible eplets are found
+        eplet_pos = eplet_table.positions
+        # eplet_pos is a dictionary with the eplet positions as keys and lists of eplet ids as values
+
+
+        # DONOR DIFF
+        mismatches = pair_scores["donor_diff"]
+        # turn mismatches into a dictionary {position: mismatch} for mismatches != list()
+        mismatches_dict = {index+1: mismatch for index, mismatch in iter_mismatches(mismatches)}
+        # filter by taking out ['-']
+        mismatches_dict = {str(k): v for k, v in mismatches_dict.items() if '-' not in v}
+        donor_known_eplets = {}
+        # loop ove all the mismatches 
+        tried_eplets = set()
+        for position, mismatch in mismatches_dict.items():
+            # if the position of the mismatch is in the eplet_pos dictionary
+            if position in eplet_pos:
+                eplet_ids = eplet_pos[position]
+                for eplet_id in eplet_ids:
+                    if eplet_id in tried_eplets:
+                        continue
+                    tried_eplets.add(eplet_id)
+                    eplet_data = eplets_dict[eplet_id]
+                    # check in the allele of the donor of that class to see if any allele has the eplet
+                    donor_alleles = self.donors[donor_id]["classified"][clas]
+                    donors_that_have_eplet = []
+                    for allele in donor_alleles:
+                        # Fetch allele data from MongoDB
+                        #allele_data = self.db.find(allele)
+                        allele_data = self.local_db[allele]
+                        if allele_data.eplets is not None:
+                            if eplet_id in allele_data.eplets:
+                                donors_that_have_eplet.append(allele)
                         else:
-                            continue
-                    else:
-                        file_path = file_paths[clas]
-                    
-                    # load the eplet data
-                    with open(file_path, "r") as f:
-                        eplets_dict = json.load(f)
+                            if self.has_eplet(allele_data.aligned_seq, eplet_data):
+                                donors_that_have_eplet.append(allele)
+                    recipients_that_have_diff = []
+                    for recip_allele in self.recipients[recipient_id]["classified"][clas]:
+                        #recip_allele_data = self.db.find(recip_allele)
+                        recip_allele_data = self.local_db[recip_allele]
+                        if recip_allele_data.aligned_seq[int(position)-1] != mismatch:
+                            recipients_that_have_diff.append(recip_allele)
+
+                    if any(donors_that_have_eplet) and any(recipients_that_have_diff):
+                        buffer = 2
+                        # get min and max position of the eplet from the eplet_data
+                        eplet_min_pos, eplet_max_pos = eplet_table.spans[eplet_id]
+                        eplet_min_pos, eplet_max_pos = eplet_min_pos - buffer, eplet_max_pos + buffer
+
+                        donor_known_eplets[eplet_id] = {
+                            "donors": donors_that_have_eplet,
+                            "recipients": recipients_that_have_diff,
+                            "mismatch_position": position,
+                            "min_pos": eplet_min_pos,
+                            "max_pos": eplet_max_pos,
+                            "eplet_data": eplet_data
+                        }
 
-                    
-                    # get all the positions where possible eplets are found
-                    eplet_pos = create_eplet_dict(eplets_dict)
-                    # eplet_pos is a dictionary with the first eplet position as keys and lists of eplet ids as values
-                    
 
-                    # DONOR DIFF
-                    mismatches = self.difference_scoring[recip_id][donor_id][clas]["donor_diff"]
-                    # turn mismatches into a dictionary {position: mismatch} for mismatches != list()
-                    mismatches_dict = {index+1: mismatch for index, mismatch in enumerate(mismatches) if mismatch != list()}
-                    # filter by taking out ['-']
-                    mismatches_dict = {str(k): v for k, v in mismatches_dict.items() if '-' not in v}
-                    donor_known_eplets = {}
-                    # loop ove all the mismatches 
-                    tried_eplets = set()
-                    for position, mismatch in mismatches_dict.items():
-                        # if the position of the mismatch is in the eplet_pos dictionary
-                        if position in eplet_pos:
-                            eplet_ids = eplet_pos[position]
-                            for eplet_id in eplet_ids:
-                                if eplet_id in tried_eplets:
-                                    continue
-                                tried_eplets.add(eplet_id)
-                                eplet_data = eplets_dict[eplet_id]
-                                # check in the allele of the donor of that class to see if any allele has the eplet
-                                donor_alleles = self.donors[donor_id]["classified"][clas]
-                                donors_that_have_eplet = []
-                                for allele in donor_alleles:
-                                    # Fetch allele data from MongoDB
-                                    #allele_data = self.db.find(allele)
-                                    allele_data = local_db[allele]
-                                    if allele_data.eplets is not None:
-                                        if eplet_id in allele_data.eplets:
-                                            donors_that_have_eplet.append(allele)
-                                    else:
-                                        if self.has_eplet(allele_data.aligned_seq, eplet_data):
-                                            donors_that_have_eplet.append(allele)
-                                recipients_that_have_diff = []
-                                for recip_allele in self.recipients[recip_id]["classified"][clas]:
-                                    #recip_allele_data = self.db.find(recip_allele)
-                                    recip_allele_data = local_db[recip_allele]
-                                    if recip_allele_data.aligned_seq[int(position)-1] != mismatch:
-                                        recipients_that_have_diff.append(recip_allele)
-                                
-                                if any(donors_that_have_eplet) and any(recipients_that_have_diff):
-                                    buffer = 2
-                                    # get min and max position of the eplet from the eplet_data
-                                    eplet_min_pos = min([int(pos) for pos in eplet_data.keys()]) - buffer
-                                    eplet_max_pos = max([int(pos) for pos in eplet_data.keys()]) + buffer
-                                    
-                                    donor_known_eplets[eplet_id] = {
-                                        "donors": donors_that_have_eplet,
-                                        "recipients": recipients_that_have_diff,
-                                        "mismatch_position": position,
-                                        "min_pos": eplet_min_pos,
-                                        "max_pos": eplet_max_pos,
-                                        "eplet_data": eplet_data
-                                    }
-                                    
-
-                    # RECIPIENT DIFF                    
-                    mismatches = self.difference_scoring[recip_id][donor_id][clas]["recip_diff"]
-                    # turn mismatches into a dictionary {position: mismatch} for mismatches != list()
-                    mismatches_dict = {index+1: mismatch for index, mismatch in enumerate(mismatches) if mismatch != list()}
-                    # filter by taking out ['-']
-                    mismatches_dict = {str(k): v for k, v in mismatches_dict.items() if '-' not in v}
-
-                    recip_known_eplets = {}
-                    # loop ove all the mismatches 
-                    tried_eplets = set()
-                    for position, mismatch in mismatches_dict.items():
-                        # if the position of the mismatch is in the eplet_pos dictionary
-                        if position in eplet_pos:
-                            eplet_ids = eplet_pos[position]
-                            for eplet_id in eplet_ids:
-                                if eplet_id in tried_eplets:
-                                    continue
-                                tried_eplets.add(eplet_id)
-                                eplet_data = eplets_dict[eplet_id]
-                                # check in the allele of the donor of that class to see if any allele has the eplet
-                                recipient_alleles = self.recipients[recip_id]["classified"][clas]
-                                recipients_that_have_eplet = []
-                                for allele in recipient_alleles:
-                                    # Fetch allele data from MongoDB
-                                    #allele_data = self.db.find(allele)
-                                    allele_data = local_db[allele]
-                                    # if self.has_eplet(allele_data.aligned_seq, eplet_data):
-                                    #     recipients_that_have_eplet.append(allele)
-                                    if allele_data.eplets is not None:
-                                        if eplet_id in allele_data.eplets:
-                                            recipients_that_have_eplet.append(allele)
-                                    else:
-                                        if self.has_eplet(allele_data.aligned_seq, eplet_data):
-                                            recipients_that_have_eplet.append(allele)
-                                donors_that_have_diff = []
-                                for donor_allele in self.donors[donor_id]["classified"][clas]:
-                                    #donor_allele_data = self.db.find(donor_allele)
-                                    donor_allele_data = local_db[donor_allele]
-                                    if donor_allele_data.aligned_seq[int(position)-1] != mismatch:
-                                        donors_that_have_diff.append(donor_allele)
-                                
-                                if any(donors_that_have_diff) and any(recipients_that_have_eplet):
-                                    buffer = 2
-                                    # get min and max position of the eplet from the eplet_data
-                                    eplet_min_pos = min([int(pos) for pos in eplet_data.keys()]) - buffer
-                                    eplet_max_pos = max([int(pos) for pos in eplet_data.keys()]) + buffer
-
-                                    recip_known_eplets[eplet_id] = {
-                                        "donors": donors_that_have_diff,
-                                        "recipients": recipients_that_have_eplet,
-                                        "mismatch_position": position,
-                                        "min_pos": eplet_min_pos,
-                                        "max_pos": eplet_max_pos,
-                                        "eplet_data": eplet_data
-                                    }
-
-                    if donor_known_eplets or recip_known_eplets:
-                        logger.info(f"Known eplets for recipient {recip_id} and donor {donor_id} in class {clas})")
-                        class_eplets_found[clas] = {
-                            "donor_diff": donor_known_eplets,
-                            "recip_diff": recip_known_eplets
+        # RECIPIENT DIFF                    
+        mismatches = pair_scores["recip_diff"]
+        # turn mismatches into a dictionary {position: mismatch} for mismatches != list()
+        mismatches_dict = {index+1: mismatch for index, mismatch in iter_mismatches(mismatches)}
+        # filter by taking out ['-']
+        mismatches_dict = {str(k): v for k, v in mismatches_dict.items() if '-' not in v}
+
+        recip_known_eplets = {}
+        # loop ove all the mismatches 
+        tried_eplets = set()
+        for position, mismatch in mismatches_dict.items():
+            # if the position of the mismatch is in the eplet_pos dictionary
+            if position in eplet_pos:
+                eplet_ids = eplet_pos[position]
+                for eplet_id in eplet_ids:
+                    if eplet_id in tried_eplets:
+                        continue
+                    tried_eplets.add(eplet_id)
+                    eplet_data = eplets_dict[eplet_id]
+                    # check in the allele of the donor of that class to see if any allele has the eplet
+                    recipient_alleles = self.recipients[recipient_id]["classified"][clas]
+                    recipients_that_have_eplet = []
+                    for allele in recipient_alleles:
+                        # Fetch allele data from MongoDB
+                        #allele_data = self.db.find(allele)
+                        allele_data = self.local_db[allele]
+                        # if self.has_eplet(allele_data.aligned_seq, eplet_data):
+                        #     recipients_that_have_eplet.append(allele)
+                        if allele_data.eplets is not None:
+                            if eplet_id in allele_data.eplets:
+                                recipients_that_have_eplet.append(allele)
+                        else:
+                            if self.has_eplet(allele_data.aligned_seq, eplet_data):
+                                recipients_that_have_eplet.append(allele)
+                    donors_that_have_diff = []
+                    for donor_allele in self.donors[donor_id]["classified"][clas]:
+                        #donor_allele_data = self.db.find(donor_allele)
+                        donor_allele_data = self.local_db[donor_allele]
+                        if donor_allele_data.aligned_seq[int(position)-1] != mismatch:
+                            donors_that_have_diff.append(donor_allele)
+
+                    if any(donors_that_have_diff) and any(recipients_that_have_eplet):
+                        buffer = 2
+                        # get min and max position of the eplet from the eplet_data
+                        eplet_min_pos, eplet_max_pos = eplet_table.spans[eplet_id]
+                        eplet_min_pos, eplet_max_pos = eplet_min_pos - buffer, eplet_max_pos + buffer
+
+                        recip_known_eplets[eplet_id] = {
+                            "donors": donors_that_have_diff,
+                            "recipients": recipients_that_have_eplet,
+                            "mismatch_position": position,
+                            "min_pos": eplet_min_pos,
+                            "max_pos": eplet_max_pos,
+                            "eplet_data": eplet_data
                         }
-                eplets_found[recip_id][donor_id] = class_eplets_found
-        
-        with open(os.path.join(self.output_path, "eplets_found.json"), "w") as f:
-            json.dump(eplets_found, f)
 
-        return eplets_found
+        if donor_known_eplets or recip_known_eplets:
+            return {
+                "donor_diff": donor_known_eplets,
+                "recip_diff": recip_known_eplets
+            }
+        return {}
+
+    def eplet_bitset(self, id: str, clas: str) -> Optional[np.ndarray]:
+        """
+        Get the known eplet bitset of the haplotype of a donor or recipient for a class:
+        the OR of the bitsets of its alleles (see EpletTable.presence).
+        The bitsets are computed on first use and cached in self.eplet_bitsets.
+
+        Returns:
+            np.ndarray: packed uint8 bitset, or None if there are no known eplets for the class
+        """
+        table = get_eplet_registry().get(clas)
+        if table is None:
+            return None
+        bitsets = self.eplet_bitsets.setdefault(id, {})
+        if clas not in bitsets:
+            entity = self.donors[id] if id in self.donors else self.recipients[id]
+            bitset = table.empty()
+            for allele in entity["classified"][clas]:
+                allele_data = self.local_db[allele]
+                bitset = bitset | table.presence(allele_data.aligned_seq, allele_data.eplets)
+            bitsets[clas] = bitset
+        return bitsets[clas]
+
+    def eplet_mismatches(self, donor_id: str, recipient_id: str, clas: str) -> Dict:
+        """
+        Get the known eplets the donor has that the recipient lacks, and the other way around, for a class.
+
+        Returns:
+            Dict: {donor_eplets: [eplet_id, ...], recip_eplets: [eplet_id, ...]}, empty lists if there
+                  are no known eplets for the class
+        """
+        table = get_eplet_registry().get(clas)
+        if table is None:
+            return {"donor_eplets": [], "recip_eplets": []}
+        donor_bits = self.eplet_bitset(donor_id, clas)
+        recip_bits = self.eplet_bitset(recipient_id, clas)
+        return {"donor_eplets": table.decode(donor_bits & ~recip_bits),
+                "recip_eplets": table.decode(recip_bits & ~donor_bits)}
+
+    def calc_eplet_mismatch_matrix(self) -> Dict:
+        """
+        Calculates the known eplet mismatch loads of all donor-recipient pairs in one batched call.
+
+        The donor eplet load of a pair is the number of known eplets on the donor haplotype of a class
+        that are not on the recipient haplotype, the recipient load the other way around.
+        Unlike check_known_eplets, it does not look at the mismatch positions, so it complements eplets_found.
+
+        Returns:
+            Dict: {"recipients": [recipient_id, ...], "donors": [donor_id, ...],
+                   "classes": {class: {donor_eplet_load: np.ndarray, recip_eplet_load: np.ndarray}}}
+                  with (n_recipients, n_donors) matrices, classes without known eplets are left out,
+                  no classes without donors or recipients
+        """
+        recipients = list(self.recipients.keys())
+        donors = list(self.donors.keys())
+        # the bitsets of no donors or no recipients can't be stacked
+        classes = self.donors[donors[0]]["classified"].keys() if donors and recipients else []
+
+        self.eplet_mismatch_matrix = {"recipients": recipients, "donors": donors, "classes": {}}
+        for clas in classes:
+            table = get_eplet_registry().get(clas)
+            if table is None:
+                continue
+            donor_eplets = table.unpack(np.stack([self.eplet_bitset(id, clas) for id in donors])).astype(np.float32)
+            recip_eplets = table.unpack(np.stack([self.eplet_bitset(id, clas) for id in recipients])).astype(np.float32)
+
+            # eplets on both haplotypes of a pair, exact in float32 for less than 2**24 eplets
+            shared = recip_eplets @ donor_eplets.T
+            self.eplet_mismatch_matrix["classes"][clas] = {
+                "donor_eplet_load": (donor_eplets.sum(axis=1)[None, :] - shared).astype(np.int32),
+                "recip_eplet_load": (recip_eplets.sum(axis=1)[:, None] - shared).astype(np.int32)
+            }
+
+        logger.info("Eplet mismatch loads calculated for %d recipients and %d donors", len(recipients), len(donors))
+        return self.eplet_mismatch_matrix
+
+    def iter_pairs(self, rsa_threshold: float = 0.25) -> Iterator[Dict]:
+        """
+        Streams the finalized results of all donor-recipient pairs, one pair at a time:
+        the difference scores, the solvent accessibility filtered mismatches and the known eplets,
+        like calcMHCDifference, filter_by_sas and check_known_eplets, in recipient then donor order.
+
+        Nothing is added to difference_scoring, known_eplets or the pair cache (the pair results that are
+        already cached are used), so the memory use does not grow with the number of pairs and a large stream
+        does not evict the cached pairs of other jobs. Needs the grouped haplotypes (group_alleles) and
+        the average SAS scores (average_sas_scores).
+
+        Usage:
+            for pair in matchmaker.iter_pairs(rsa_threshold=0.25):
+                ...
+            # or write them as JSON lines
+            data_exporter.export_pair_stream(matchmaker.iter_pairs(), "results/pairs.jsonl")
+
+        Parameters:
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+
+        Yields:
+            Dict: {"recipient_id": str, "donor_id": str,
+                   "scores": {class: {donor_diff: [...], ..., updated_mismatches: [...], ...}},
+                   "eplets": {class: {donor_diff: {...}, recip_diff: {...}}}}
+                  see calcSingleDifference, filter_by_sas and check_known_eplets
+        """
+        classes = self.donors[next(iter(self.donors))]["classified"].keys() if self.donors else []
+        eplet_tables = {clas: get_eplet_registry().get(clas) for clas in classes}
+
+        for recip_id in self.recipients:
+            for donor_id in self.donors:
+                scores = {}
+                eplets = {}
+                for clas in classes:
+                    pair_scores = self.calcSingleClassDifference(donor_id, recip_id, clas, store=False)
+                    pair_scores.update(self.cached_filter_pair_by_sas(recip_id, donor_id, clas, rsa_threshold, pair_scores,
+                                                                      store=False))
+                    scores[clas] = pair_scores
+                    if eplet_tables[clas] is None:
+                        continue
+                    class_eplets = self.cached_known_class_eplets(donor_id, recip_id, clas, eplet_tables[clas], pair_scores,
+                                                                  store=False)
+                    if class_eplets:
+                        eplets[clas] = class_eplets
+                yield {"recipient_id": recip_id, "donor_id": donor_id, "scores": scores, "eplets": eplets}
+
+    def add_donors(self, donors: Dict[str, List[str]]) -> None:
+        """
+        Adds donors to the session without recomputing the existing pairs, see add_entities.
+
+        Parameters:
+            donors (Dict[str, List[str]]): {donor_id: haplotype (list of allele IDs)}
+        """
+        self.add_entities(donors, is_donor=True)
+
+    def add_recipients(self, recipients: Dict[str, List[str]]) -> None:
+        """
+        Adds recipients to the session without recomputing the existing pairs, see add_entities.
+
+        Parameters:
+            recipients (Dict[str, List[str]]): {recipient_id: haplotype (list of allele IDs)}
+        """
+        self.add_entities(recipients, is_donor=False)
+
+    def add_entities(self, entities: Dict[str, List[str]], is_donor: bool) -> None:
+        """
+        Adds donors or recipients to the session, keeping the results of the stages that have run consistent.
+
+        Only the new donors or recipients are validated, classified, grouped and averaged (if average_sas_scores
+        has run), and only their pairs are scored (if calcMHCDifference has run), filtered with the last
+        RSA threshold (if filter_by_sas has run) and checked for known eplets (if check_known_eplets has run).
+        New donors are added after the existing ones, new recipients after the existing ones.
+        The batched score_matrix and eplet_mismatch_matrix (and the donor_masks and donor_index if donors are added) are reset,
+        calculate them again when needed.
+
+        Parameters:
+            entities (Dict[str, List[str]]): {identifier: haplotype (list of allele IDs)}
+            is_donor (bool): True for donors, False for recipients
+
+        Raises:
+            ValueError: If an identifier is already in the session, or an allele can not be classified
+                        or has no aligned RSA/ASA values
+        """
+        existing = [id for id in entities if id in self.donors or id in self.recipients]
+        if existing:
+            raise ValueError(f"Identifiers already in the session: {existing}")
+        if not entities:
+            return
+
+        # the new entities are validated, classified and grouped by a matchmaker of their own,
+        # so the existing ones are not processed again
+        new = {id: {"Haplotype": list(haplotype)} for id, haplotype in entities.items()}
+        session = MHCMatchmaker(output_path=self.output_path, mismatch_engine=self.mismatch_engine, sparse=self.sparse,
+                                haplotype_cache=self.haplotype_cache, pair_cache=self.pair_cache, db=self.db)
+        session.donors, session.recipients = (new, {}) if is_donor else ({}, new)
+        session.check_alleles()
+        session.classify_haplotypes()
+        session.group_alleles()
+
+        self.local_db.update(session.local_db)
+        # only the new alleles are added to the columnar store
+        if self.allele_store is None:
+            self.allele_store = AlleleStore.from_alleles(session.local_db, sas_dtype=np.float64)
+        else:
+            self.allele_store.add_alleles(session.local_db)
+        self.invalid_alleles.extend(session.invalid_alleles)
+        self.transformed_alleles.update(session.transformed_alleles)
+        if is_donor:
+            self.donors.update(new)
+        else:
+            self.recipients.update(new)
+        self.score_matrix = {}
+        self.eplet_mismatch_matrix = {}
+        if is_donor:
+            self.donor_masks = {}
+            self.donor_index = None
+
+        if self.sas_scores:
+            for id, entity in new.items():
+                self.sas_arrays[id] = self.average_entity_sas_scores(entity)
+                self.sas_scores[id] = {clas: averages.to_dict() for clas, averages in self.sas_arrays[id].items()}
+
+        if self.difference_scoring:
+            pairs = ([(donor_id, recip_id) for recip_id in self.recipients for donor_id in new] if is_donor
+                     else [(donor_id, recip_id) for recip_id in new for donor_id in self.donors])
+            classes = next(iter(new.values()))["classified"].keys()
+            eplet_tables = {clas: get_eplet_registry().get(clas) for clas in classes}
+            for donor_id, recip_id in pairs:
+                self.difference_scoring.setdefault(recip_id, {})[donor_id] = self.score_pair(donor_id, recip_id)
+                if self.known_eplets:
+                    self.known_eplets.setdefault(recip_id, {})[donor_id] = self.pair_known_eplets(donor_id, recip_id, eplet_tables)
+
+        logger.info("%d %s added to the session", len(new), "donors" if is_donor else "recipients")
+
+    def score_pair(self, donor_id: str, recipient_id: str) -> Dict:
+        """
+        Calculates the difference scoring of one donor-recipient pair as calcMHCDifference and, if it has run,
+        filter_by_sas would, in lazy mode as well.
+
+        Returns:
+            Dict: {class: {...}}, see calcSingleDifference and filter_by_sas
+        """
+        if not self.lazy:
+            class_scores = self.calcSingleDifference(donor_id, recipient_id)
+            if self.rsa_threshold is not None:
+                for clas, pair_scores in class_scores.items():
+                    pair_scores.update(self.cached_filter_pair_by_sas(recipient_id, donor_id, clas, self.rsa_threshold,
+                                                                      pair_scores))
+            return class_scores
+
+        class_scores = {}
+        for clas in self.recipients[recipient_id]["classified"].keys():
+            compute = partial(self.calcSingleClassDifference, donor_id, recipient_id, clas)
+            result = compute()
+            scores = {key: result[key] for key in SCORE_KEYS}
+            if self.sparse:
+                scores["length"] = result["length"]
+            class_scores[clas] = LazyClassDifference(scores, compute)
+            if self.rsa_threshold is not None:
+                class_scores[clas].set_sas_filter(self.sas_keep([donor_id], clas, self.rsa_threshold)[0],
+                                                  self.sas_keep([recipient_id], clas, self.rsa_threshold)[0])
+        return class_scores
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """
+        Removes donors and/or recipients from the session, with their pairs.
+        The batched score_matrix, eplet_mismatch_matrix, donor_masks and donor_index are reset, calculate them again when needed.
+
+        Parameters:
+            ids (Iterable[str]): Donor and recipient identifiers
+
+        Raises:
+            KeyError: If an identifier is not in the session
+        """
+        ids = list(ids)
+        unknown = [id for id in ids if id not in self.donors and id not in self.recipients]
+        if unknown:
+            raise KeyError(f"Identifiers not in the session: {unknown}")
+
+        for id in ids:
+            if id in self.donors:
+                del self.donors[id]
+                for donor_scores in self.difference_scoring.values():
+                    donor_scores.pop(id, None)
+                for donor_eplets in self.known_eplets.values():
+                    donor_eplets.pop(id, None)
+            else:
+                del self.recipients[id]
+                self.difference_scoring.pop(id, None)
+                self.known_eplets.pop(id, None)
+            for per_entity in (self.sas_scores, self.sas_arrays, self.grouped_masks, self.eplet_bitsets):
+                per_entity.pop(id, None)
+        self.score_matrix = {}
+        self.eplet_mismatch_matrix = {}
+        self.donor_masks = {}
+        self.donor_index = None
+
+        logger.info("%d donors or recipients removed from the session", len(ids))
 
     def get_relevant_classes(self) -> List[str]:
         """
@@ -974,6 +1972,74 @@ class MHCMatchmaker:
             if relevant:
                 relevant_classes.append(clas)
         return relevant_classes
+
+    def match_pairs_parallel(self, rsa_threshold: float = 0.25, workers: int = None) -> Tuple[Dict, Dict]:
+        """
+        Calculates the difference scores, the solvent accessibility filtered mismatches and the known eplets
+        of all donor-recipient pairs in worker processes, with the same results as calcMHCDifference,
+        filter_by_sas and check_known_eplets.
+
+        The recipients are split into contiguous shards, every worker matches its shards against all donors.
+        Workers get the columnar allele store of the session alleles (allele_store) and their known eplets
+        instead of the database, together with the classified and grouped haplotypes and the average SAS scores
+        (call average_sas_scores first). The difference scoring of every pair is shipped back to the main process.
+        The shards are merged in recipient order, so the results do not depend on the number of workers
+        or on the order the shards finish in.
+        Every worker process has pair and haplotype caches of its own: the results cached by the workers
+        are not added to the caches of the main process and are dropped when the pool exits.
+
+        Parameters:
+            rsa_threshold (float): The RSA threshold of the solvent accessibility filter. Defaults to 0.25.
+            workers (int, optional): Number of worker processes, defaults to self.workers
+
+        Returns:
+            Tuple[Dict, Dict]: The difference scoring and the known eplets, also stored in
+                               self.difference_scoring and self.known_eplets
+        """
+        workers = workers or self.workers
+        recipients = list(self.recipients.keys())
+        # a few shards per worker, so one slow shard does not leave the other workers idle
+        n_shards = min(len(recipients), workers * 4)
+        shards = [recipients[len(recipients) * i // n_shards:len(recipients) * (i + 1) // n_shards]
+                  for i in range(n_shards)]
+
+        # the workers only read the classified and grouped haplotypes of the donors and recipients
+        keys = ["classified", "haplotypeClassGrouped"]
+        state = {
+            "settings": {"output_path": self.output_path, "mismatch_engine": self.mismatch_engine, "sparse": self.sparse},
+            "db_version": self.db.version,
+            "allele_store": self.allele_store,
+            "eplets": {allele: allele_data.eplets for allele, allele_data in self.local_db.items()
+                       if allele_data is not None},
+            "donors": {id: {key: entity[key] for key in keys} for id, entity in self.donors.items()},
+            "recipients": {id: {key: entity[key] for key in keys} for id, entity in self.recipients.items()},
+            "sas_scores": self.sas_scores
+        }
+        shard_results = []
+        if shards:
+            with ProcessPoolExecutor(max_workers=min(workers, n_shards), initializer=_init_worker,
+                                     initargs=(state,)) as executor:
+                # map returns the shards in submission order
+                shard_results = list(executor.map(partial(_match_recipients, rsa_threshold=rsa_threshold), shards))
+
+        self.difference_scoring = {}
+        self.known_eplets = {}
+        self.rsa_threshold = rsa_threshold
+        for shard_result in shard_results:
+            for recip_id, (scoring, eplets) in shard_result.items():
+                self.difference_scoring[recip_id] = scoring
+                self.known_eplets[recip_id] = eplets
+
+        # write the results to json files, like filter_by_sas and check_known_eplets
+        with open(os.path.join(self.output_path, "difference_scores.json"), "w") as f:
+            json.dump(self.difference_scoring, f)
+        with open(os.path.join(self.output_path, "eplets_found.json"), "w") as f:
+            json.dump(self.known_eplets, f)
+
+        logger.info("Difference scoring, SAS filter and known eplets calculated for %d recipients and %d donors "
+                    "in %d shards on %d worker processes", len(self.recipients), len(self.donors), n_shards, workers)
+
+        return self.difference_scoring, self.known_eplets
     
     def perform_matching(self, input_filename: str) -> Dict:
         """
@@ -988,6 +2054,9 @@ class MHCMatchmaker:
         6. Computes average solvent accessibility scores
         7. Filters mismatches based on solvent accessibility
         8. Identifies known eplets in the mismatches
+        9. Calculates the known eplet mismatch loads of all pairs
+
+        With more than one worker, steps 5, 7 and 8 run in worker processes (see match_pairs_parallel).
         
         Parameters:
             input_filename (str): Path to the input file (CSV or Excel)
@@ -1023,23 +2092,81 @@ class MHCMatchmaker:
         # Filter the mismatches by SAS
         self.group_alleles()
 
-        # Calculate the difference scores
-        self.calcMHCDifference()
+        if self.workers > 1 and self.lazy:
+            logger.info("Lazy matching runs in a single process, the scores are already batched")
+
+        if self.workers > 1 and not self.lazy:
+            # average the sas scores
+            self.average_sas_scores()
 
-        # average the sas scores
-        self.average_sas_scores()
+            # the difference scores, SAS filter and known eplets of the pairs, sharded by recipient
+            self.match_pairs_parallel(rsa_threshold=0.25)
+        else:
+            # Calculate the difference scores
+            self.calcMHCDifference()
 
-        # Filter the donors by SAS scores
-        self.filter_by_sas(rsa_threshold=0.25)
+            # average the sas scores
+            self.average_sas_scores()
 
-        # check for known eplets
-        self.known_eplets = self.check_known_eplets()
+            # Filter the donors by SAS scores
+            self.filter_by_sas(rsa_threshold=0.25)
+
+            # check for known eplets
+            self.known_eplets = self.check_known_eplets()
+
+        # count the known eplets of the donor the recipient lacks, and the other way around
+        self.calc_eplet_mismatch_matrix()
 
         stop = time.time()
         execution_time = stop - start
         print(f"Execution time: {execution_time} seconds")
+        logger.info("Haplotype cache: %s", self.haplotype_cache.stats())
+        logger.info("Pair cache: %s", self.pair_cache.stats())
 
         return self.difference_scoring
-    
-        
 
+
+### Worker processes of MHCMatchmaker.match_pairs_parallel ###
+
+# the matchmaker of a worker process, set up once per process by _init_worker
+_worker_matchmaker = None
+
+
+class WorkerAllele(NamedTuple):
+    """The data of an allele read by the pairwise stages of a worker process"""
+    aligned_seq: str
+    eplets: Optional[List[str]]
+
+
+def _init_worker(state: Dict) -> None:
+    """Set up the matchmaker of a worker process from the state shipped by match_pairs_parallel"""
+    global _worker_matchmaker
+    store = state["allele_store"]
+    local_db = {allele: WorkerAllele(store[store.class_of(allele)].aligned_seq(allele), eplets)
+                for allele, eplets in state["eplets"].items() if allele in store}
+    # the session database keeps the version of the database, so the cache keys stay the same
+    matchmaker = MHCMatchmaker(db=SessionDatabase(local_db, state["db_version"]), **state["settings"])
+    matchmaker.local_db = local_db
+    matchmaker.allele_store = store
+    matchmaker.donors = state["donors"]
+    matchmaker.recipients = state["recipients"]
+    matchmaker.sas_scores = state["sas_scores"]
+    _worker_matchmaker = matchmaker
+
+
+def _match_recipients(recipient_ids: List[str], rsa_threshold: float) -> Dict:
+    """
+    Match a shard of recipients against all donors in a worker process.
+
+    Returns:
+        Dict: {recipient_id: (difference scoring, known eplets)}, in shard order
+    """
+    matchmaker = _worker_matchmaker
+    results = {}
+    for recip_id in recipient_ids:
+        matchmaker.difference_scoring[recip_id] = matchmaker.calcRecipientDifference(recip_id)
+        matchmaker.filter_recipient_by_sas(recip_id, rsa_threshold)
+        eplets = matchmaker.recipient_known_eplets(recip_id)
+        # the worker only keeps the results until they are shipped back
+        results[recip_id] = (matchmaker.difference_scoring.pop(recip_id), eplets)
+    return results
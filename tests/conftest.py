@@ -0,0 +1,139 @@
+import json
+import random
+from typing import Dict, List
+
+import pytest
+
+# project imports
+from database import TinyDBDatabase
+from matchmaker import MHCMatchmaker
+from utils.haplotype_cache import HaplotypeCache
+from utils.pair_cache import PairCache
+from utils.eplet_registry import EpletRegistry
+from benchmarks.synthetic import make_alleles, write_tinydb
+
+"""
+Shared fixtures of the tests: a small synthetic allele database with synthetic eplets, a cohort of random donor and
+recipient haplotypes of that database, and matchmakers that ran the pairwise stages on the cohort.
+Every matchmaker gets caches of its own, so the tests do not share cached results.
+"""
+
+RSA_THRESHOLD = 0.25
+N_DONORS = 24
+N_RECIPIENTS = 6
+N_EPLETS = 40
+# eplet class -> loci of the synthetic alleles it covers
+EPLET_LOCI = {"I": ["SLA-1", "SLA-2", "SLA-3"], "IIDQ": ["SLA-DQA", "SLA-DQB1"], "IIDRB": ["SLA-DRB1"]}
+
+
+def make_eplets(alleles: Dict[str, Dict], loci: List[str], n_eplets: int, seed: int = 0) -> Dict[str, Dict[str, str]]:
+    """Eplets of 1 to 3 nearby positions, with the residues of a random allele of the loci, so some alleles have them"""
+    rng = random.Random(seed)
+    seqs = [allele["aligned_seq"] for allele in alleles.values() if allele["locus"] in loci]
+    eplets = {}
+    while len(eplets) < n_eplets:
+        seq = rng.choice(seqs)
+        start = rng.randrange(len(seq) - 6)
+        positions = sorted(rng.sample(range(start, start + 6), rng.randint(1, 3)))
+        if any(seq[pos] == "-" for pos in positions):
+            continue
+        eplets[f"{len(eplets)}{seq[positions[0]]}"] = {str(pos + 1): seq[pos] for pos in positions}
+    return eplets
+
+
+def build_matchmaker(db, output_path: str, donors: Dict[str, List[str]], recipients: Dict[str, List[str]],
+                     rsa_threshold: float = RSA_THRESHOLD, stages: bool = True, **settings) -> MHCMatchmaker:
+    """
+    A matchmaker of the donors and recipients ({id: haplotype}), with fresh caches unless others are given.
+    With stages, the stages of perform_matching up to filter_by_sas have run.
+    """
+    settings.setdefault("haplotype_cache", HaplotypeCache())
+    settings.setdefault("pair_cache", PairCache())
+    mm = MHCMatchmaker(output_path=output_path, db=db, **settings)
+    mm.donors = {id: {"Haplotype": list(haplotype)} for id, haplotype in donors.items()}
+    mm.recipients = {id: {"Haplotype": list(haplotype)} for id, haplotype in recipients.items()}
+    mm.check_alleles()
+    mm.classify_haplotypes()
+    mm.group_alleles()
+    if stages:
+        mm.calcMHCDifference()
+        mm.average_sas_scores()
+        mm.filter_by_sas(rsa_threshold)
+    return mm
+
+
+@pytest.fixture(scope="session")
+def synthetic_alleles():
+    # the eplets of the alleles are not checked yet (None), so they are found from the aligned sequences
+    return {allele_id: {**doc, "eplets": None} for allele_id, doc in make_alleles(200, seed=0, mutation_rate=0.1).items()}
+
+
+@pytest.fixture(scope="session")
+def synthetic_db(tmp_path_factory, synthetic_alleles):
+    tmp = tmp_path_factory.mktemp("synthetic_db")
+    return TinyDBDatabase(write_tinydb(synthetic_alleles, str(tmp / "alleles_db.json")))
+
+
+@pytest.fixture(scope="session")
+def eplet_paths(tmp_path_factory, synthetic_alleles) -> Dict[str, str]:
+    """Synthetic eplet files of the synthetic alleles, {eplet class: path}"""
+    tmp = tmp_path_factory.mktemp("eplets")
+    paths = {}
+    for seed, (clas, loci) in enumerate(EPLET_LOCI.items()):
+        paths[clas] = str(tmp / f"eplets_{clas}.json")
+        with open(paths[clas], "w") as f:
+            json.dump(make_eplets(synthetic_alleles, loci, N_EPLETS, seed), f)
+    return paths
+
+
+@pytest.fixture(autouse=True)
+def eplet_registry(monkeypatch, eplet_paths) -> EpletRegistry:
+    """Every test gets an eplet registry of the synthetic eplet files instead of the process wide one"""
+    registry = EpletRegistry(eplet_paths)
+    monkeypatch.setattr("utils.eplet_registry._registry", registry)
+    return registry
+
+
+@pytest.fixture(scope="session")
+def cohort(synthetic_alleles):
+    """Random donor and recipient haplotypes, ({donor_id: haplotype}, {recipient_id: haplotype})"""
+    rng = random.Random(0)
+    per_class = {}
+    for allele_id, allele in synthetic_alleles.items():
+        if allele["status"] == "Public":
+            per_class.setdefault((allele["allele_class"], allele["locus"]), []).append(allele_id)
+    # a small pool per locus, so donors share alleles and some haplotypes are identical
+    pools = {locus: rng.sample(ids, min(len(ids), 6)) for locus, ids in per_class.items()}
+
+    def haplotype():
+        return [allele for pool in pools.values() for allele in rng.sample(pool, rng.randint(1, 2))]
+
+    donors = {f"D{i}": haplotype() for i in range(N_DONORS)}
+    recipients = {f"R{i}": haplotype() for i in range(N_RECIPIENTS)}
+    return donors, recipients
+
+
+@pytest.fixture
+def make_matchmaker(synthetic_db, cohort, tmp_path):
+    """Factory of matchmakers of the cohort (or of other donors and recipients), see build_matchmaker"""
+    def make(donors=None, recipients=None, **kwargs) -> MHCMatchmaker:
+        return build_matchmaker(synthetic_db, str(tmp_path / "results") + "/",
+                                cohort[0] if donors is None else donors,
+                                cohort[1] if recipients is None else recipients, **kwargs)
+    return make
+
+
+@pytest.fixture(scope="module")
+def matchmaker(synthetic_db, cohort, tmp_path_factory):
+    """A matchmaker of the cohort that ran the pairwise stages, shared by the tests of a module: do not modify its donors or recipients"""
+    return build_matchmaker(synthetic_db, str(tmp_path_factory.mktemp("results")) + "/", *cohort)
+
+
+@pytest.fixture
+def brute_force_scores():
+    """Ranks the donors of a recipient from the pairs scored one by one, [(score, donor position, donor_id)] best first"""
+    def rank(mm: MHCMatchmaker, recipient_id: str, weights: Dict[str, float]) -> List:
+        scores = mm.difference_scoring[recipient_id]
+        return sorted((sum(weight * scores[donor_id][clas]["updated_mismatches_count"] for clas, weight in weights.items()),
+                       j, donor_id) for j, donor_id in enumerate(mm.donors))
+    return rank
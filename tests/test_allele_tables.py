@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+"""
+Tests of the batched scores composed from the allele pair difference tables against the scores compared on the
+grouped bitmasks, with all alleles in the tables and with some left out.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+@pytest.mark.parametrize("memory_budget", [64 * 2**20, 2**14])
+def test_allele_tables_match_score_matrix(matchmaker, memory_budget):
+    matchmaker.allele_tables = None
+    expected = matchmaker.calc_score_matrix(matchmaker.rsa_threshold)["classes"]
+    # a small budget leaves some alleles out of the tables, those pairs are compared on the bitmasks
+    matchmaker.build_allele_tables(memory_budget)
+    try:
+        scores = matchmaker.calc_score_matrix(matchmaker.rsa_threshold)["classes"]
+    finally:
+        matchmaker.allele_tables = None
+    for clas, class_scores in expected.items():
+        for key, matrix in class_scores.items():
+            assert np.array_equal(scores[clas][key], matrix), (clas, key)
@@ -0,0 +1,69 @@
+import itertools
+
+import numpy as np
+import pytest
+
+# project imports
+from utils.allocation import allocate
+
+"""
+Tests of the donor-recipient allocation solver against the best of all assignments, on small cost matrices
+and on the allocation of the cohort.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def brute_force_allocation(cost: np.ndarray, capacity: np.ndarray, forbidden: np.ndarray):
+    """(number of assigned rows, total cost) of the best assignment: as many rows as possible, at a minimal cost"""
+    n_rows, n_cols = cost.shape
+    best = (0, 0.0)
+    for choice in itertools.product([None] + list(range(n_cols)), repeat=n_rows):
+        pairs = [(i, j) for i, j in enumerate(choice) if j is not None]
+        if any(forbidden[i, j] for i, j in pairs):
+            continue
+        if any(sum(1 for _, j in pairs if j == col) > capacity[col] for col in range(n_cols)):
+            continue
+        total = sum(cost[i, j] for i, j in pairs)
+        if len(pairs) > best[0] or (len(pairs) == best[0] and total < best[1]):
+            best = (len(pairs), total)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(12))
+def test_allocate_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n_rows, n_cols = rng.integers(1, 6), rng.integers(1, 5)
+    cost = rng.integers(0, 20, size=(n_rows, n_cols)).astype(float)
+    capacity = rng.integers(0, 3, size=n_cols)
+    forbidden = rng.random((n_rows, n_cols)) < 0.2
+
+    pairs = allocate(cost, capacity, forbidden)
+    assert [i for i, _ in pairs] == sorted({i for i, _ in pairs})
+    assert not any(forbidden[i, j] for i, j in pairs)
+    assert all(sum(1 for _, j in pairs if j == col) <= capacity[col] for col in range(n_cols))
+    assert (len(pairs), sum(cost[i, j] for i, j in pairs)) == brute_force_allocation(cost, capacity, forbidden)
+
+
+def test_allocate_donors_is_optimal(make_matchmaker, cohort):
+    donors, recipients = cohort
+    mm = make_matchmaker(donors=dict(list(donors.items())[:4]), recipients=dict(list(recipients.items())[:5]))
+    allocation = mm.allocate_donors(capacity={"D0": 2}, forbidden_pairs=[("R0", "D1")])
+
+    # the cost of a pair is its number of SAS filtered donor mismatches over all classes
+    costs = np.array([[sum(scores["updated_mismatches_count"] for scores in mm.difference_scoring[recipient_id][donor_id].values())
+                       for donor_id in mm.donors] for recipient_id in mm.recipients], dtype=float)
+    forbidden = np.zeros(costs.shape, dtype=bool)
+    forbidden[0, 1] = True
+    expected = brute_force_allocation(costs, np.array([2, 1, 1, 1]), forbidden)
+    assert (len(allocation["assignments"]), allocation["total_cost"]) == expected
+    for assignment in allocation["assignments"]:
+        i, j = list(mm.recipients).index(assignment["recipient_id"]), list(mm.donors).index(assignment["donor_id"])
+        assert assignment["cost"] == costs[i, j]
+
+
+def test_allocate_donors_without_donors(make_matchmaker):
+    mm = make_matchmaker(donors={})
+    allocation = mm.allocate_donors()
+    assert allocation == {"assignments": [], "unassigned": list(mm.recipients), "total_cost": 0.0}
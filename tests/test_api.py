@@ -0,0 +1,83 @@
+import importlib
+import json
+from collections import OrderedDict
+from functools import partialmethod
+
+import pandas as pd
+import pytest
+from fastapi.staticfiles import StaticFiles
+
+# project imports
+import database
+import utils.mismatch_engine as mismatch_engine
+
+"""
+Tests of the jobs of the API on the synthetic database: a lazy job never holds the mismatch details of more than
+DETAILS_CACHE_SIZE pairs, and its ranking only holds the counts of the pairs.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+# name of the consensus file of a class (see TinyDBDatabase.get_consensus_seq) -> a synthetic locus of the class
+CONSENSUS_FILES = {"I": "SLA-1", "DQA": "SLA-DQA", "DQB": "SLA-DQB1", "DRA": "SLA-DRA", "DRB": "SLA-DRB1"}
+
+
+class RecordingCache(OrderedDict):
+    """A details cache that records the number of materialized pairs and the largest number of them it held"""
+    materialized = 0
+    max_size = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.materialized += 1
+        self.max_size = max(self.max_size, len(self))
+
+
+@pytest.fixture(scope="module")
+def api(synthetic_db):
+    with pytest.MonkeyPatch.context() as mp:
+        # the frontend and the MHC database are not built here: serve no static files and open the synthetic database
+        mp.setattr(StaticFiles, "__init__", partialmethod(StaticFiles.__init__, check_dir=False))
+        mp.setitem(database._databases, "data/alleles_db.json", synthetic_db)
+        yield importlib.import_module("api")
+
+
+def test_lazy_job_keeps_only_scores(api, cohort, synthetic_alleles, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "results").mkdir()
+    # the alignment export reads the consensus sequences of the classes, any aligned sequence of the class will do
+    (tmp_path / "data" / "alignment").mkdir(parents=True)
+    for name, locus in CONSENSUS_FILES.items():
+        seq = next(allele["aligned_seq"] for allele in synthetic_alleles.values() if allele["locus"] == locus)
+        (tmp_path / "data" / "alignment" / f"consensus_{name}.fasta").write_text(f">consensus\n{seq}\n")
+    cache = RecordingCache()
+    monkeypatch.setattr(mismatch_engine, "_details_cache", cache)
+
+    donors, recipients = cohort
+    rows = [{"identifier": id, "type": type, "haplotype": str(haplotype)}
+            for type, entities in [("Donor", donors), ("Recipient", recipients)] for id, haplotype in entities.items()]
+    file = pd.DataFrame(rows).to_csv(index=False).encode("utf-8")
+    api.job_store["lazy"] = {"status": "queued"}
+    api.process_job(file, "csv", 0.25, None, True, "lazy")
+
+    job = api.job_store["lazy"]
+    assert job["status"] == "completed", job["result"]
+    assert cache.max_size <= mismatch_engine.DETAILS_CACHE_SIZE
+    # the results of a lazy job are built from the scores alone
+    assert cache.materialized == 0
+    ranking = job["result"]["ranking"]
+    assert set(ranking) == set(recipients)
+    for recipient_ranking in ranking.values():
+        for class_ranking in recipient_ranking["scores"].values():
+            assert len(class_ranking) == len(donors)
+            for donor_ranking in class_ranking:
+                assert "updated_mismatches" not in donor_ranking
+                assert all(not isinstance(value, (list, dict)) for value in donor_ranking.values())
+    with open("results/ranking_data.json") as f:
+        assert json.load(f) == ranking
+
+    # the details of a pair are still available on request
+    details = api.get_pair_details("lazy", next(iter(recipients)), next(iter(donors)))
+    assert all("updated_mismatches" in class_details for class_details in details.values())
+    del api.job_store["lazy"]
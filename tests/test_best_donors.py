@@ -0,0 +1,33 @@
+import random
+
+import pytest
+
+"""
+Tests of the top k donor query against the donors of a recipient ranked from the pairs scored one by one.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+@pytest.mark.parametrize("k", [1, 5, 50])
+def test_best_donors_match_brute_force(matchmaker, brute_force_scores, k):
+    classes = list(next(iter(matchmaker.donors.values()))["classified"].keys())
+    known_eplets = matchmaker.check_known_eplets()
+    rng = random.Random(k)
+    for recipient_id in matchmaker.recipients:
+        weights = {clas: rng.choice([0, 0.5, 1, 2]) for clas in classes}
+        expected = brute_force_scores(matchmaker, recipient_id, weights)[:k]
+        top = matchmaker.best_donors(recipient_id, k, weights, matchmaker.rsa_threshold)
+        assert [(t["donor_id"], t["score"]) for t in top] == [(donor_id, score) for score, _, donor_id in expected]
+        # the detail of the weighted classes
+        for t in top:
+            pair_scores = matchmaker.difference_scoring[recipient_id][t["donor_id"]]
+            pair_eplets = known_eplets[recipient_id][t["donor_id"]]
+            assert t["scores"] == {clas: pair_scores[clas] for clas, weight in weights.items() if weight != 0}
+            assert t["eplets"] == {clas: eplets for clas, eplets in pair_eplets.items() if weights[clas] != 0}
+
+
+def test_best_donors_without_donors(make_matchmaker):
+    mm = make_matchmaker(donors={})
+    assert mm.best_donors(next(iter(mm.recipients)), 5) == []
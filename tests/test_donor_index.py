@@ -0,0 +1,22 @@
+import random
+
+import pytest
+
+"""
+Tests of the exact nearest donor index against the donors of a recipient ranked from the pairs scored one by one.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+@pytest.mark.parametrize("k", [1, 5, 50])
+def test_donor_index_matches_brute_force(matchmaker, brute_force_scores, k):
+    classes = list(next(iter(matchmaker.donors.values()))["classified"].keys())
+    matchmaker.build_donor_index(matchmaker.rsa_threshold, n_pivots=4)
+    rng = random.Random(k)
+    for recipient_id in matchmaker.recipients:
+        weights = {clas: rng.choice([0, 0.5, 1, 2]) for clas in classes}
+        expected = [(donor_id, score) for score, _, donor_id in brute_force_scores(matchmaker, recipient_id, weights)[:k]]
+        top = matchmaker.nearest_donors(recipient_id, k, weights, matchmaker.rsa_threshold)
+        assert [(t["donor_id"], t["score"]) for t in top] == expected, recipient_id
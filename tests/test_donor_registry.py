@@ -0,0 +1,49 @@
+import numpy as np
+
+# project imports
+from database import TinyDBDatabase
+from donor_registry import DonorRegistry
+from benchmarks.synthetic import write_tinydb
+
+"""
+Tests of the persistent donor registry: recipients matched against the registry get the scores of a matchmaker
+that processed the donors and recipients together, also after the registry is reopened, changed or its database changed.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def assert_same_scores(registry, matchmaker, recipients, tmp_path):
+    matched = registry.match(recipients, rsa_threshold=matchmaker.rsa_threshold, output_path=str(tmp_path / "match") + "/")
+    expected = matchmaker.calc_score_matrix(matchmaker.rsa_threshold)
+    assert matched.score_matrix["donors"] == expected["donors"]
+    assert matched.score_matrix["recipients"] == expected["recipients"]
+    for clas, scores in expected["classes"].items():
+        for key, matrix in scores.items():
+            assert np.array_equal(matched.score_matrix["classes"][clas][key], matrix), (clas, key)
+    for recipient_id in recipients:
+        assert matched.best_donors(recipient_id, 3) == matchmaker.best_donors(recipient_id, 3)
+
+
+def test_registry_matches_matchmaker(make_matchmaker, synthetic_db, synthetic_alleles, cohort, tmp_path):
+    donors, recipients = cohort
+    path = str(tmp_path / "registry")
+    registry = DonorRegistry(path, db=synthetic_db)
+    registry.add_donors(donors)
+    assert_same_scores(registry, make_matchmaker(), recipients, tmp_path)
+
+    # reopened from disk, after removing some donors
+    removed = list(donors)[::3]
+    registry.remove_donors(removed)
+    reopened = DonorRegistry(path, db=synthetic_db)
+    assert list(reopened.donors) == [donor_id for donor_id in donors if donor_id not in removed]
+    kept = {donor_id: haplotype for donor_id, haplotype in donors.items() if donor_id not in removed}
+    assert_same_scores(reopened, make_matchmaker(donors=kept), recipients, tmp_path)
+
+    # another version of the database: the donors are processed again on load
+    other_db = TinyDBDatabase(write_tinydb(synthetic_alleles, str(tmp_path / "other_db" / "alleles_db.json")))
+    assert other_db.version != synthetic_db.version
+    reprocessed = DonorRegistry(path, db=other_db)
+    assert list(reprocessed.donors) == list(kept)
+    assert_same_scores(reprocessed, make_matchmaker(donors=kept), recipients, tmp_path)
@@ -0,0 +1,48 @@
+"""
+Tests of the eplet bitsets and the batched eplet mismatch loads against the eplets of the alleles checked one by one.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def haplotype_eplets(mm, id: str, clas: str, table) -> set:
+    """The known eplets of the alleles of a haplotype, checked on the aligned sequences"""
+    entity = mm.donors[id] if id in mm.donors else mm.recipients[id]
+    return {eplet_id for allele in entity["classified"][clas] for eplet_id in table.ids
+            if mm.has_eplet(mm.local_db[allele].aligned_seq, table.eplets[eplet_id])}
+
+
+def test_eplet_mismatches_match_alleles(matchmaker, eplet_registry):
+    found = 0
+    for clas in matchmaker.get_relevant_classes():
+        table = eplet_registry.get(clas)
+        if table is None:
+            continue
+        for recipient_id in matchmaker.recipients:
+            recip_eplets = haplotype_eplets(matchmaker, recipient_id, clas, table)
+            for donor_id in matchmaker.donors:
+                donor_eplets = haplotype_eplets(matchmaker, donor_id, clas, table)
+                mismatches = matchmaker.eplet_mismatches(donor_id, recipient_id, clas)
+                assert set(mismatches["donor_eplets"]) == donor_eplets - recip_eplets, (recipient_id, donor_id, clas)
+                assert set(mismatches["recip_eplets"]) == recip_eplets - donor_eplets, (recipient_id, donor_id, clas)
+                found += len(mismatches["donor_eplets"])
+    # the synthetic eplets are found on some of the haplotypes
+    assert found > 0
+
+
+def test_eplet_mismatch_matrix_matches_pairs(matchmaker):
+    matrix = matchmaker.calc_eplet_mismatch_matrix()
+    assert matrix["classes"]
+    for clas, loads in matrix["classes"].items():
+        for i, recipient_id in enumerate(matrix["recipients"]):
+            for j, donor_id in enumerate(matrix["donors"]):
+                mismatches = matchmaker.eplet_mismatches(donor_id, recipient_id, clas)
+                assert loads["donor_eplet_load"][i, j] == len(mismatches["donor_eplets"])
+                assert loads["recip_eplet_load"][i, j] == len(mismatches["recip_eplets"])
+
+
+def test_eplet_mismatch_matrix_without_donors(make_matchmaker):
+    mm = make_matchmaker(donors={}, stages=False)
+    matrix = mm.calc_eplet_mismatch_matrix()
+    assert matrix["donors"] == [] and matrix["classes"] == {}
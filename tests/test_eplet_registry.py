@@ -0,0 +1,45 @@
+import json
+
+# project imports
+from utils.eplet_registry import EpletRegistry, create_eplet_dict
+
+"""
+Tests of the eplet registry: every eplet file is loaded once, with the lookup tables check_known_eplets used to
+rebuild per pair, and loaded again after clear().
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_tables_are_loaded_once(eplet_registry, eplet_paths):
+    table = eplet_registry.get("I")
+    assert eplet_registry.get("I") is table
+    # the DQA and DQB alleles share the DQ eplets, there are no DRA eplets
+    assert eplet_registry.get("IIDQA") is eplet_registry.get("IIDQB")
+    assert eplet_registry.get("IIDRA") is None
+
+    with open(eplet_paths["I"], "r") as f:
+        eplets = json.load(f)
+    assert table.eplets == eplets
+    assert table.positions == create_eplet_dict(eplets)
+    for eplet_id, eplet_data in eplets.items():
+        positions = [int(pos) for pos in eplet_data]
+        assert table.spans[eplet_id] == (min(positions), max(positions))
+
+
+def test_clear_reloads_the_files(tmp_path, eplet_paths):
+    path = tmp_path / "eplets_I.json"
+    path.write_text(json.dumps({"1A": {"1": "A"}}))
+    registry = EpletRegistry({**eplet_paths, "I": str(path)})
+    assert registry.get("I").ids == ["1A"]
+
+    path.write_text(json.dumps({"2C": {"2": "C"}}))
+    assert registry.get("I").ids == ["1A"]
+    registry.clear()
+    assert registry.get("I").ids == ["2C"]
+
+
+def test_database_eplet_dict_is_the_registry_table(synthetic_db, eplet_registry):
+    assert synthetic_db.get_eplet_dict("IIDRB") is eplet_registry.get("IIDRB").eplets
+    assert synthetic_db.get_eplet_dict("IIDRA") is None
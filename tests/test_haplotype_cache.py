@@ -0,0 +1,53 @@
+import numpy as np
+
+# project imports
+from utils.haplotype_cache import HaplotypeCache, haplotype_key
+
+"""
+Tests of the haplotype cache: the grouped sequences, bitmasks and SAS averages of cached haplotypes are those of
+a matchmaker without cache, and identical haplotypes are computed once.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_cached_haplotypes_match_uncached(make_matchmaker):
+    cache = HaplotypeCache()
+    cached = make_matchmaker(haplotype_cache=cache, stages=False)
+    cached.average_sas_scores()
+    uncached = make_matchmaker(haplotype_cache=HaplotypeCache(maxsize=0), stages=False)
+    uncached.average_sas_scores()
+
+    for id, entity in {**cached.donors, **cached.recipients}.items():
+        other = uncached.donors.get(id) or uncached.recipients[id]
+        assert entity["haplotypeClassGrouped"] == other["haplotypeClassGrouped"], id
+        for clas, haplotype in entity["classified"].items():
+            assert entity["haplotypeClassGrouped"][clas] == cached.group_haplotype(haplotype), (id, clas)
+            assert np.array_equal(cached.grouped_mask(id, clas), uncached.grouped_mask(id, clas)), (id, clas)
+    assert cached.sas_scores == uncached.sas_scores
+
+    # the cohort shares haplotypes: every distinct haplotype of a class is grouped and averaged once
+    entities = list(cached.donors.values()) + list(cached.recipients.values())
+    distinct = {(clas, tuple(haplotype)) for entity in entities for clas, haplotype in entity["classified"].items()}
+    stats = cache.stats()
+    assert stats["size"] == len(distinct)
+    assert stats["misses"]["grouped"] == stats["misses"]["sas"] == len(distinct)
+    assert stats["hits"]["grouped"] == len(entities) * len(entities[0]["classified"]) - len(distinct)
+
+
+def test_keys_of_other_database_versions_miss():
+    cache = HaplotypeCache()
+    assert cache.lookup(haplotype_key("v1", "I", ["A", "B"]), "grouped", lambda: "v1") == "v1"
+    assert cache.lookup(haplotype_key("v1", "I", ["A", "B"]), "grouped", lambda: "other") == "v1"
+    assert cache.lookup(haplotype_key("v2", "I", ["A", "B"]), "grouped", lambda: "v2") == "v2"
+    # the order of the alleles is part of the key
+    assert cache.lookup(haplotype_key("v1", "I", ["B", "A"]), "grouped", lambda: "BA") == "BA"
+
+
+def test_cache_is_bounded():
+    cache = HaplotypeCache(maxsize=2)
+    for name in ["A", "B", "C"]:
+        cache.lookup(haplotype_key("v1", "I", [name]), "grouped", lambda: name)
+    assert len(cache) == 2
+    assert cache.lookup(haplotype_key("v1", "I", ["A"]), "grouped", lambda: "recomputed") == "recomputed"
@@ -0,0 +1,42 @@
+# project imports
+from utils.pair_cache import PairCache
+
+"""
+Tests of the streaming pair results against the stages of perform_matching, and of their memory use:
+streamed pairs are not kept, in the matchmaker or in the pair cache.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_iter_pairs_matches_stages(make_matchmaker):
+    serial = make_matchmaker(rsa_threshold=0.25)
+    serial_eplets = serial.check_known_eplets()
+
+    cache = PairCache()
+    streaming = make_matchmaker(pair_cache=cache, stages=False)
+    streaming.average_sas_scores()
+    pairs = list(streaming.iter_pairs(rsa_threshold=0.25))
+    assert [(pair["recipient_id"], pair["donor_id"]) for pair in pairs] == \
+        [(recipient_id, donor_id) for recipient_id in serial.recipients for donor_id in serial.donors]
+    for pair in pairs:
+        assert pair["scores"] == serial.difference_scoring[pair["recipient_id"]][pair["donor_id"]]
+        assert pair["eplets"] == serial_eplets[pair["recipient_id"]][pair["donor_id"]]
+
+    assert streaming.difference_scoring == {} and streaming.known_eplets == {}
+    assert len(cache) == 0
+
+
+def test_iter_pairs_uses_cached_pairs(make_matchmaker, tmp_path):
+    cache = PairCache(cache_dir=str(tmp_path / "pair_cache"))
+    make_matchmaker(pair_cache=cache, rsa_threshold=0.25).check_known_eplets()
+    size, files = len(cache), cache.stats()["disk_files"]
+
+    streaming = make_matchmaker(pair_cache=cache, stages=False)
+    streaming.average_sas_scores()
+    for _ in streaming.iter_pairs(rsa_threshold=0.25):
+        pass
+    stats = cache.stats()
+    assert stats["hits"]["difference"] > 0
+    assert len(cache) == size and stats["disk_files"] == files
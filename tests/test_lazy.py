@@ -0,0 +1,91 @@
+import pytest
+
+# project imports
+from utils.allele_store import SasAverages
+from utils.data_exporter import generate_ranking_data
+from utils.mismatch_engine import iter_mismatches
+
+"""
+Tests of the lazy per pair mismatch details against the eagerly computed difference scoring.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_lazy_matches_eager(matchmaker, make_matchmaker):
+    lazy = make_matchmaker(lazy=True)
+    assert lazy.compact_scoring() == matchmaker.compact_scoring()
+    for recipient_id in matchmaker.recipients:
+        for donor_id in matchmaker.donors:
+            assert lazy.pair_details(recipient_id, donor_id) == matchmaker.pair_details(recipient_id, donor_id), \
+                (recipient_id, donor_id)
+
+
+def test_lazy_filter_is_kept_for_added_donors(make_matchmaker, cohort):
+    donors, _ = cohort
+    added = dict(list(donors.items())[:2])
+    lazy = make_matchmaker(donors=dict(list(donors.items())[2:]), lazy=True, stages=False)
+    lazy.calcMHCDifference()
+    lazy.average_sas_scores()
+    # called directly instead of through filter_by_sas
+    lazy.filter_lazy_by_sas(0.25)
+    lazy.add_donors(added)
+
+    eager = make_matchmaker(rsa_threshold=0.25)
+    for recipient_id in lazy.recipients:
+        for donor_id in added:
+            details = lazy.pair_details(recipient_id, donor_id)
+            assert all("updated_mismatches" in class_details for class_details in details.values())
+            assert details == eager.pair_details(recipient_id, donor_id), (recipient_id, donor_id)
+
+
+def test_lazy_without_donors(make_matchmaker):
+    lazy = make_matchmaker(donors={}, lazy=True)
+    assert lazy.difference_scoring == {recipient_id: {} for recipient_id in lazy.recipients}
+
+
+def test_compact_ranking_matches_eager(matchmaker, make_matchmaker):
+    lazy = make_matchmaker(lazy=True)
+    expected = generate_ranking_data(matchmaker.donors, matchmaker.recipients, matchmaker.difference_scoring)
+    for recipient_ranking in expected.values():
+        for class_ranking in recipient_ranking["scores"].values():
+            for donor_ranking in class_ranking:
+                del donor_ranking["updated_mismatches"]
+    assert generate_ranking_data(lazy.donors, lazy.recipients, lazy.compact_scoring(), compact=True) == expected
+
+
+def truncate_sas_averages(mm, length):
+    """Keep the average SAS scores of the first length positions only, as if the other positions had no scores"""
+    for id, class_arrays in mm.sas_arrays.items():
+        for clas, averages in class_arrays.items():
+            class_arrays[clas] = SasAverages(rsa=averages.rsa[:length], asa=averages.asa[:length], total=averages.total[:length])
+            mm.sas_scores[id][clas] = class_arrays[clas].to_dict()
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_mismatches_past_sas_averages_are_kept(make_matchmaker, sparse):
+    length = 20
+    results = []
+    for lazy in [False, True]:
+        mm = make_matchmaker(lazy=lazy, sparse=sparse, stages=False)
+        mm.calcMHCDifference()
+        mm.average_sas_scores()
+        truncate_sas_averages(mm, length)
+        mm.filter_by_sas(1.0)
+        results.append(mm)
+    eager, lazy = results
+
+    assert lazy.compact_scoring() == eager.compact_scoring()
+    kept_past = 0
+    for recipient_id in eager.recipients:
+        for donor_id in eager.donors:
+            details = eager.pair_details(recipient_id, donor_id)
+            assert lazy.pair_details(recipient_id, donor_id) == details, (recipient_id, donor_id)
+            for class_details in details.values():
+                mismatches = dict(iter_mismatches(class_details["donor_diff"]))
+                updated = dict(iter_mismatches(class_details["updated_mismatches"]))
+                # no average RSA reaches 1.0, so only the mismatches past the averages are kept
+                assert updated == {pos: value for pos, value in mismatches.items() if pos >= length}
+                kept_past += len(updated)
+    assert kept_past > 0
@@ -0,0 +1,13 @@
+# project imports
+from benchmarks.bench_mismatch_engine import random_pairs, check_equivalence
+
+"""
+Equivalence test of the bitmask mismatch engine against the python (set based) engine, on random grouped haplotypes.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_bitmask_engine_matches_python_engine():
+    assert check_equivalence(random_pairs(300, seed=1)) == 300
@@ -0,0 +1,61 @@
+import json
+
+# project imports
+from utils import pair_cache
+from utils.eplet_registry import EpletRegistry
+from utils.pair_cache import PairCache, get_pair_cache
+
+"""
+Tests of the pair cache: cached pair results are those of a matchmaker without cache, and the cached known eplets
+are not served after the eplet files change, in memory and on disk.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_cached_pairs_match_uncached(make_matchmaker):
+    cache = PairCache()
+    cached = make_matchmaker(pair_cache=cache)
+    uncached = make_matchmaker(pair_cache=PairCache(maxsize=0))
+    assert cached.difference_scoring == uncached.difference_scoring
+    assert cached.check_known_eplets() == uncached.check_known_eplets()
+    # the cohort shares haplotypes, so some pairs of haplotypes are compared once for several pairs
+    stats = cache.stats()
+    assert stats["hits"]["difference"] > 0 and stats["hits"]["eplets"] > 0
+
+
+def test_eplet_changes_are_not_served_from_the_cache(monkeypatch, make_matchmaker, eplet_paths, tmp_path):
+    paths = {}
+    for clas, path in eplet_paths.items():
+        paths[clas] = str(tmp_path / f"eplets_{clas}.json")
+        with open(path, "r") as f, open(paths[clas], "w") as out:
+            out.write(f.read())
+    registry = EpletRegistry(paths)
+    monkeypatch.setattr("utils.eplet_registry._registry", registry)
+
+    cache_dir = str(tmp_path / "pair_cache")
+    mm = make_matchmaker(pair_cache=PairCache(cache_dir=cache_dir))
+    before = mm.check_known_eplets()
+
+    # keep half of the eplets of every class
+    for path in paths.values():
+        with open(path, "r") as f:
+            eplets = json.load(f)
+        with open(path, "w") as f:
+            json.dump(dict(list(eplets.items())[::2]), f)
+    registry.clear()
+
+    expected = make_matchmaker(pair_cache=PairCache(maxsize=0)).check_known_eplets()
+    assert expected != before
+    assert mm.check_known_eplets() == expected
+    # a restarted worker with the same disk tier
+    assert make_matchmaker(pair_cache=PairCache(cache_dir=cache_dir)).check_known_eplets() == expected
+
+
+def test_shared_cache_size(monkeypatch):
+    monkeypatch.setattr(pair_cache, "_cache", None)
+    monkeypatch.delenv(pair_cache.CACHE_DIR_ENV, raising=False)
+    monkeypatch.setenv(pair_cache.CACHE_SIZE_ENV, "7")
+    assert get_pair_cache().maxsize == 7
+    assert PairCache().maxsize == 500
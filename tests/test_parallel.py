@@ -0,0 +1,44 @@
+import pickle
+
+import numpy as np
+
+# project imports
+from utils.allele_store import AlleleStore
+
+"""
+Tests of the pairwise stages in worker processes against the same stages run in the main process,
+and of the allele store shipped to the workers.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_workers_match_serial(make_matchmaker):
+    serial = make_matchmaker(rsa_threshold=0.25)
+    serial_eplets = serial.check_known_eplets()
+
+    parallel = make_matchmaker(workers=2, stages=False)
+    parallel.average_sas_scores()
+    difference_scoring, known_eplets = parallel.match_pairs_parallel(rsa_threshold=0.25)
+    assert list(difference_scoring) == list(serial.difference_scoring)
+    assert difference_scoring == serial.difference_scoring
+    assert known_eplets == serial_eplets
+    assert parallel.rsa_threshold == 0.25
+
+
+def test_pickled_allele_store_after_append(synthetic_alleles):
+    ids = list(synthetic_alleles)
+    store = AlleleStore.from_alleles({allele: synthetic_alleles[allele] for allele in ids[:50]})
+    store.add_alleles({allele: synthetic_alleles[allele] for allele in ids[50:]})
+    shipped = pickle.loads(pickle.dumps(store))
+
+    expected = AlleleStore.from_alleles(synthetic_alleles)
+    for clas, class_store in expected.classes.items():
+        # the spare rows of the grown matrices are not shipped
+        assert shipped[clas]._buffers is None
+        assert sorted(shipped[clas].ids) == sorted(class_store.ids)
+        for allele in class_store.ids:
+            assert shipped[clas].aligned_seq(allele) == class_store.aligned_seq(allele)
+            row, expected_row = shipped[clas].index[allele], class_store.index[allele]
+            assert np.array_equal(shipped[clas].rsa[row], class_store.rsa[expected_row], equal_nan=True)
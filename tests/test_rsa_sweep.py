@@ -0,0 +1,29 @@
+# project imports
+from utils.mismatch_engine import FILTERED_COUNT_KEYS
+
+"""
+Tests of the multi-threshold RSA sweep against filter_by_sas run once per threshold.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_sweep_matches_filter_by_sas(make_matchmaker):
+    mm = make_matchmaker(lazy=True)
+    # unsorted, with a duplicate and the extremes
+    thresholds = [0.5, 0.0, 0.25, 0.25, 1.0, 0.1]
+    sweep = mm.filter_by_sas_sweep(thresholds)
+    assert sweep["thresholds"] == thresholds
+
+    eager = make_matchmaker(stages=False)
+    eager.calcMHCDifference()
+    eager.average_sas_scores()
+    for t, threshold in enumerate(thresholds):
+        eager.filter_by_sas(threshold)
+        for recipient_id, donors in eager.difference_scoring.items():
+            for donor_id, classes in donors.items():
+                for clas, pair_scores in classes.items():
+                    for key in FILTERED_COUNT_KEYS:
+                        assert sweep["counts"][recipient_id][donor_id][clas][key][t] == pair_scores[key], \
+                            (threshold, recipient_id, donor_id, clas, key)
@@ -0,0 +1,39 @@
+import pytest
+
+"""
+Tests of the vectorized SAS averages against the per position averages of the aligned RSA/ASA values.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def reference_averages(mm, haplotype) -> dict:
+    """The per position averages of the alleles, summed allele by allele, skipping the gaps"""
+    sums = {}
+    for allele in haplotype:
+        allele_data = mm.local_db[allele]
+        for i, (r, a) in enumerate(zip(allele_data.aligned_rsa, allele_data.aligned_asa)):
+            position = sums.setdefault(i, {"rsa": 0, "asa": 0, "total": 0})
+            if r is not None and a is not None:
+                position["rsa"] += r
+                position["asa"] += a
+                position["total"] += 1
+    return {i: {"rsa": s["rsa"] / s["total"] if s["total"] else None,
+                "asa": s["asa"] / s["total"] if s["total"] else None,
+                "total": s["total"]} for i, s in sums.items()}
+
+
+def test_averages_match_reference(matchmaker):
+    for id, entity in {**matchmaker.donors, **matchmaker.recipients}.items():
+        for clas, haplotype in entity["classified"].items():
+            expected = reference_averages(matchmaker, haplotype)
+            averages = matchmaker.sas_scores[id][clas]
+            assert averages.keys() == expected.keys(), (id, clas)
+            for i, position in expected.items():
+                assert averages[i]["total"] == position["total"], (id, clas, i)
+                for key in ["rsa", "asa"]:
+                    if position[key] is None:
+                        assert averages[i][key] is None, (id, clas, i, key)
+                    else:
+                        assert averages[i][key] == pytest.approx(position[key], rel=1e-12), (id, clas, i, key)
@@ -0,0 +1,26 @@
+# project imports
+from utils.mismatch_engine import SCORE_KEYS, FILTERED_COUNT_KEYS
+
+"""
+Tests of the batched donor x recipient score matrix against the pairs scored one by one.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def test_score_matrix_matches_pairs(matchmaker):
+    matrix = matchmaker.calc_score_matrix(matchmaker.rsa_threshold)
+    for i, recipient_id in enumerate(matrix["recipients"]):
+        for j, donor_id in enumerate(matrix["donors"]):
+            for clas, scores in matrix["classes"].items():
+                pair_scores = matchmaker.difference_scoring[recipient_id][donor_id][clas]
+                for key in SCORE_KEYS + FILTERED_COUNT_KEYS:
+                    assert scores[key][i, j] == pair_scores[key], (recipient_id, donor_id, clas, key)
+
+
+def test_score_matrix_without_donors(make_matchmaker):
+    mm = make_matchmaker(donors={})
+    matrix = mm.calc_score_matrix(mm.rsa_threshold)
+    assert matrix["donors"] == [] and matrix["recipients"] == list(mm.recipients)
+    assert matrix["classes"] == {}
@@ -0,0 +1,48 @@
+import pytest
+
+"""
+Tests of the incremental matching session: after adding and removing donors and recipients, the results are those
+of a matchmaker that processed the final donors and recipients from scratch.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_add_remove_matches_recompute(make_matchmaker, cohort, lazy):
+    donors, recipients = cohort
+    donor_ids, recipient_ids = list(donors), list(recipients)
+    session = make_matchmaker(donors={id: donors[id] for id in donor_ids[:12]},
+                              recipients={id: recipients[id] for id in recipient_ids[:3]}, lazy=lazy)
+    session.check_known_eplets()
+
+    session.add_donors({id: donors[id] for id in donor_ids[12:]})
+    session.add_recipients({id: recipients[id] for id in recipient_ids[3:]})
+    removed = donor_ids[::5] + recipient_ids[1:2]
+    session.remove(removed)
+
+    final_donors = {id: donors[id] for id in donor_ids if id not in removed}
+    final_recipients = {id: recipients[id] for id in recipient_ids if id not in removed}
+    full = make_matchmaker(donors=final_donors, recipients=final_recipients, lazy=lazy)
+    assert list(session.donors) == list(full.donors) and list(session.recipients) == list(full.recipients)
+    assert session.compact_scoring() == full.compact_scoring()
+    for recipient_id in full.recipients:
+        for donor_id in full.donors:
+            assert session.pair_details(recipient_id, donor_id) == full.pair_details(recipient_id, donor_id), \
+                (recipient_id, donor_id)
+    assert session.known_eplets == full.check_known_eplets()
+    assert session.sas_scores == full.sas_scores
+
+
+def test_session_without_donors(make_matchmaker, cohort):
+    session = make_matchmaker()
+    session.remove(list(session.donors))
+    assert session.difference_scoring == {recipient_id: {} for recipient_id in session.recipients}
+    assert session.allocate_donors()["unassigned"] == list(session.recipients)
+    assert session.calc_eplet_mismatch_matrix()["classes"] == {}
+
+    # and back
+    donors, _ = cohort
+    session.add_donors(donors)
+    assert session.compact_scoring() == make_matchmaker().compact_scoring()
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+
+# project imports
+from database import TinyDBDatabase, SnapshotDatabase, compile_snapshot, is_snapshot_fresh
+from benchmarks.synthetic import make_alleles, write_tinydb
+
+"""
+Tests of the binary snapshot of the allele database: a snapshot returns the documents of the JSON database,
+and a handle that is open while the snapshot is recompiled keeps reading the snapshot it was opened on.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def assert_same_store(store, expected):
+    for clas, class_store in expected.classes.items():
+        assert store.classes[clas].ids == class_store.ids, clas
+        assert np.array_equal(store.classes[clas].seqs, class_store.seqs), clas
+
+
+def test_snapshot_matches_json_database(tmp_path):
+    db_path = write_tinydb(make_alleles(100, seed=0), str(tmp_path / "alleles_db.json"))
+    snapshot_path = compile_snapshot(db_path)
+    assert is_snapshot_fresh(snapshot_path, db_path)
+
+    json_db, snap_db = TinyDBDatabase(db_path=db_path), SnapshotDatabase(snapshot_path, db_path=db_path)
+    assert snap_db.get_all_ids() == json_db.get_all_ids()
+    for allele_id in json_db.get_all_ids():
+        assert snap_db.find_dict(allele_id) == json_db.find_dict(allele_id)
+    assert_same_store(snap_db.get_allele_store(), json_db.get_allele_store())
+
+
+def test_open_snapshot_survives_recompile(tmp_path):
+    alleles = make_alleles(100, seed=0)
+    db_path = write_tinydb(alleles, str(tmp_path / "alleles_db.json"))
+    snapshot_path = compile_snapshot(db_path)
+    old = SnapshotDatabase(snapshot_path, db_path=db_path)
+    expected = {allele_id: TinyDBDatabase(db_path=db_path).find_dict(allele_id) for allele_id in alleles}
+    expected_store = TinyDBDatabase(db_path=db_path).get_allele_store()
+
+    # new alleles in front of the old ones shift every row of the recompiled snapshot
+    new_alleles = {f"NEW{allele_id}": {**doc, "accession": f"NEW{doc['accession']}"} for allele_id, doc in alleles.items()}
+    write_tinydb({**new_alleles, **alleles}, db_path)
+    compile_snapshot(db_path)
+    assert len(os.listdir(snapshot_path)) == 2  # manifest.json and the new version directory
+
+    for allele_id, doc in expected.items():
+        assert old.find_dict(allele_id) == doc
+    # the class arrays of the old handle were not loaded before the recompile
+    assert_same_store(old.get_allele_store(), expected_store)
+
+    new = SnapshotDatabase(snapshot_path, db_path=db_path)
+    assert new.version != old.version
+    assert len(new.get_all_ids()) == 2 * len(alleles)
+    assert new.find_dict(f"NEW{next(iter(alleles))}")["accession"].startswith("NEW")
@@ -0,0 +1,22 @@
+import pytest
+
+# project imports
+from utils.mismatch_engine import dense_class_difference
+
+"""
+Tests of the sparse mismatch representation against the dense (legacy) difference scoring.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_sparse_matches_dense(matchmaker, make_matchmaker, lazy):
+    sparse = make_matchmaker(sparse=True, lazy=lazy)
+    assert sparse.compact_scoring() == matchmaker.compact_scoring()
+    for recipient_id in matchmaker.recipients:
+        for donor_id in matchmaker.donors:
+            details = sparse.pair_details(recipient_id, donor_id)
+            assert {clas: dense_class_difference(result) for clas, result in details.items()} == \
+                matchmaker.pair_details(recipient_id, donor_id), (recipient_id, donor_id)
@@ -0,0 +1,29 @@
+# project imports
+from database import TinyDBDatabase
+from utils import epletMatching
+from benchmarks.synthetic import write_tinydb
+
+"""
+Tests of the bulk rebuild of the eplet presence of the database against the per allele update.
+
+Usage (from the repository root):
+    python -m pytest tests
+"""
+
+
+def rebuilt_eplets(monkeypatch, alleles, db_path: str, bulk: bool) -> dict:
+    """The eplets of every allele of the database file after update_eplets_db, read back from the file"""
+    db = TinyDBDatabase(write_tinydb(alleles, db_path))
+    monkeypatch.setattr(epletMatching, "get_database", lambda: db)
+    epletMatching.update_eplets_db(bulk=bulk)
+    db.db.storage.flush()
+    reopened = TinyDBDatabase(db_path)
+    # the per allele update leaves the alleles without eplets as they were, the bulk update writes []
+    return {allele_id: reopened.find_dict(allele_id)["eplets"] or [] for allele_id in reopened.get_all_ids()}
+
+
+def test_bulk_update_matches_per_allele_update(monkeypatch, tmp_path, synthetic_alleles):
+    per_allele = rebuilt_eplets(monkeypatch, synthetic_alleles, str(tmp_path / "per_allele" / "alleles_db.json"), bulk=False)
+    bulk = rebuilt_eplets(monkeypatch, synthetic_alleles, str(tmp_path / "bulk" / "alleles_db.json"), bulk=True)
+    assert bulk == per_allele
+    assert any(per_allele.values())
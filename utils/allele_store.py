@@ -0,0 +1,286 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains a columnar store of the aligned allele data.
+For every class the aligned sequences are kept in a uint8 matrix (one row per allele)
+and the aligned RSA/ASA values in float matrices with NaN for gaps.
+Alleles can be added to a store, the rows of the alleles already in it never change.
+"""
+
+CLASSES = ["I", "IIDQA", "IIDQB", "IIDRA", "IIDRB"]
+
+# padding value of the residue matrix beyond the end of an aligned sequence
+PAD = 0
+
+
+def class_key(allele_class: str, locus: Optional[str]) -> Optional[str]:
+    """
+    Map the allele_class and locus attributes of an allele to one of the CLASSES.
+
+    Returns:
+        The class key, or None if the allele cannot be classified
+    """
+    if allele_class == "I":
+        return "I"
+    if allele_class == "II" and locus:
+        for loc in ["DQA", "DQB", "DRA", "DRB"]:
+            if loc in locus:
+                return "II" + loc
+    return None
+
+
+def _get(allele, attribute):
+    """Read an attribute from an Allele dataclass or from a database document"""
+    if isinstance(allele, dict):
+        return allele.get(attribute)
+    return getattr(allele, attribute)
+
+
+def _per_class(alleles: Dict[str, object]) -> Dict[str, Dict[str, object]]:
+    """Split {allele_id: allele} by class, leaving out missing alleles and alleles that cannot be classified"""
+    per_class = {clas: {} for clas in CLASSES}
+    for allele_id, allele in alleles.items():
+        if allele is None:
+            continue
+        clas = class_key(_get(allele, "allele_class"), _get(allele, "locus"))
+        if clas is None:
+            logger.warning(f"{allele_id} could not be classified, left out of the allele store")
+            continue
+        per_class[clas][allele_id] = allele
+    return per_class
+
+
+@dataclass
+class ClassStore:
+    """
+    Columnar data of all the alleles of one class.
+
+    Attributes:
+        allele_class (str): The class of the alleles, one of CLASSES
+        ids (List[str]): Allele IDs, in row order
+        index (Dict[str, int]): Allele ID -> row
+        seqs (np.ndarray): (n_alleles, width) uint8 matrix of the aligned residues (ASCII codes), padded with PAD
+        lengths (np.ndarray): (n_alleles,) length of every aligned sequence
+        rsa (np.ndarray): (n_alleles, width) aligned RSA values, NaN for gaps
+        asa (np.ndarray): (n_alleles, width) aligned ASA values, NaN for gaps
+        sas_lengths (np.ndarray): (n_alleles,) number of aligned RSA/ASA values, -1 if they are missing
+    """
+    allele_class: str
+    ids: List[str]
+    seqs: np.ndarray
+    lengths: np.ndarray
+    rsa: np.ndarray
+    asa: np.ndarray
+    sas_lengths: np.ndarray
+    index: Dict[str, int] = field(default_factory=dict)
+    # (seqs, lengths, rsa, asa, sas_lengths) with spare rows, the attributes are views of their first rows
+    _buffers: Optional[tuple] = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if not self.index:
+            self.index = {allele_id: row for row, allele_id in enumerate(self.ids)}
+
+    @classmethod
+    def from_alleles(cls, allele_class: str, alleles: Dict[str, object], sas_dtype=np.float32) -> "ClassStore":
+        """
+        Build the store of one class.
+
+        Parameters:
+            allele_class (str): The class of the alleles
+            alleles (Dict[str, object]): {allele_id: Allele or database document}, all of allele_class
+            sas_dtype: dtype of the RSA/ASA matrices
+        """
+        ids = list(alleles.keys())
+        aligned_seqs = [_get(alleles[a], "aligned_seq") or "" for a in ids]
+        aligned_sas = [(_get(alleles[a], "aligned_rsa"), _get(alleles[a], "aligned_asa")) for a in ids]
+
+        lengths = np.array([len(s) for s in aligned_seqs], dtype=np.int32)
+        # the scores are used pairwise, so only the positions where both are defined count
+        sas_lengths = np.array([-1 if r is None or a is None else min(len(r), len(a)) for r, a in aligned_sas],
+                               dtype=np.int32)
+        width = int(max(lengths.max(), sas_lengths.max())) if len(ids) else 0
+
+        seqs = np.full((len(ids), width), PAD, dtype=np.uint8)
+        rsa = np.full((len(ids), width), np.nan, dtype=sas_dtype)
+        asa = np.full((len(ids), width), np.nan, dtype=sas_dtype)
+        for row, (seq, (aligned_rsa, aligned_asa)) in enumerate(zip(aligned_seqs, aligned_sas)):
+            seqs[row, :len(seq)] = np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+            n = sas_lengths[row]
+            if n > 0:
+                rsa[row, :n] = [np.nan if v is None else v for v in aligned_rsa[:n]]
+                asa[row, :n] = [np.nan if v is None else v for v in aligned_asa[:n]]
+
+        return cls(allele_class=allele_class, ids=ids, seqs=seqs, lengths=lengths,
+                   rsa=rsa, asa=asa, sas_lengths=sas_lengths)
+
+    def append(self, other: "ClassStore") -> None:
+        """
+        Append the rows of another store of the class, whose alleles are not in this store.
+        The matrices grow with spare rows, so appending costs in proportion to the appended rows;
+        views of the matrices taken before keep the rows they had.
+        """
+        n, m = len(self.ids), len(other.ids)
+        if m == 0:
+            return
+        width = max(self.seqs.shape[1], other.seqs.shape[1])
+        if self._buffers is None or n + m > len(self._buffers[0]) or width > self._buffers[0].shape[1]:
+            capacity = max(2 * (n + m), 16)
+            buffers = (np.full((capacity, width), PAD, dtype=np.uint8), np.zeros(capacity, dtype=self.lengths.dtype),
+                       np.full((capacity, width), np.nan, dtype=self.rsa.dtype),
+                       np.full((capacity, width), np.nan, dtype=self.asa.dtype),
+                       np.zeros(capacity, dtype=self.sas_lengths.dtype))
+            for buffer, matrix in zip(buffers, (self.seqs, self.lengths, self.rsa, self.asa, self.sas_lengths)):
+                buffer[(slice(0, n),) + tuple(slice(0, size) for size in matrix.shape[1:])] = matrix
+            self._buffers = buffers
+        for buffer, matrix in zip(self._buffers, (other.seqs, other.lengths, other.rsa, other.asa, other.sas_lengths)):
+            buffer[(slice(n, n + m),) + tuple(slice(0, size) for size in matrix.shape[1:])] = matrix
+
+        self.seqs, self.lengths, self.rsa, self.asa, self.sas_lengths = (buffer[:n + m] for buffer in self._buffers)
+        for row, allele_id in enumerate(other.ids, start=n):
+            self.index[allele_id] = row
+        self.ids.extend(other.ids)
+
+    def __getstate__(self) -> Dict:
+        # the matrices are views of the buffers after an append, only the rows in use are pickled
+        return {**self.__dict__, "_buffers": None}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, allele_id: str) -> bool:
+        return allele_id in self.index
+
+    def rows(self, allele_ids: Iterable[str]) -> np.ndarray:
+        """Get the row numbers of a list of alleles"""
+        return np.array([self.index[a] for a in allele_ids], dtype=np.intp)
+
+    def aligned_seq(self, allele_id: str) -> str:
+        """Get the aligned sequence of an allele as a string"""
+        row = self.index[allele_id]
+        return self.seqs[row, :self.lengths[row]].tobytes().decode("ascii")
+
+    @property
+    def nbytes(self) -> int:
+        return self.seqs.nbytes + self.rsa.nbytes + self.asa.nbytes + self.lengths.nbytes + self.sas_lengths.nbytes
+
+
+@dataclass
+class SasAverages:
+    """
+    Per position average RSA/ASA scores of a group of alleles (e.g. the alleles of a haplotype class).
+
+    Attributes:
+        rsa (np.ndarray): (length,) average RSA, NaN where no allele has a score
+        asa (np.ndarray): (length,) average ASA, NaN where no allele has a score
+        total (np.ndarray): (length,) number of alleles with a score at the position
+    """
+    rsa: np.ndarray
+    asa: np.ndarray
+    total: np.ndarray
+
+    @classmethod
+    def from_rows(cls, store: ClassStore, rows: np.ndarray) -> "SasAverages":
+        """
+        Average the RSA/ASA scores of some rows of a class store in one call.
+        A position counts for an allele if both its RSA and ASA are known, positions run up to the
+        longest aligned RSA/ASA of the rows.
+        """
+        length = int(store.sas_lengths[rows].max()) if len(rows) else 0
+        rsa, asa = store.rsa[rows, :length], store.asa[rows, :length]
+        valid = ~np.isnan(rsa) & ~np.isnan(asa)
+        total = valid.sum(axis=0)
+        rsa_sum = np.zeros(length, dtype=np.float64)
+        asa_sum = np.zeros(length, dtype=np.float64)
+        # the rows are added one by one (np.sum may sum pairwise), so the sums are exactly
+        # the sequential sums over the alleles in haplotype order
+        for row_valid, row_rsa, row_asa in zip(valid, rsa, asa):
+            rsa_sum += np.where(row_valid, row_rsa, 0.0)
+            asa_sum += np.where(row_valid, row_asa, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return cls(rsa=rsa_sum / total, asa=asa_sum / total, total=total)
+
+    def __len__(self) -> int:
+        return len(self.total)
+
+    def __getitem__(self, position: int) -> Dict:
+        """
+        Get the averages of one position in the shape of to_dict, so the averages can be indexed
+        like the dictionary without converting all positions
+        """
+        if not 0 <= position < len(self.total):
+            raise KeyError(position)
+        total = int(self.total[position])
+        return {"rsa": float(self.rsa[position]) if total != 0 else None,
+                "asa": float(self.asa[position]) if total != 0 else None,
+                "total": total}
+
+    def to_dict(self) -> Dict[int, Dict]:
+        """
+        Convert to the dictionary shape of MHCMatchmaker.average_sas_scores:
+        {position: {"rsa": float or None, "asa": float or None, "total": int}}
+        """
+        return {i: {"rsa": rsa if total != 0 else None,
+                    "asa": asa if total != 0 else None,
+                    "total": total}
+                for i, (rsa, asa, total) in enumerate(zip(self.rsa.tolist(), self.asa.tolist(), self.total.tolist()))}
+
+
+class AlleleStore:
+    """
+    Columnar store of the aligned allele data, one ClassStore per class.
+
+    Usage:
+        store = AlleleStore.from_alleles(local_db)
+        rows = store["I"].rows(["SLA-1*04:01:01", "SLA-2*01:05:02"])
+        sequences = store["I"].seqs[rows]
+    """
+
+    def __init__(self, classes: Dict[str, ClassStore]):
+        self.classes = classes
+        self.allele_classes = {allele_id: clas for clas, store in classes.items() for allele_id in store.ids}
+
+    @classmethod
+    def from_alleles(cls, alleles: Dict[str, object], sas_dtype=np.float32) -> "AlleleStore":
+        """
+        Build the store from a mapping of allele IDs to Allele dataclasses or database documents.
+        Alleles that cannot be classified are left out.
+        """
+        per_class = _per_class(alleles)
+        return cls({clas: ClassStore.from_alleles(clas, per_class[clas], sas_dtype=sas_dtype) for clas in CLASSES})
+
+    def add_alleles(self, alleles: Dict[str, object]) -> None:
+        """
+        Add the alleles that are not in the store yet, see ClassStore.append.
+        Only the new alleles are read, alleles that cannot be classified are left out.
+        """
+        per_class = _per_class({allele_id: allele for allele_id, allele in alleles.items() if allele_id not in self})
+        for clas, class_alleles in per_class.items():
+            if not class_alleles:
+                continue
+            store = self.classes[clas]
+            store.append(ClassStore.from_alleles(clas, class_alleles, sas_dtype=store.rsa.dtype))
+            for allele_id in class_alleles:
+                self.allele_classes[allele_id] = clas
+
+    def __getitem__(self, allele_class: str) -> ClassStore:
+        return self.classes[allele_class]
+
+    def __contains__(self, allele_id: str) -> bool:
+        return allele_id in self.allele_classes
+
+    def __len__(self) -> int:
+        return len(self.allele_classes)
+
+    def class_of(self, allele_id: str) -> str:
+        """Get the class of an allele in the store"""
+        return self.allele_classes[allele_id]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(store.nbytes for store in self.classes.values())
@@ -0,0 +1,271 @@
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+# project imports
+from utils.allele_store import AlleleStore, ClassStore
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains the allele pair difference tables.
+
+A residue of the donor haplotype at a position is a mismatch if no recipient allele has it there, so a
+position of a pair of grouped haplotypes has a donor mismatch if some donor allele differs from every
+recipient allele at that position:
+    donor mismatches = OR over the donor alleles a of (AND over the recipient alleles b of differs(a, b))
+and the recipient mismatches the other way around. The table of a class keeps differs(a, b), the positions
+where two aligned sequences have a different residue, bit-packed in 64 bit words for every pair of alleles,
+so the scores of a pair of haplotypes are composed from a few table rows instead of comparing the sequences.
+
+The table of a class grows with the square of its number of alleles, so the tables are built for the alleles
+used most by the donors and recipients, within a memory budget. The pairs with an allele outside the table
+are compared on the grouped bitmasks (mismatch_engine.score_matrix).
+"""
+
+WORD_DTYPE = np.uint64
+
+# np.bitwise_count is only available from NumPy 2.0
+_bitwise_count = getattr(np, "bitwise_count", None)
+
+
+def pack(bits: np.ndarray) -> np.ndarray:
+    """Pack bool arrays over the last axis into 64 bit words, bit p in word p // 64"""
+    packed = np.packbits(bits, axis=-1)
+    n_words = (packed.shape[-1] + 7) // 8
+    padded = np.zeros(packed.shape[:-1] + (n_words * 8,), dtype=np.uint8)
+    padded[..., :packed.shape[-1]] = packed
+    return padded.view(WORD_DTYPE)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Count the set bits of packed bitsets over the last axis"""
+    if _bitwise_count is not None:
+        return _bitwise_count(words).sum(axis=-1, dtype=np.int32)
+    # SWAR population count of every word
+    words = words - ((words >> WORD_DTYPE(1)) & WORD_DTYPE(0x5555555555555555))
+    words = (words & WORD_DTYPE(0x3333333333333333)) + ((words >> WORD_DTYPE(2)) & WORD_DTYPE(0x3333333333333333))
+    words = (words + (words >> WORD_DTYPE(4))) & WORD_DTYPE(0x0F0F0F0F0F0F0F0F)
+    return ((words * WORD_DTYPE(0x0101010101010101)) >> WORD_DTYPE(56)).sum(axis=-1, dtype=np.int32)
+
+
+class AlleleDiffTable:
+    """
+    Bit-packed per position residue differences of every pair of alleles of one class.
+
+    Attributes:
+        ids (List[str]): Allele IDs, in table order
+        index (Dict[str, int]): Allele ID -> table row
+        lengths (np.ndarray): (n_alleles,) length of every aligned sequence
+        width (int): Number of positions of the table
+        diff (np.ndarray): (n_alleles + 1, n_alleles + 1, n_words) packed bitsets (see pack), bit p of diff[a, b]
+                           is set if the aligned sequences of a and b differ at position p (both long enough).
+                           The last row and column are the sentinel allele that pads the haplotypes to the same
+                           number of alleles: its row is empty and its column full, so it leaves the OR over the
+                           alleles of one side and the AND over the alleles of the other side unchanged.
+    """
+
+    def __init__(self, store: ClassStore, allele_ids: List[str]):
+        """
+        Parameters:
+            store (ClassStore): The store of the class
+            allele_ids (List[str]): The alleles of the table, all in the store
+        """
+        self.ids = list(allele_ids)
+        self.index = {allele_id: row for row, allele_id in enumerate(self.ids)}
+        rows = store.rows(self.ids)
+        self.lengths = store.lengths[rows].astype(np.int64)
+        self.width = int(self.lengths.max()) if len(rows) else 0
+        seqs = store.seqs[rows, :self.width]
+
+        positions = np.arange(self.width)
+        self.diff = np.zeros((len(rows) + 1, len(rows) + 1, self.n_words), dtype=WORD_DTYPE)
+        self.diff[:, len(rows)] = ~WORD_DTYPE(0)
+        self.diff[len(rows)] = 0
+        # one row at a time, so the unpacked differences of all pairs are never held at once
+        for row in range(len(rows)):
+            compared = positions < np.minimum(self.lengths[row], self.lengths)[:, None]
+            self.diff[row, :len(rows)] = pack((seqs[row] != seqs) & compared)
+
+    @property
+    def n_words(self) -> int:
+        return (self.width + 63) // 64
+
+    @property
+    def nbytes(self) -> int:
+        return self.diff.nbytes
+
+    @staticmethod
+    def estimate_nbytes(n_alleles: int, width: int) -> int:
+        """Get the size of the table of n_alleles alleles of width positions, without building it"""
+        return (n_alleles + 1) ** 2 * ((width + 63) // 64) * WORD_DTYPE().itemsize
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def covers(self, haplotype: Iterable[str]) -> bool:
+        """Check if all the alleles of a haplotype are in the table"""
+        return all(allele in self.index for allele in haplotype)
+
+    def _rows(self, haplotypes: List[List[str]]):
+        # rows of the alleles of every haplotype, padded with the sentinel row len(self)
+        width = max([len(haplotype) for haplotype in haplotypes], default=0)
+        rows = np.full((len(haplotypes), width), len(self), dtype=np.intp)
+        lengths = np.zeros(len(haplotypes), dtype=np.int64)
+        for i, haplotype in enumerate(haplotypes):
+            rows[i, :len(haplotype)] = [self.index[allele] for allele in haplotype]
+            # a grouped haplotype ends at its shortest aligned sequence, see MHCMatchmaker.group_haplotype
+            lengths[i] = self.lengths[rows[i, :len(haplotype)]].min() if len(haplotype) else 0
+        return rows, lengths
+
+    def _pack_keep(self, keep: np.ndarray) -> np.ndarray:
+        padded = np.ones((len(keep), self.width), dtype=bool)
+        n = min(self.width, keep.shape[1])
+        padded[:, :n] = keep[:, :n]
+        return pack(padded)
+
+    def score_matrix(self, donor_haplotypes: List[List[str]], recip_haplotypes: List[List[str]],
+                     donor_keep: np.ndarray = None, recip_keep: np.ndarray = None,
+                     max_block_bytes: int = 64 * 2**20) -> Dict[str, np.ndarray]:
+        """
+        Compute the mismatch scores of all recipient x donor pairs of haplotypes of the class from the table,
+        with the output of mismatch_engine.score_matrix.
+
+        Parameters:
+            donor_haplotypes (List[List[str]]): The alleles of every donor haplotype of the class, all in the table
+            recip_haplotypes (List[List[str]]): The alleles of every recipient haplotype of the class, all in the table
+            donor_keep (np.ndarray, optional): (n_donors, width) bool, False for the positions filtered out
+                                               by solvent accessibility (see MHCMatchmaker.sas_keep)
+            recip_keep (np.ndarray, optional): (n_recipients, width) bool, the same for the recipients
+            max_block_bytes (int): Memory budget of one block of recipients
+
+        Returns:
+            Dict[str, np.ndarray]: (n_recipients, n_donors) matrices
+                - donor_diff_score, recip_diff_score
+                - updated_mismatches_count (if donor_keep is given)
+                - updated_recip_mismatches_count (if recip_keep is given)
+
+        Raises:
+            KeyError: If an allele is not in the table
+        """
+        n_recips, n_donors = len(recip_haplotypes), len(donor_haplotypes)
+        donor_rows, donor_lengths = self._rows(donor_haplotypes)
+        recip_rows, recip_lengths = self._rows(recip_haplotypes)
+        if donor_keep is not None:
+            donor_keep = self._pack_keep(donor_keep)
+        if recip_keep is not None:
+            recip_keep = self._pack_keep(recip_keep)
+
+        scores = {"donor_diff_score": np.zeros((n_recips, n_donors), dtype=np.int32),
+                  "recip_diff_score": np.zeros((n_recips, n_donors), dtype=np.int32)}
+        if donor_keep is not None:
+            scores["updated_mismatches_count"] = np.zeros((n_recips, n_donors), dtype=np.int32)
+        if recip_keep is not None:
+            scores["updated_recip_mismatches_count"] = np.zeros((n_recips, n_donors), dtype=np.int32)
+
+        # bitsets of the positions before every length, to cut a comparison at the end of the shortest haplotype
+        positions = np.arange(self.width)
+        prefixes = pack(positions[None, :] < np.arange(self.width + 1)[:, None])
+
+        # the differences of every allele with a whole haplotype: bit p of differs_all[h, a] is set if allele a
+        # differs from every allele of haplotype h at p, the sentinel allele differs from nothing
+        def differs_all(rows: np.ndarray) -> np.ndarray:
+            return np.bitwise_and.reduce(self.diff[:, rows], axis=2).swapaxes(0, 1)
+
+        # a block of haplotypes holds a few (block, n_table_alleles or n_donors, n_alleles) arrays of bitsets
+        n_alleles = max(1, donor_rows.shape[1], recip_rows.shape[1])
+        row_bytes = 4 * n_alleles * self.diff[0, 0].nbytes
+        donor_block = max(1, int(max_block_bytes // (row_bytes * len(self.diff))))
+        recip_block = max(1, int(max_block_bytes // (row_bytes * max(len(self.diff), min(donor_block, n_donors)))))
+        for donor_start in range(0, n_donors, donor_block):
+            donors = slice(donor_start, min(donor_start + donor_block, n_donors))
+            donor_differs = differs_all(donor_rows[donors])
+            for start in range(0, n_recips, recip_block):
+                stop = min(start + recip_block, n_recips)
+                recip_differs = differs_all(recip_rows[start:stop])
+                # a donor mismatch is a donor allele that differs from every recipient allele, and the other way around
+                donor_bits = np.bitwise_or.reduce(recip_differs[:, donor_rows[donors]], axis=2)
+                recip_bits = np.bitwise_or.reduce(donor_differs[:, recip_rows[start:stop]], axis=2).swapaxes(0, 1)
+
+                compared = prefixes[np.minimum(recip_lengths[start:stop, None], donor_lengths[None, donors])]
+                donor_bits &= compared
+                recip_bits &= compared
+                scores["donor_diff_score"][start:stop, donors] = popcount(donor_bits)
+                scores["recip_diff_score"][start:stop, donors] = popcount(recip_bits)
+                if donor_keep is not None:
+                    scores["updated_mismatches_count"][start:stop, donors] = popcount(donor_bits & donor_keep[None, donors])
+                if recip_keep is not None:
+                    scores["updated_recip_mismatches_count"][start:stop, donors] = popcount(recip_bits & recip_keep[start:stop, None])
+
+        return scores
+
+
+class AlleleTables:
+    """
+    The allele pair difference tables of all classes, built for the alleles of a session or registry.
+
+    Usage:
+        tables = AlleleTables.build(allele_store, {"I": [haplotype, ...], ...}, memory_budget=64 * 2**20)
+        table = tables.get("I")
+    """
+
+    def __init__(self, tables: Dict[str, AlleleDiffTable]):
+        self.tables = tables
+
+    @classmethod
+    def build(cls, store: AlleleStore, haplotypes: Dict[str, List[List[str]]],
+              memory_budget: int = 64 * 2**20) -> "AlleleTables":
+        """
+        Build the tables of the alleles of the haplotypes, within a memory budget.
+        If the table of all the alleles of a class does not fit, it holds the alleles in most haplotypes.
+        The budget is shared by the classes, a class gets an equal part of what the smaller classes leave.
+
+        Parameters:
+            store (AlleleStore): The store of the alleles
+            haplotypes (Dict[str, List[List[str]]]): {class: the alleles of every haplotype of the class}
+            memory_budget (int): Maximum size of all the tables in bytes. Defaults to 64 MiB.
+
+        Returns:
+            AlleleTables: The tables, classes without a table are compared on the grouped bitmasks
+        """
+        counts = {clas: Counter(allele for haplotype in class_haplotypes for allele in set(haplotype))
+                  for clas, class_haplotypes in haplotypes.items()}
+        widths = {clas: max([int(store[clas].lengths[store[clas].index[allele]]) for allele in class_counts], default=0)
+                  for clas, class_counts in counts.items()}
+        # the classes that need the least go first, and leave the rest of their part to the others
+        order = sorted(counts, key=lambda clas: AlleleDiffTable.estimate_nbytes(len(counts[clas]), widths[clas]))
+
+        tables, remaining = {}, memory_budget
+        for i, clas in enumerate(order):
+            budget = remaining // (len(order) - i)
+            # the most used alleles first, ties in store order
+            alleles = sorted(counts[clas], key=lambda allele: (-counts[clas][allele], store[clas].index[allele]))
+            n = len(alleles)
+            while n > 0 and AlleleDiffTable.estimate_nbytes(n, widths[clas]) > budget:
+                n -= 1
+            if n < len(alleles):
+                kept = set(alleles[:n])
+                covered = sum(1 for haplotype in haplotypes[clas] if kept.issuperset(haplotype))
+                logger.info(f"Allele table of class {clas} limited to {n} of {len(alleles)} alleles by the memory budget, "
+                            f"covering {covered} of {len(haplotypes[clas])} haplotypes")
+            if n == 0:
+                continue
+            tables[clas] = AlleleDiffTable(store[clas], alleles[:n])
+            remaining -= tables[clas].nbytes
+
+        logger.info("Allele tables built for %d classes, %.1f MiB", len(tables),
+                    sum(table.nbytes for table in tables.values()) / 2**20)
+        return cls(tables)
+
+    def get(self, clas: str) -> Optional[AlleleDiffTable]:
+        """Get the table of a class, None if there is none"""
+        return self.tables.get(clas)
+
+    def __contains__(self, clas: str) -> bool:
+        return clas in self.tables
+
+    @property
+    def nbytes(self) -> int:
+        return sum(table.nbytes for table in self.tables.values())
@@ -0,0 +1,213 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment as _scipy_linear_sum_assignment
+except ImportError:
+    _scipy_linear_sum_assignment = None
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains the donor-recipient allocation solver.
+Instead of ranking the donors of every recipient on its own, it assigns the donors to the recipients
+such that the total cost over all assigned pairs is minimal. The cost of a pair is the weighted sum of
+its SAS filtered donor mismatch counts per class plus its weighted known eplet load.
+
+The assignment is solved with the shortest augmenting path variant of the Hungarian algorithm,
+or with scipy.optimize.linear_sum_assignment if scipy is installed.
+"""
+
+
+def linear_sum_assignment(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solve the (rectangular) linear assignment problem: every row is assigned to a different column
+    (or every column to a different row if there are fewer columns) with a minimal total cost.
+
+    Parameters:
+        cost (np.ndarray): (n_rows, n_cols) finite cost matrix
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The row and column indices of the assigned pairs, sorted by row
+
+    Raises:
+        ValueError: If the cost matrix is not 2 dimensional or has non finite costs
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.ndim != 2:
+        raise ValueError(f"The cost matrix must be 2 dimensional, got shape {cost.shape}")
+    if not np.isfinite(cost).all():
+        raise ValueError("The cost matrix must be finite")
+    if cost.size == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    if _scipy_linear_sum_assignment is not None:
+        rows, cols = _scipy_linear_sum_assignment(cost)
+        return np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)
+
+    # the solver assigns every row, so it runs on the orientation with the fewest rows
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = _hungarian(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+    return _hungarian(cost)
+
+
+def _hungarian(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Shortest augmenting path Hungarian algorithm for n_rows <= n_cols, O(n_rows^2 * n_cols).
+    The rows are added one by one, every row is assigned along the shortest augmenting path under
+    the reduced costs (a Dijkstra search over the columns, vectorized over the columns).
+    """
+    n_rows, n_cols = cost.shape
+    # potentials of the rows and columns, column 0 is a virtual column for the row being added
+    u = np.zeros(n_rows + 1)
+    v = np.zeros(n_cols + 1)
+    # row assigned to every column (1-indexed, 0 if free) and the previous column on the shortest path
+    assigned = np.zeros(n_cols + 1, dtype=np.intp)
+    way = np.zeros(n_cols + 1, dtype=np.intp)
+
+    # row reduction: assign the rows greedily to a free column of minimal cost,
+    # only the rows left over need an augmenting path search
+    u[1:] = cost.min(axis=1)
+    unassigned = []
+    for row in range(1, n_rows + 1):
+        candidates = np.flatnonzero((cost[row - 1] == u[row]) & (assigned[1:] == 0))
+        if len(candidates):
+            assigned[candidates[0] + 1] = row
+        else:
+            unassigned.append(row)
+
+    for row in unassigned:
+        assigned[0] = row
+        col = 0
+        min_reduced = np.full(n_cols + 1, np.inf)
+        used = np.zeros(n_cols + 1, dtype=bool)
+        while True:
+            used[col] = True
+            current_row = assigned[col]
+            free = ~used
+            free[0] = False
+            reduced = np.full(n_cols + 1, np.inf)
+            reduced[1:] = cost[current_row - 1] - u[current_row] - v[1:]
+            improved = free & (reduced < min_reduced)
+            min_reduced[improved] = reduced[improved]
+            way[improved] = col
+
+            next_col = int(np.argmin(np.where(free, min_reduced, np.inf)))
+            delta = min_reduced[next_col]
+            u[assigned[used]] += delta
+            v[used] -= delta
+            min_reduced[free] -= delta
+
+            col = next_col
+            if assigned[col] == 0:
+                break
+
+        # flip the assignments along the augmenting path
+        while col != 0:
+            previous = way[col]
+            assigned[col] = assigned[previous]
+            col = previous
+
+    cols = np.flatnonzero(assigned[1:])
+    rows = assigned[1:][cols] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def allocate(cost: np.ndarray, capacity=1, forbidden: Optional[np.ndarray] = None) -> List[Tuple[int, int]]:
+    """
+    Assign columns (donors) to rows (recipients) with a minimal total cost.
+    A column can be assigned to at most capacity rows. Forbidden pairs are never assigned:
+    the assignment has as many allowed pairs as possible, and the minimal cost among those.
+    Rows that can not be assigned (more rows than total capacity, or only forbidden pairs) are left out.
+
+    Parameters:
+        cost (np.ndarray): (n_rows, n_cols) cost matrix, infinite costs are forbidden pairs
+        capacity (int or np.ndarray): Maximum number of rows per column, one value or one per column. Defaults to 1.
+        forbidden (np.ndarray, optional): (n_rows, n_cols) bool matrix of the pairs that must not be assigned
+
+    Returns:
+        List[Tuple[int, int]]: The assigned (row, column) pairs, sorted by row
+
+    Raises:
+        ValueError: If the shapes do not match or a capacity or cost is negative
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    n_rows, n_cols = cost.shape
+    capacity = np.broadcast_to(np.asarray(capacity, dtype=np.intp), (n_cols,))
+    if (capacity < 0).any():
+        raise ValueError("Capacities must not be negative")
+    # a column is never assigned to more rows than there are
+    capacity = np.minimum(capacity, n_rows)
+    if np.isnan(cost).any() or (cost < 0).any():
+        raise ValueError("Costs must not be negative or NaN")
+
+    blocked = ~np.isfinite(cost)
+    if forbidden is not None:
+        forbidden = np.asarray(forbidden, dtype=bool)
+        if forbidden.shape != cost.shape:
+            raise ValueError(f"Forbidden pairs of shape {forbidden.shape} do not match the costs of shape {cost.shape}")
+        blocked = blocked | forbidden
+
+    # a column with capacity c is repeated c times
+    columns = np.repeat(np.arange(n_cols), capacity)
+    if n_rows == 0 or len(columns) == 0:
+        return []
+
+    # every blocked pair costs more than any assignment of allowed pairs, so they are only used when
+    # a row can not be assigned otherwise, and dropped afterwards
+    allowed_costs = cost[~blocked]
+    big = (allowed_costs.max() if allowed_costs.size else 0.0) * min(n_rows, len(columns)) + 1.0
+    expanded = np.where(blocked, big, cost)[:, columns]
+
+    rows, cols = linear_sum_assignment(expanded)
+    return [(int(row), int(columns[col])) for row, col in zip(rows, cols) if not blocked[row, columns[col]]]
+
+
+def allocation_costs(score_matrix: Dict, class_weights: Optional[Dict[str, float]] = None,
+                     eplet_mismatch_matrix: Optional[Dict] = None, eplet_weight: float = 0.0) -> np.ndarray:
+    """
+    Build the (n_recipients, n_donors) cost matrix of the allocation.
+
+    Parameters:
+        score_matrix (Dict): Batched scores with the SAS filtered counts, see MHCMatchmaker.calc_score_matrix
+        class_weights (Dict[str, float], optional): Weight of every class, classes that are not in the dictionary
+                                                    are left out. Defaults to a weight of 1 for all classes.
+        eplet_mismatch_matrix (Dict, optional): Batched eplet loads, see MHCMatchmaker.calc_eplet_mismatch_matrix
+        eplet_weight (float): Weight of the donor eplet load (known eplets of the donor the recipient lacks),
+                              per class weighted by the class weight as well. Defaults to 0.
+
+    Returns:
+        np.ndarray: The cost matrix, rows in score_matrix["recipients"] order, columns in score_matrix["donors"] order
+
+    Raises:
+        ValueError: If the score matrix has no SAS filtered counts, the eplet loads are of other donors or recipients,
+                    or a weight is negative
+    """
+    classes = score_matrix["classes"]
+    if class_weights is None:
+        class_weights = {clas: 1.0 for clas in classes}
+    if eplet_weight < 0 or any(weight < 0 for weight in class_weights.values()):
+        raise ValueError("Weights must not be negative")
+
+    costs = np.zeros((len(score_matrix["recipients"]), len(score_matrix["donors"])))
+    for clas, weight in class_weights.items():
+        if weight == 0 or clas not in classes:
+            continue
+        if "updated_mismatches_count" not in classes[clas]:
+            raise ValueError("The score matrix has no SAS filtered counts, calculate it with an rsa_threshold")
+        costs += weight * classes[clas]["updated_mismatches_count"]
+
+    if eplet_mismatch_matrix is not None and eplet_weight != 0:
+        if (eplet_mismatch_matrix["recipients"] != score_matrix["recipients"]
+                or eplet_mismatch_matrix["donors"] != score_matrix["donors"]):
+            raise ValueError("The eplet loads and the scores are of different donors or recipients")
+        for clas, loads in eplet_mismatch_matrix["classes"].items():
+            weight = class_weights.get(clas, 0)
+            if weight != 0:
+                costs += eplet_weight * weight * loads["donor_eplet_load"]
+    return costs
@@ -9,9 +9,9 @@ import logging
 
 # project imports
 from database import get_database
+from utils.mismatch_engine import count_mismatches, mismatch_length, dense_class_difference
 
 # setting up 
-db = get_database()
 logger = logging.getLogger(__name__)
 
 
@@ -153,6 +153,7 @@ def export_alignment(donors, recipients, relevant_classes, write_to_file=False):
     """
 
     alignment_wb = Workbook()
+    db = get_database()
 
     for cls in relevant_classes:
         alignment_ws = alignment_wb.create_sheet(cls)
@@ -333,7 +334,7 @@ def export_mismatches(difference_scores, relevant_classes, write_to_file=False,o
     for cls in relevant_classes:
         mismatches_ws = mismatches_wb.create_sheet(cls)
         
-        length = len(difference_scores[recipients[0]][donors[0]][cls]["updated_mismatches"])
+        length = mismatch_length(difference_scores[recipients[0]][donors[0]][cls])
 
         # Add header row with recipient-donor pair labels
         header = ['Recipient-Donor'] + [i+1 for i in range(length)]
@@ -341,8 +342,11 @@ def export_mismatches(difference_scores, relevant_classes, write_to_file=False,o
 
         for recip in recipients:
             for donor in donors:
+                # the sheet has a column for every position, so sparse results are exported dense
+                pair_scores = dense_class_difference(difference_scores[recip][donor][cls])
+
                 row = [f"{recip}-{donor}: initial donor mismatches"]
-                mismatches = difference_scores[recip][donor][cls]["donor_diff"]
+                mismatches = pair_scores["donor_diff"]
                 for i in mismatches:
                     if i is list():
                         row.append(None)
@@ -352,7 +356,7 @@ def export_mismatches(difference_scores, relevant_classes, write_to_file=False,o
                 mismatches_ws.append(row)
 
                 row = [f"{recip}-{donor}: SAS filtered donor mismatches"]
-                mismatches = difference_scores[recip][donor][cls]["updated_mismatches"]
+                mismatches = pair_scores["updated_mismatches"]
                 for i in mismatches:
                     if i is list():
                         row.append(None)
@@ -361,7 +365,7 @@ def export_mismatches(difference_scores, relevant_classes, write_to_file=False,o
                 mismatches_ws.append(row)
             
                 row = [f"{recip}-{donor}: initial recipient mismatches"]
-                mismatches = difference_scores[recip][donor][cls]["recip_diff"]
+                mismatches = pair_scores["recip_diff"]
                 for i in mismatches:
                     if i is list():
                         row.append(None)
@@ -370,7 +374,7 @@ def export_mismatches(difference_scores, relevant_classes, write_to_file=False,o
                 mismatches_ws.append(row)
                 
                 row = [f"{recip}-{donor}: SAS filtered recipient mismatches"]
-                mismatches = difference_scores[recip][donor][cls]["updated_recip_mismatches"]
+                mismatches = pair_scores["updated_recip_mismatches"]
                 for i in mismatches:
                     if i is list():
                         row.append(None)
@@ -495,6 +499,7 @@ def create_entity_info(donors,recipients,write_to_file=False,output_path="result
     """
 
     entity_info = {}
+    db = get_database()
 
     donors_and_recips = {**donors, **recipients}
     for id in donors_and_recips:
@@ -568,10 +573,18 @@ def get_raw_mismatches(donors,recipients,difference_scoring):
         return raw_mismatches
     
 
-def generate_ranking_data(donors, recipients, difference_scoring):
+def generate_ranking_data(donors, recipients, difference_scoring, compact=False):
     """
+    Rank the donors of every recipient per class on their mismatches.
 
-    
+    :param donors: dict with the donors, with their grouped haplotypes
+    :param recipients: dict with the recipients, with their grouped haplotypes
+    :param difference_scoring: the difference scoring of all pairs, filtered by solvent accessibility
+    :param compact: if True, difference_scoring only holds the scores of the pairs (MHCMatchmaker.compact_scoring,
+                    lazy jobs). The ranking is then built from the counts alone and leaves out the per position
+                    updated_mismatches, which are available per pair from /api/pair_details.
+
+    :return: {recipient_id: {"recipientID": recipient_id, "scores": {class: [{donorID, score, ...}]}}}
     """
     ranking_data = {}
 
@@ -588,38 +601,86 @@ def generate_ranking_data(donors, recipients, difference_scoring):
                 if donor_id not in difference_scoring[recip_id]:
                     raise ValueError(f"Difference scoring not calculated for donor_id: {donor_id} and recipient_id: {recip_id}")
                 
-                donor_diff_score = difference_scoring[recip_id][donor_id][clas]["donor_diff_score"]
+                scores = difference_scoring[recip_id][donor_id][clas]
+                donor_diff_score = scores["donor_diff_score"]
                 donor_diff_total = len(recipients[recip_id]["haplotypeClassGrouped"][clas])
                 
                 if donor_diff_total != 0:
                     percent = round(donor_diff_score / donor_diff_total, 4) * 100.0 
                     percent = 100 - percent
-                    updated_score = difference_scoring[recip_id][donor_id][clas]["updated_mismatches_count"]
+                    updated_score = scores["updated_mismatches_count"]
                     updated_score_percent = 100 - round(updated_score / donor_diff_total, 4) * 100.0
                 else:
                     percent = None
                     updated_score = None
                     updated_score_percent = None
                 
-                total_sequence_length = len(difference_scoring[recip_id][donor_id][clas]["updated_mismatches"])
-
+                if compact:
+                    # the scores and counts are the number of mismatched positions of the vectors
+                    mismatch_counts = [scores["donor_diff_score"], scores["recip_diff_score"],
+                                       scores["updated_mismatches_count"], scores["updated_recip_mismatches_count"]]
+                    total_sequence_length = min(len(donors[donor_id]["haplotypeClassGrouped"][clas]),
+                                                len(recipients[recip_id]["haplotypeClassGrouped"][clas]))
+                else:
+                    mismatch_counts = [count_mismatches(scores[key]) for key in
+                                       ["donor_diff", "recip_diff", "updated_mismatches", "updated_recip_mismatches"]]
+                    total_sequence_length = mismatch_length(scores)
 
-                recipient_data["scores"][clas].append({
+                donor_ranking = {
                     "donorID": donor_id, 
                     "score": percent,
-                    "mismatches_donor": len([mismatch for mismatch in difference_scoring[recip_id][donor_id][clas]["donor_diff"] if mismatch != list()]),
-                    "mismatches_recip": len([mismatch for mismatch in difference_scoring[recip_id][donor_id][clas]["recip_diff"] if mismatch != list()]),
-                    "updated_mismatches_donor": len([mismatch for mismatch in difference_scoring[recip_id][donor_id][clas]["updated_mismatches"] if mismatch != list()]),
-                    "updated_mismatches_recip": len([mismatch for mismatch in difference_scoring[recip_id][donor_id][clas]["updated_recip_mismatches"] if mismatch != list()]),
+                    "mismatches_donor": mismatch_counts[0],
+                    "mismatches_recip": mismatch_counts[1],
+                    "updated_mismatches_donor": mismatch_counts[2],
+                    "updated_mismatches_recip": mismatch_counts[3],
                     "total_sequence_length": total_sequence_length ,
-                    "updated_score": updated_score_percent,
-                    "updated_mismatches": difference_scoring[recip_id][donor_id][clas]["updated_mismatches"]})
+                    "updated_score": updated_score_percent}
+                if not compact:
+                    donor_ranking["updated_mismatches"] = scores["updated_mismatches"]
+                recipient_data["scores"][clas].append(donor_ranking)
             
         ranking_data[recip_id] = recipient_data
     
     return ranking_data
 
 
+def generate_eplet_load_data(eplet_mismatch_matrix):
+    """
+    Turn the batched eplet mismatch loads (MHCMatchmaker.calc_eplet_mismatch_matrix) into a JSON friendly dictionary.
+
+    :param eplet_mismatch_matrix: dict with the recipients, donors and per class load matrices
+
+    :return: {recipient_id: {donor_id: {class: {"donor": int, "recip": int}}}}
+    """
+    classes = eplet_mismatch_matrix["classes"]
+    return {recip_id: {donor_id: {clas: {"donor": int(loads["donor_eplet_load"][i, j]),
+                                         "recip": int(loads["recip_eplet_load"][i, j])}
+                                  for clas, loads in classes.items()}
+                       for j, donor_id in enumerate(eplet_mismatch_matrix["donors"])}
+            for i, recip_id in enumerate(eplet_mismatch_matrix["recipients"])}
+
+
+def export_pair_stream(pairs, output_file):
+    """
+    Write a stream of pair records (MHCMatchmaker.iter_pairs) to a JSON lines file, one pair per line,
+    without holding more than one pair in memory.
+
+    :param pairs: iterable of pair records
+    :param output_file: path of the JSON lines file
+
+    :return: the number of pairs written
+    """
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    n_pairs = 0
+    with open(output_file, "w") as f:
+        for pair in pairs:
+            f.write(json.dumps(pair))
+            f.write("\n")
+            n_pairs += 1
+    logger.info(f"{n_pairs} pairs written to {output_file}")
+    return n_pairs
+
+
 def generate_ranking_data_csv(ranking_data):
     """
     Generate a csv file from the ranking data for every recipient
@@ -635,6 +696,7 @@ def get_aligned_seqs(donors, recipients):
     Get the aligned sequences for all alleles in the donors and recipients.
     """
     aligned_seqs = {}
+    db = get_database()
     donors_and_recips = {**donors, **recipients}
     
     for entity in donors_and_recips:
@@ -0,0 +1,221 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# project imports
+from utils.mismatch_engine import MASK_DTYPE
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains an exact nearest donor index over the bitmask encoded grouped haplotypes.
+
+The solvent accessibility filtered donor mismatch count of a pair (updated_mismatches_count) is the number
+of positions where the donor has a residue the recipient lacks and the donor position survives the filter.
+With the filtered positions of the donor set to the empty mask, and the recipient padded with full masks
+beyond its length, that count is
+    q(donor, recipient) = number of positions p where donor[p] is not a subset of recipient[p]
+q is not symmetric, but it satisfies the triangle inequality q(x, z) <= q(x, y) + q(y, z): if x[p] is not a
+subset of z[p], either x[p] is not a subset of y[p], or it is and then y[p] is not a subset of z[p] either.
+
+The index keeps q between every donor and a few pivot haplotypes (LAESA). For a query, q between the
+recipient and the pivots gives a lower bound of every donor score without looking at the donor:
+    q(donor, recipient) >= q(donor, pivot) - q(recipient, pivot)
+    q(donor, recipient) >= q(pivot, recipient) - q(pivot, donor)
+The donors are then scored in the order of their lower bound, until the lower bound of the next donor
+is above the k-th best score found. Donors with the same filtered haplotype are indexed once.
+"""
+
+# mask of a position that holds every residue
+FULL_MASK = ~MASK_DTYPE(0)
+
+
+def _not_subset(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Count the positions where x is not a subset of y, over the last axis"""
+    return ((x & ~y) != 0).sum(axis=-1)
+
+
+class DonorIndex:
+    """
+    Exact k nearest donor search by solvent accessibility filtered donor mismatches.
+
+    Usage:
+        index = DonorIndex(donor_ids, {"I": stack_masks(donor_masks)}, {"I": donor_keep})
+        index.query({"I": recipient_mask}, k=10)
+    """
+
+    def __init__(self, donor_ids: List[str], masks: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                 keep: Dict[str, np.ndarray], n_pivots: int = 16, rsa_threshold: Optional[float] = None,
+                 block_size: int = 64):
+        """
+        Parameters:
+            donor_ids (List[str]): The donor identifiers, in donor order
+            masks (Dict[str, Tuple[np.ndarray, np.ndarray]]): {class: (stacked bitmasks, lengths)} of the donors,
+                                                              see mismatch_engine.stack_masks
+            keep (Dict[str, np.ndarray]): {class: (n_donors, width) bool}, False for the positions filtered out
+                                          by solvent accessibility, see MHCMatchmaker.sas_keep
+            n_pivots (int): Number of pivot haplotypes. Defaults to 16.
+            rsa_threshold (float, optional): The RSA threshold the keep masks were built with
+            block_size (int): Number of donors scored per step of a query. Defaults to 64.
+        """
+        self.donor_ids = list(donor_ids)
+        self.rsa_threshold = rsa_threshold
+        self.block_size = block_size
+        self.classes = list(masks.keys())
+        self.widths = {}
+
+        # filtered donor haplotypes: the filtered positions and the positions beyond the end are empty
+        filtered = {}
+        for clas, (stacked, lengths) in masks.items():
+            width = stacked.shape[1]
+            class_keep = np.ones((len(stacked), width), dtype=bool)
+            n = min(width, keep[clas].shape[1])
+            class_keep[:, :n] = keep[clas][:, :n]
+            filtered[clas] = np.where(class_keep, stacked, MASK_DTYPE(0))
+            self.widths[clas] = width
+
+        # donors with the same filtered haplotypes are one point of the index
+        point_of_key = {}
+        self.point_of = np.zeros(len(self.donor_ids), dtype=np.intp)
+        for row in range(len(self.donor_ids)):
+            key = b"".join(filtered[clas][row].tobytes() for clas in self.classes)
+            self.point_of[row] = point_of_key.setdefault(key, len(point_of_key))
+        representatives = np.zeros(len(point_of_key), dtype=np.intp)
+        representatives[self.point_of[::-1]] = np.arange(len(self.donor_ids))[::-1]
+        self.points = {clas: filtered[clas][representatives] for clas in self.classes}
+        self.sizes = np.bincount(self.point_of, minlength=len(representatives))
+        self.members = np.argsort(self.point_of, kind="stable")
+        self.member_starts = np.concatenate([[0], np.cumsum(self.sizes)])
+
+        self._select_pivots(masks, representatives, n_pivots)
+        logger.info("Donor index built: %d donors, %d distinct filtered haplotypes, %d pivots",
+                    len(self.donor_ids), len(representatives), len(self.pivots[self.classes[0]]) if self.classes else 0)
+
+    def __len__(self) -> int:
+        return len(self.donor_ids)
+
+    def _select_pivots(self, masks: Dict[str, Tuple[np.ndarray, np.ndarray]], representatives: np.ndarray,
+                       n_pivots: int) -> None:
+        """
+        Pick the pivots among the donor haplotypes (unfiltered, like a recipient), farthest first:
+        every next pivot is the point farthest from the pivots so far.
+        """
+        n_points = len(representatives)
+        n_pivots = min(n_pivots, n_points)
+        self.pivots = {clas: np.zeros((n_pivots, self.widths[clas]), dtype=MASK_DTYPE) for clas in self.classes}
+        # q(point, pivot) and q(pivot, point) of every point and pivot
+        self.to_pivot = {clas: np.zeros((n_points, n_pivots), dtype=np.int32) for clas in self.classes}
+        self.from_pivot = {clas: np.zeros((n_points, n_pivots), dtype=np.int32) for clas in self.classes}
+
+        nearest = np.full(n_points, np.inf)
+        point = 0
+        for j in range(n_pivots):
+            distance = np.zeros(n_points)
+            for clas in self.classes:
+                stacked, lengths = masks[clas]
+                row = representatives[point]
+                pivot = np.where(np.arange(self.widths[clas]) < lengths[row], stacked[row], FULL_MASK)
+                self.pivots[clas][j] = pivot
+                self.to_pivot[clas][:, j] = _not_subset(self.points[clas], pivot)
+                self.from_pivot[clas][:, j] = _not_subset(pivot, self.points[clas])
+                distance += self.to_pivot[clas][:, j] + self.from_pivot[clas][:, j]
+            nearest = np.minimum(nearest, distance)
+            point = int(np.argmax(nearest))
+            if nearest[point] == 0:
+                # every point coincides with a pivot, more pivots add nothing
+                n_pivots = j + 1
+                break
+
+        for clas in self.classes:
+            self.pivots[clas] = self.pivots[clas][:n_pivots]
+            self.to_pivot[clas] = self.to_pivot[clas][:, :n_pivots]
+            self.from_pivot[clas] = self.from_pivot[clas][:, :n_pivots]
+
+    def _query_masks(self, recipient_masks: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        # beyond the end of the recipient nothing is compared, so those positions hold every residue
+        query = {}
+        for clas, mask in recipient_masks.items():
+            width = self.widths[clas]
+            padded = np.full(width, FULL_MASK, dtype=MASK_DTYPE)
+            n = min(width, len(mask))
+            padded[:n] = mask[:n]
+            query[clas] = padded
+        return query
+
+    def lower_bounds(self, recipient_masks: Dict[str, np.ndarray], class_weights: Dict[str, float]) -> np.ndarray:
+        """
+        Get a lower bound of the weighted score of every distinct filtered haplotype (point) from the pivot table.
+
+        Returns:
+            np.ndarray: (n_points,) lower bounds
+        """
+        query = self._query_masks({clas: recipient_masks[clas] for clas in class_weights})
+        lower = np.zeros(len(self.sizes))
+        for clas, weight in class_weights.items():
+            recip_to_pivot = _not_subset(query[clas], self.pivots[clas])
+            pivot_to_recip = _not_subset(self.pivots[clas], query[clas])
+            bound = np.maximum(self.to_pivot[clas] - recip_to_pivot, pivot_to_recip - self.from_pivot[clas])
+            lower += weight * np.maximum(bound.max(axis=1, initial=0), 0)
+        return lower
+
+    def query(self, recipient_masks: Dict[str, np.ndarray], k: int = 10,
+              class_weights: Optional[Dict[str, float]] = None) -> List[Tuple[str, float]]:
+        """
+        Find the k donors with the fewest solvent accessibility filtered donor mismatches for a recipient.
+        The score of a donor is the sum over the classes of the class weight times its filtered mismatch count,
+        lower is better, ties are ranked in donor order. The result is exact, the number of donors that were
+        scored is kept in self.last_scored.
+
+        Parameters:
+            recipient_masks (Dict[str, np.ndarray]): {class: bitmasks of the grouped haplotype of the recipient}
+            k (int): Number of donors. Defaults to 10.
+            class_weights (Dict[str, float], optional): Weight of every class, classes that are not in the
+                                                        dictionary are left out. Defaults to a weight of 1 for all classes.
+
+        Returns:
+            List[Tuple[str, float]]: The top k (donor_id, score), best first
+
+        Raises:
+            ValueError: If a class weight is negative or a weighted class is not in the index
+        """
+        if class_weights is None:
+            class_weights = {clas: 1.0 for clas in self.classes}
+        if any(weight < 0 for weight in class_weights.values()):
+            raise ValueError(f"Class weights must not be negative: {class_weights}")
+        missing = [clas for clas, weight in class_weights.items() if weight != 0 and clas not in self.widths]
+        if missing:
+            raise ValueError(f"Classes not in the donor index: {missing}")
+        weights = {clas: weight for clas, weight in class_weights.items() if weight != 0}
+        self.last_scored = 0
+        if k <= 0 or not self.donor_ids:
+            return []
+
+        lower = self.lower_bounds(recipient_masks, weights)
+        query = self._query_masks({clas: recipient_masks[clas] for clas in weights})
+        order = np.argsort(lower, kind="stable")
+
+        scored_points, scores = [], []
+        n_donors, bound = 0, np.inf
+        for start in range(0, len(order), self.block_size):
+            block = order[start:start + self.block_size]
+            # a donor can only tie with the k-th best score if its lower bound is not above it
+            if lower[block[0]] > bound:
+                break
+            block_scores = np.zeros(len(block))
+            for clas, weight in weights.items():
+                block_scores += weight * _not_subset(self.points[clas][block], query[clas])
+            scored_points.append(block)
+            scores.append(block_scores)
+            n_donors += int(self.sizes[block].sum())
+            if n_donors >= k:
+                donor_scores = np.repeat(np.concatenate(scores), self.sizes[np.concatenate(scored_points)])
+                bound = np.partition(donor_scores, k - 1)[k - 1]
+
+        scored_points, scores = np.concatenate(scored_points), np.concatenate(scores)
+        rows = np.concatenate([self.members[self.member_starts[p]:self.member_starts[p + 1]] for p in scored_points])
+        row_scores = np.repeat(scores, self.sizes[scored_points])
+        ranked = np.lexsort((rows, row_scores))[:k]
+        self.last_scored = len(rows)
+        logger.debug("Donor index query: %d of %d donors scored", len(rows), len(self.donor_ids))
+        return [(self.donor_ids[rows[i]], float(row_scores[i])) for i in ranked]
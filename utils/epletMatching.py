@@ -1,37 +1,17 @@
 import logging
-import json
+from typing import Dict, List
+
+import numpy as np
+
 from database import get_database
+from utils.allele_store import ClassStore, CLASSES
+from utils.eplet_registry import EpletTable, get_eplet_registry, create_eplet_dict
 # set up basic logging
 logger = logging.getLogger(__name__)
 from tqdm import tqdm
 
 
 
-def create_eplet_dict(eplets_dict):
-    """
-    Create a dictionary with the first eplet position as keys and lists of eplet ids as values
-
-    Parameters:
-    eplets_dict: a dictionary with the eplet ids as keys and the eplet data as values, eplet data is a dictionary with the position as key and the base as value
-
-    Returns:
-    eplet_dict: a dictionary with the first eplet position as keys and lists of eplet ids as values
-    """
-    eplet_dict = {}
-    for eplet_id, eplet_data in eplets_dict.items():
-        # get the sorted smallest position in the eplet_data keys
-        pos = sorted(eplet_data.keys())[0]
-        for pos in eplet_data.keys():
-            if pos not in eplet_dict:
-                eplet_dict[pos] = []
-            eplet_dict[pos].append(eplet_id)
-
-    # the length of eplet_dict should be the same as the sum of all the lenght of the values
-    # sum_of_values = sum(len(v) for v in eplet_dict.values())
-    # assert sum_of_values == len(eplets_dict), "The number of eplets in the eplet_dict is not the same as the number of eplets in the eplets_dict"
-    return eplet_dict
-
-
 def check_eplet_presence(allele, update_db=False):
     """
     Give an allele, check if it has a known eplet in it,
@@ -45,30 +25,18 @@ def check_eplet_presence(allele, update_db=False):
     eplet_ids: a list of the eplet ids
     """
 
-    file_paths = {
-        "IIDRB": "data/eplets/eplets_DRB.json",
-        "IIDQ": "data/eplets/eplets_DQ.json",
-        "I": "data/eplets/eplets_I.json"
-    }
-
     db = get_database()
 
 
     # Check the allele class
     cls = db.get_allele_class(allele)
-    if cls == "IIDQA" or cls == "IIDQB":
-        cls = "IIDQ"
-    
-    # no eplets for IIDRA class
-    if cls not in file_paths:
-        return []
 
-    # load the known eplets
-    with open(file_paths[cls], "r") as f:
-        eplets_dict = json.load(f)
-    
-    # create eplet position dict
-    eplet_pos = create_eplet_dict(eplets_dict)
+    # the known eplets and their position dict, no eplets for IIDRA class
+    eplet_table = get_eplet_registry().get(cls)
+    if eplet_table is None:
+        return []
+    eplets_dict = eplet_table.eplets
+    eplet_pos = eplet_table.positions
 
     # check the aligned sequences for the eplet presence
     aligned_seq = db.find(allele).aligned_seq
@@ -108,15 +76,63 @@ def check_eplet_presence(allele, update_db=False):
     return eplet_ids
 
 
-def update_eplets_db():
+def compute_eplet_presence(store: ClassStore, table: EpletTable) -> Dict[str, List[str]]:
+    """
+    Check all the eplets of a table against all the aligned sequences of a class at once.
+    Every eplet position is one column comparison over the residue matrix of the class.
+
+    Parameters:
+    store: the columnar store of the alleles of the class
+    table: the known eplets of the class
+
+    Returns:
+    eplet_ids: {allele_id: eplet ids}, in the order check_eplet_presence finds them (by first eplet position)
+    """
+    seqs = store.seqs
+    present = np.ones((len(store), len(table.ids)), dtype=bool)
+    for bit, eplet_id in enumerate(tqdm(table.ids, desc=f"eplets {store.allele_class}", leave=False)):
+        for pos, residue in table.eplets[eplet_id].items():
+            # eplets are 1-indexed, positions past the end of the aligned sequences never match
+            pos = int(pos) - 1
+            if pos >= seqs.shape[1] or len(residue) != 1:
+                present[:, bit] = False
+                break
+            present[:, bit] &= seqs[:, pos] == ord(residue)
+
+    # check_eplet_presence walks the sequence, so eplets are listed by their first position
+    order = sorted(range(len(table.ids)), key=lambda bit: (table.spans[table.ids[bit]][0], bit))
+    ordered_ids = [table.ids[bit] for bit in order]
+    present = present[:, order]
+    return {allele_id: [ordered_ids[bit] for bit in np.flatnonzero(present[row])]
+            for row, allele_id in enumerate(store.ids)}
+
+
+def update_eplets_db(bulk: bool = True):
     """
     Goes over all the alleles in the db and check each allele for eplet presence.
     If an allele has an eplet, the eplet ids are added to the allele object and the db is updated.
 
+    Parameters:
+    bulk: if True, all the eplets are checked against all the alleles of a class at once (compute_eplet_presence)
+          and the eplets of every allele of a class with known eplets are written in one batched write.
+          If False, the alleles are checked and updated one by one with check_eplet_presence.
     """
 
     db = get_database()
 
+    if bulk:
+        store = db.get_allele_store()
+        eplets = {}
+        for clas in tqdm(CLASSES, desc="classes"):
+            table = get_eplet_registry().get(clas)
+            # no eplets for IIDRA class
+            if table is None:
+                continue
+            eplets.update(compute_eplet_presence(store[clas], table))
+        updated = db.update_eplet_presence_bulk(eplets)
+        logger.info(f"Eplet presence updated for {updated} alleles, {sum(len(e) for e in eplets.values())} eplets found")
+        return
+
     # get all the alleles in the db
     alleles = db.get_all_ids()
 
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains the registry of the known eplets.
+Every eplet file is loaded once per process, together with its per position lookup table
+and the span (first and last position) of every eplet.
+The eplets an allele has are kept as a bitset (np.packbits), bit i for the i-th eplet of the table,
+so the eplets of a haplotype are the OR of the bitsets of its alleles.
+"""
+
+# eplet files per eplet class, the DQA and DQB alleles share the DQ eplets and there are no DRA eplets
+EPLET_PATHS = {
+    "IIDRB": "data/eplets/eplets_DRB.json",
+    "IIDQ": "data/eplets/eplets_DQ.json",
+    "I": "data/eplets/eplets_I.json"
+}
+
+
+def create_eplet_dict(eplets_dict):
+    """
+    Create a dictionary with the first eplet position as keys and lists of eplet ids as values
+
+    Parameters:
+    eplets_dict: a dictionary with the eplet ids as keys and the eplet data as values, eplet data is a dictionary with the position as key and the base as value
+
+    Returns:
+    eplet_dict: a dictionary with the first eplet position as keys and lists of eplet ids as values
+    """
+    eplet_dict = {}
+    for eplet_id, eplet_data in eplets_dict.items():
+        for pos in eplet_data.keys():
+            if pos not in eplet_dict:
+                eplet_dict[pos] = []
+            eplet_dict[pos].append(eplet_id)
+
+    # the length of eplet_dict should be the same as the sum of all the lenght of the values
+    # sum_of_values = sum(len(v) for v in eplet_dict.values())
+    # assert sum_of_values == len(eplets_dict), "The number of eplets in the eplet_dict is not the same as the number of eplets in the eplets_dict"
+    return eplet_dict
+
+
+def eplet_class(allele_class: str) -> Optional[str]:
+    """
+    Map an allele class (one of utils.allele_store.CLASSES) to its eplet class (a key of EPLET_PATHS).
+
+    Returns:
+        The eplet class, or None if there are no known eplets for the allele class
+    """
+    if allele_class in ["IIDQA", "IIDQB"]:
+        return "IIDQ"
+    return allele_class if allele_class in EPLET_PATHS else None
+
+
+@dataclass
+class EpletTable:
+    """
+    The known eplets of one eplet class.
+
+    Attributes:
+        eplets (Dict[str, Dict[str, str]]): {eplet_id: {position: residue}}, as in the eplet file (1-indexed positions)
+        positions (Dict[str, List[str]]): {position: [eplet_id, ...]}, the eplets covering a position (see create_eplet_dict)
+        spans (Dict[str, Tuple[int, int]]): {eplet_id: (first position, last position)}
+        ids (List[str]): The eplet ids in bitset order
+        index (Dict[str, int]): eplet_id -> bit
+        fingerprint (str): Hash of the eplets (in file order), part of the cache keys of results that depend on them
+    """
+    eplets: Dict[str, Dict[str, str]]
+    positions: Dict[str, List[str]] = field(default_factory=dict)
+    spans: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+    ids: List[str] = field(default_factory=list)
+    index: Dict[str, int] = field(default_factory=dict)
+    fingerprint: str = ""
+
+    @classmethod
+    def from_eplets(cls, eplets: Dict[str, Dict[str, str]]) -> "EpletTable":
+        spans = {}
+        for eplet_id, eplet_data in eplets.items():
+            eplet_positions = [int(pos) for pos in eplet_data.keys()]
+            spans[eplet_id] = (min(eplet_positions), max(eplet_positions))
+        ids = list(eplets.keys())
+        fingerprint = hashlib.sha1(json.dumps(eplets).encode("utf-8")).hexdigest()
+        return cls(eplets=eplets, positions=create_eplet_dict(eplets), spans=spans,
+                   ids=ids, index={eplet_id: bit for bit, eplet_id in enumerate(ids)}, fingerprint=fingerprint)
+
+    def has_eplet(self, seq: str, eplet_id: str) -> bool:
+        """Check if an aligned sequence has all the residues of an eplet, like MHCMatchmaker.has_eplet"""
+        eplet_data = self.eplets[eplet_id]
+        for pos in sorted(eplet_data.keys()):
+            if int(pos) >= len(seq):
+                return False
+            if seq[int(pos)-1] != eplet_data[pos]:
+                return False
+        return True
+
+    def presence(self, aligned_seq: str, eplets: Optional[List[str]] = None) -> np.ndarray:
+        """
+        Get the eplet bitset of an allele.
+        The eplets stored for the allele in the database are used if they are known (not None),
+        otherwise the aligned sequence is checked for every eplet, like MHCMatchmaker.check_known_eplets.
+
+        Returns:
+            np.ndarray: packed uint8 bitset
+        """
+        present = np.zeros(len(self.ids), dtype=bool)
+        if eplets is not None:
+            for eplet_id in eplets:
+                if eplet_id in self.index:
+                    present[self.index[eplet_id]] = True
+        else:
+            for bit, eplet_id in enumerate(self.ids):
+                present[bit] = self.has_eplet(aligned_seq, eplet_id)
+        return np.packbits(present)
+
+    def empty(self) -> np.ndarray:
+        """Get the bitset without eplets"""
+        return np.zeros((len(self.ids) + 7) // 8, dtype=np.uint8)
+
+    def unpack(self, bitsets: np.ndarray) -> np.ndarray:
+        """Unpack one or more (stacked) bitsets into bool arrays with one entry per eplet"""
+        return np.unpackbits(bitsets, axis=-1, count=len(self.ids)).astype(bool)
+
+    def decode(self, bitset: np.ndarray) -> List[str]:
+        """Get the eplet ids of a bitset"""
+        return [self.ids[bit] for bit in np.flatnonzero(self.unpack(bitset))]
+
+
+class EpletRegistry:
+    """
+    Loads the eplet files on first use and keeps their EpletTable, shared by all users in the process.
+    The tables are read-only, use clear() to reload the files after they changed.
+
+    Usage:
+        table = get_eplet_registry().get("IIDQA")
+        eplet_ids = table.positions.get("55", [])
+    """
+
+    def __init__(self, paths: Dict[str, str] = EPLET_PATHS):
+        self.paths = dict(paths)
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, allele_class: str) -> Optional[EpletTable]:
+        """
+        Get the eplet table of an allele class (or eplet class).
+
+        Returns:
+            The EpletTable, or None if there are no known eplets for the class
+
+        Raises:
+            FileNotFoundError: If the eplet file of the class does not exist
+        """
+        clas = eplet_class(allele_class)
+        if clas is None or clas not in self.paths:
+            return None
+        table = self._tables.get(clas)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(clas)
+                if table is None:
+                    with open(self.paths[clas], "r") as f:
+                        table = EpletTable.from_eplets(json.load(f))
+                    self._tables[clas] = table
+                    logger.info(f"Loaded {len(table.eplets)} eplets of class {clas} from {self.paths[clas]}")
+        return table
+
+    def clear(self) -> None:
+        """Forget the loaded tables, the eplet files are loaded again on next use"""
+        with self._lock:
+            self._tables = {}
+
+
+_registry = EpletRegistry()
+
+
+def get_eplet_registry() -> EpletRegistry:
+    """Get the eplet registry shared by the process"""
+    return _registry
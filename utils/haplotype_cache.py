@@ -0,0 +1,114 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains a memoization cache for the per haplotype results of the matchmaker.
+Animals of a breeding colony share identical haplotypes, so the grouped sequence, its bitmask encoding
+and the averaged RSA/ASA scores of a class are computed once per haplotype instead of once per animal.
+The cache is shared by all the matchmakers of a process (see get_haplotype_cache), so it persists across
+the jobs of the API worker.
+"""
+
+# cached values of a haplotype
+FIELDS = ["grouped", "mask", "sas"]
+
+
+def haplotype_key(db_version: str, allele_class: str, alleles: List[str]) -> Tuple:
+    """
+    Get the cache key of the haplotype of a class.
+
+    The alleles are kept in haplotype order: the order of the residues in a grouped position
+    and the summation order of the SAS averages depend on it.
+    The database version makes sure a reloaded database never gets the results of the previous one.
+    """
+    return (db_version, allele_class, tuple(alleles))
+
+
+class HaplotypeCache:
+    """
+    Thread-safe LRU cache of per haplotype values, with hit/miss counters per value.
+    The cached values are shared by all users and should not be modified.
+
+    Usage:
+        cache = get_haplotype_cache()
+        grouped = cache.lookup(key, "grouped", lambda: group(alleles))
+        cache.stats()
+    """
+
+    def __init__(self, maxsize: int = 4096, fields: List[str] = FIELDS):
+        """
+        Parameters:
+            maxsize (int): Maximum number of cached haplotypes, 0 disables the cache
+            fields (List[str]): Names of the cached values
+        """
+        self.maxsize = maxsize
+        self.fields = list(fields)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = {field: 0 for field in self.fields}
+        self.misses = {field: 0 for field in self.fields}
+
+    def lookup(self, key: Hashable, field: str, compute: Callable[[], object], store: bool = True):
+        """
+        Get a cached value of a haplotype, computing and caching it on a miss.
+        Values are only cached when compute succeeds.
+
+        Parameters:
+            key (Hashable): The haplotype key, see haplotype_key
+            field (str): One of the fields
+            compute (Callable[[], object]): Computes the value
+            store (bool): If False, a computed value is not cached (lookup only). Defaults to True.
+
+        Returns:
+            The cached or computed value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and field in entry:
+                self._entries.move_to_end(key)
+                self.hits[field] += 1
+                return entry[field]
+            self.misses[field] += 1
+
+        value = compute()
+        if store:
+            self.store(key, field, value)
+        return value
+
+    def store(self, key: Hashable, field: str, value) -> None:
+        """Cache a value of a haplotype, evicting the least recently used haplotypes beyond maxsize"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries.setdefault(key, {})[field] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        """Get the number of cached haplotypes and the hit/miss counters per value"""
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize,
+                    "hits": dict(self.hits), "misses": dict(self.misses)}
+
+    def clear(self) -> None:
+        """Empty the cache and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = {field: 0 for field in self.fields}
+            self.misses = {field: 0 for field in self.fields}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_cache = HaplotypeCache()
+
+
+def get_haplotype_cache() -> HaplotypeCache:
+    """Get the haplotype cache shared by the process"""
+    return _cache
@@ -0,0 +1,529 @@
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains the mismatch engines used to compare grouped haplotypes.
+
+A grouped haplotype of a class is a list with, for every aligned position, a string with the
+residue of every allele at that position (see MHCMatchmaker.group_alleles).
+The bitmask engine encodes every position of a grouped haplotype as a residue bitmask
+(one bit per amino acid, plus one for the gap) so the differences between a donor and a recipient
+become a vectorised `donor & ~recipient` over the whole alignment.
+
+A class difference holds its per position vectors (donor_diff, all_donor_diff_counts, updated_mismatches, ...)
+either dense, as a list with an entry for every position (empty if there is no mismatch), or sparse,
+as a {position: entry} dict of the mismatched positions only, with the number of compared positions under "length".
+"""
+
+# residues that can be encoded, one bit each
+ALPHABET = "-ACDEFGHIKLMNPQRSTVWYXBZJUO*."
+MASK_DTYPE = np.uint64
+
+# ASCII code -> bit, 0 for residues outside the alphabet
+_BIT_LUT = np.zeros(256, dtype=MASK_DTYPE)
+for _bit, _residue in enumerate(ALPHABET):
+    _BIT_LUT[ord(_residue)] = MASK_DTYPE(1) << MASK_DTYPE(_bit)
+_BIT_RESIDUES = {int(_BIT_LUT[ord(_residue)]): _residue for _residue in ALPHABET}
+
+
+def grouped_codes(grouped: List[str]) -> np.ndarray:
+    """
+    Turn a grouped haplotype into a (length, n_alleles) uint8 matrix of residue codes.
+    """
+    if len(grouped) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    return np.frombuffer("".join(grouped).encode("ascii"), dtype=np.uint8).reshape(len(grouped), -1)
+
+
+def encode_codes(codes: np.ndarray) -> np.ndarray:
+    """
+    Encode a (..., n_alleles) matrix of residue codes into residue bitmasks, reducing the last axis.
+
+    Raises:
+        ValueError: If a residue is not in ALPHABET
+    """
+    bits = _BIT_LUT[codes]
+    if codes.size and not bits.all():
+        unknown = sorted({chr(c) for c in np.unique(codes[bits == 0])})
+        raise ValueError(f"Residues {unknown} can not be encoded in a bitmask")
+    return np.bitwise_or.reduce(bits, axis=-1) if codes.shape[-1] else np.zeros(codes.shape[:-1], dtype=MASK_DTYPE)
+
+
+def encode_grouped(grouped: List[str]) -> np.ndarray:
+    """
+    Encode a grouped haplotype into one residue bitmask per position.
+
+    Returns:
+        np.ndarray: (length,) array of bitmasks
+
+    Raises:
+        ValueError: If a residue is not in ALPHABET
+    """
+    return encode_codes(grouped_codes(grouped))
+
+
+@lru_cache(maxsize=4096)
+def _decode(mask: int) -> Tuple[str, ...]:
+    residues = []
+    while mask:
+        low_bit = mask & -mask
+        residues.append(_BIT_RESIDUES[low_bit])
+        mask ^= low_bit
+    return tuple(residues)
+
+
+def decode_mask(mask: int) -> List[str]:
+    """Get the residues of a bitmask, in ALPHABET order"""
+    return list(_decode(int(mask)))
+
+
+def class_difference_python(donor_grouped: List[str], recipient_grouped: List[str]) -> Dict:
+    """
+    Reference implementation of the mismatches between the grouped haplotypes of one class,
+    comparing the residues position by position with Python sets.
+
+    Returns:
+        Dict: donor_diff, recip_diff, donor_diff_score, recip_diff_score and the
+              all_donor_diff_counts/ratios and all_recip_diff_counts/ratios of every position
+              (see MHCMatchmaker.calcSingleDifference)
+    """
+    # in the case that the donor and recipient have different lengths, we need to pad the shorter one with '-'
+    donor_grouped = [allele if i < len(donor_grouped) else '-' for i, allele in enumerate(donor_grouped)]
+    recipient_grouped = [allele if i < len(recipient_grouped) else '-' for i, allele in enumerate(recipient_grouped)]
+
+    # calculate the difference between the donor and recipient grouped haplotypes
+    all_donor_diff_counts = []
+    all_donor_diff_ratios = []
+    all_recip_diff_counts = []
+    all_recip_diff_ratios = []
+
+    for a1, a2 in zip(donor_grouped, recipient_grouped):
+        donor_diff_elems = set(a1).difference(set(a2)) # elements in a1 that are not in a2
+
+        donor_diff_counts = {elem: a1.count(elem) for elem in donor_diff_elems}
+        donor_diff_ratios = {elem: a1.count(elem) / len(a1) for elem in donor_diff_elems}
+
+        all_donor_diff_counts.append(donor_diff_counts)
+        all_donor_diff_ratios.append(donor_diff_ratios)
+
+        recip_diff_elems = set(a2).difference(set(a1))
+        recip_diff_counts = {elem: a2.count(elem) for elem in recip_diff_elems}
+        recip_diff_ratios = {elem: a2.count(elem) / len(a2) for elem in recip_diff_elems}
+
+        all_recip_diff_counts.append(recip_diff_counts)
+        all_recip_diff_ratios.append(recip_diff_ratios)
+
+
+    donor_diff = [set(a1).difference(set(a2)) for a1, a2 in zip(donor_grouped, recipient_grouped)] # set(donor_grouped) - set(recipient_grouped)  elements present in donor_grouped but not in recipient_grouped
+    recip_diff = [set(a2).difference(set(a1)) for a1, a2 in zip(donor_grouped, recipient_grouped)] # set(recipient_grouped) - set(donor_grouped)  elements present in recipient_grouped but not in donor_grouped
+
+    # use a mapping function to map the list to different values:
+    # if the set is empty, map to []
+    # if the set is not empty, map to the list of the set
+    donor_diff = list(map(lambda x: [] if x == set() else list(x), donor_diff))
+    recip_diff = list(map(lambda x: [] if x == set() else list(x), recip_diff))
+
+    # calculate the difference scores: if ther diff list is not empty, add 1 to the score
+    donor_diff_score = sum([1 for diff in donor_diff if diff != list()])
+    recip_diff_score = sum([1 for diff in recip_diff if diff != list()])
+
+    return {"donor_diff": donor_diff,
+            "recip_diff": recip_diff,
+            "donor_diff_score": donor_diff_score,
+            "recip_diff_score": recip_diff_score,
+            "all_donor_diff_counts": all_donor_diff_counts,
+            "all_donor_diff_ratios": all_donor_diff_ratios,
+            "all_recip_diff_counts": all_recip_diff_counts,
+            "all_recip_diff_ratios": all_recip_diff_ratios}
+
+
+def _position_details(grouped: List[str], diff_bits: np.ndarray, length: int, sparse: bool = False):
+    """
+    Build the per position mismatch lists, counts and ratios of one side of a comparison, dense or sparse.
+    Only the positions with a non-zero diff bitmask are decoded.
+    """
+    if sparse:
+        diff, counts, ratios = {}, {}, {}
+    else:
+        diff = [[] for _ in range(length)]
+        counts = [{} for _ in range(length)]
+        ratios = [{} for _ in range(length)]
+    positions = np.flatnonzero(diff_bits)
+    for pos, mask in zip(positions.tolist(), diff_bits[positions].tolist()):
+        residues = _decode(mask)
+        seq = grouped[pos]
+        diff[pos] = list(residues)
+        counts[pos] = {elem: seq.count(elem) for elem in residues}
+        ratios[pos] = {elem: count / len(seq) for elem, count in counts[pos].items()}
+    return diff, counts, ratios
+
+
+def class_difference_bitmask(donor_grouped: List[str], recipient_grouped: List[str],
+                             donor_mask: np.ndarray = None, recipient_mask: np.ndarray = None,
+                             sparse: bool = False) -> Dict:
+    """
+    Bitmask implementation of class_difference_python, with the same output.
+    The residues of a position are listed in ALPHABET order (the reference lists them in set order).
+
+    Parameters:
+        donor_grouped (List[str]): Grouped donor haplotype of the class
+        recipient_grouped (List[str]): Grouped recipient haplotype of the class
+        donor_mask (np.ndarray, optional): encode_grouped(donor_grouped), if already computed
+        recipient_mask (np.ndarray, optional): encode_grouped(recipient_grouped), if already computed
+        sparse (bool): Return the sparse representation (see sparse_class_difference)
+
+    Raises:
+        ValueError: If a residue is not in ALPHABET
+    """
+    if donor_mask is None:
+        donor_mask = encode_grouped(donor_grouped)
+    if recipient_mask is None:
+        recipient_mask = encode_grouped(recipient_grouped)
+
+    # the positions are compared up to the end of the shortest grouped haplotype
+    length = min(len(donor_mask), len(recipient_mask))
+    donor_mask, recipient_mask = donor_mask[:length], recipient_mask[:length]
+    donor_bits = donor_mask & ~recipient_mask
+    recip_bits = recipient_mask & ~donor_mask
+
+    donor_diff, all_donor_diff_counts, all_donor_diff_ratios = _position_details(donor_grouped, donor_bits, length, sparse)
+    recip_diff, all_recip_diff_counts, all_recip_diff_ratios = _position_details(recipient_grouped, recip_bits, length, sparse)
+
+    result = {"donor_diff": donor_diff,
+              "recip_diff": recip_diff,
+              "donor_diff_score": int(np.count_nonzero(donor_bits)),
+              "recip_diff_score": int(np.count_nonzero(recip_bits)),
+              "all_donor_diff_counts": all_donor_diff_counts,
+              "all_donor_diff_ratios": all_donor_diff_ratios,
+              "all_recip_diff_counts": all_recip_diff_counts,
+              "all_recip_diff_ratios": all_recip_diff_ratios}
+    if sparse:
+        result["length"] = length
+    return result
+
+
+def same_class_difference(result: Dict, reference: Dict) -> bool:
+    """
+    Check if two class difference results are equal, comparing the mismatch lists of a position as sets
+    (their order is the iteration order of a Python set in the reference implementation).
+    """
+    result, reference = dense_class_difference(result), dense_class_difference(reference)
+    if result.keys() != reference.keys():
+        return False
+    for key in ["donor_diff", "recip_diff"]:
+        if len(result[key]) != len(reference[key]):
+            return False
+        if any(set(a) != set(b) or len(a) != len(b) for a, b in zip(result[key], reference[key])):
+            return False
+    return all(result[key] == reference[key] for key in result if key not in ["donor_diff", "recip_diff"])
+
+
+# per position vectors of a class difference, with the entry of a position without mismatch
+VECTOR_KEYS = {"donor_diff": list, "recip_diff": list,
+               "all_donor_diff_counts": dict, "all_donor_diff_ratios": dict,
+               "all_recip_diff_counts": dict, "all_recip_diff_ratios": dict,
+               "updated_mismatches": list, "updated_recip_mismatches": list}
+
+
+def iter_mismatches(diff: Union[List, Dict]) -> Iterator[Tuple[int, List[str]]]:
+    """Iterate over the (position, residues) of the mismatched positions of a dense or sparse mismatch vector"""
+    if isinstance(diff, dict):
+        return ((int(pos), residues) for pos, residues in diff.items() if residues)
+    return ((pos, residues) for pos, residues in enumerate(diff) if residues != list())
+
+
+def count_mismatches(diff: Union[List, Dict]) -> int:
+    """Count the mismatched positions of a dense or sparse mismatch vector"""
+    return sum([1 for _ in iter_mismatches(diff)])
+
+
+def to_sparse(dense: List) -> Dict[int, object]:
+    """Turn a dense per position vector into a sparse {position: entry} dict, leaving out the empty entries"""
+    return {pos: entry for pos, entry in enumerate(dense) if entry}
+
+
+def to_dense(sparse: Dict, length: int, empty=list) -> List:
+    """Turn a sparse per position vector into a dense list of length entries, filling the gaps with empty()"""
+    entries = {int(pos): entry for pos, entry in sparse.items()}
+    return [entries[pos] if pos in entries else empty() for pos in range(length)]
+
+
+def is_sparse(result: Dict) -> bool:
+    """Check if a class difference uses the sparse representation"""
+    return "length" in result
+
+
+def mismatch_length(result: Dict) -> int:
+    """Get the number of compared positions of a dense or sparse class difference"""
+    return result["length"] if is_sparse(result) else len(result["donor_diff"])
+
+
+def sparse_class_difference(result: Dict) -> Dict:
+    """Get the sparse representation of a class difference, sparse results are returned as they are"""
+    if is_sparse(result):
+        return result
+    sparse = {key: to_sparse(value) if key in VECTOR_KEYS else value for key, value in result.items()}
+    sparse["length"] = len(result["donor_diff"])
+    return sparse
+
+
+def dense_class_difference(result: Dict) -> Dict:
+    """Get the legacy dense representation of a class difference, dense results are returned as they are"""
+    if not is_sparse(result):
+        return result
+    length = result["length"]
+    return {key: to_dense(value, length, VECTOR_KEYS[key]) if key in VECTOR_KEYS else value
+            for key, value in result.items() if key != "length"}
+
+
+def stack_masks(masks: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Stack the bitmasks of several grouped haplotypes into one matrix, padded with 0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (n, width) matrix of bitmasks and the (n,) lengths
+    """
+    lengths = np.array([len(mask) for mask in masks], dtype=np.int64)
+    width = int(lengths.max()) if len(masks) else 0
+    stacked = np.zeros((len(masks), width), dtype=MASK_DTYPE)
+    for row, mask in enumerate(masks):
+        stacked[row, :len(mask)] = mask
+    return stacked, lengths
+
+
+def _pad(matrix: np.ndarray, width: int, value) -> np.ndarray:
+    if matrix.shape[1] >= width:
+        return matrix[:, :width]
+    padded = np.full((matrix.shape[0], width), value, dtype=matrix.dtype)
+    padded[:, :matrix.shape[1]] = matrix
+    return padded
+
+
+def score_matrix(donor_masks: np.ndarray, donor_lengths: np.ndarray,
+                 recip_masks: np.ndarray, recip_lengths: np.ndarray,
+                 donor_keep: np.ndarray = None, recip_keep: np.ndarray = None,
+                 max_block_bytes: int = 64 * 2**20) -> Dict[str, np.ndarray]:
+    """
+    Compute the mismatch scores of all recipient x donor pairs of one class at once.
+
+    Parameters:
+        donor_masks, donor_lengths: stacked donor bitmasks (see stack_masks)
+        recip_masks, recip_lengths: stacked recipient bitmasks (see stack_masks)
+        donor_keep (np.ndarray, optional): (n_donors, width) bool, False for the positions filtered out
+                                           by solvent accessibility (see MHCMatchmaker.filter_by_sas)
+        recip_keep (np.ndarray, optional): (n_recipients, width) bool, the same for the recipients
+        max_block_bytes (int): Memory budget of one block of recipients
+
+    Returns:
+        Dict[str, np.ndarray]: (n_recipients, n_donors) matrices
+            - donor_diff_score, recip_diff_score
+            - updated_mismatches_count (if donor_keep is given)
+            - updated_recip_mismatches_count (if recip_keep is given)
+    """
+    n_recips, n_donors = len(recip_masks), len(donor_masks)
+    width = max(donor_masks.shape[1], recip_masks.shape[1])
+    donor_masks, recip_masks = _pad(donor_masks, width, 0), _pad(recip_masks, width, 0)
+    if donor_keep is not None:
+        donor_keep = _pad(donor_keep, width, True)
+    if recip_keep is not None:
+        recip_keep = _pad(recip_keep, width, True)
+
+    scores = {"donor_diff_score": np.zeros((n_recips, n_donors), dtype=np.int32),
+              "recip_diff_score": np.zeros((n_recips, n_donors), dtype=np.int32)}
+    if donor_keep is not None:
+        scores["updated_mismatches_count"] = np.zeros((n_recips, n_donors), dtype=np.int32)
+    if recip_keep is not None:
+        scores["updated_recip_mismatches_count"] = np.zeros((n_recips, n_donors), dtype=np.int32)
+
+    positions = np.arange(width)
+    # a block holds a few (block, n_donors, width) arrays of bitmasks
+    block = max(1, int(max_block_bytes // max(1, 4 * n_donors * width * MASK_DTYPE().itemsize)))
+    for start in range(0, n_recips, block):
+        stop = min(start + block, n_recips)
+        recip_block = recip_masks[start:stop, None, :]
+        # the positions are compared up to the end of the shortest grouped haplotype of a pair
+        valid = positions < np.minimum(recip_lengths[start:stop, None], donor_lengths[None, :])[:, :, None]
+
+        donor_bits = ((donor_masks[None, :, :] & ~recip_block) != 0) & valid
+        recip_bits = ((recip_block & ~donor_masks[None, :, :]) != 0) & valid
+
+        scores["donor_diff_score"][start:stop] = donor_bits.sum(axis=-1)
+        scores["recip_diff_score"][start:stop] = recip_bits.sum(axis=-1)
+        if donor_keep is not None:
+            scores["updated_mismatches_count"][start:stop] = (donor_bits & donor_keep[None, :, :]).sum(axis=-1)
+        if recip_keep is not None:
+            scores["updated_recip_mismatches_count"][start:stop] = (recip_bits & recip_keep[start:stop, None, :]).sum(axis=-1)
+
+    return scores
+
+
+def sweep_score_matrix(donor_masks: np.ndarray, donor_lengths: np.ndarray,
+                       recip_masks: np.ndarray, recip_lengths: np.ndarray,
+                       donor_levels: np.ndarray, recip_levels: np.ndarray, n_levels: int,
+                       max_block_bytes: int = 64 * 2**20) -> Dict[str, np.ndarray]:
+    """
+    Compute the solvent accessibility filtered mismatch counts of all recipient x donor pairs of one class
+    for several filters at once. The mismatches of a pair are found once, a mismatch at position p of the donor
+    counts for the filters 0 .. donor_levels[p] - 1 (the same for the recipient).
+
+    Parameters:
+        donor_masks, donor_lengths: stacked donor bitmasks (see stack_masks)
+        recip_masks, recip_lengths: stacked recipient bitmasks (see stack_masks)
+        donor_levels (np.ndarray): (n_donors, width) number of filters that keep each donor position
+        recip_levels (np.ndarray): (n_recipients, width) the same for the recipients
+        n_levels (int): Number of filters, the positions beyond the levels are kept by all filters
+        max_block_bytes (int): Memory budget of one block of recipients
+
+    Returns:
+        Dict[str, np.ndarray]: (n_levels, n_recipients, n_donors) updated_mismatches_count and updated_recip_mismatches_count
+    """
+    n_recips, n_donors = len(recip_masks), len(donor_masks)
+    width = max(donor_masks.shape[1], recip_masks.shape[1])
+    donor_masks, recip_masks = _pad(donor_masks, width, 0), _pad(recip_masks, width, 0)
+    donor_levels, recip_levels = _pad(donor_levels, width, n_levels), _pad(recip_levels, width, n_levels)
+
+    counts = {"updated_mismatches_count": np.zeros((n_levels, n_recips, n_donors), dtype=np.int32),
+              "updated_recip_mismatches_count": np.zeros((n_levels, n_recips, n_donors), dtype=np.int32)}
+
+    positions = np.arange(width)
+    block = max(1, int(max_block_bytes // max(1, 4 * n_donors * width * MASK_DTYPE().itemsize)))
+    for start in range(0, n_recips, block):
+        stop = min(start + block, n_recips)
+        recip_block = recip_masks[start:stop, None, :]
+        valid = positions < np.minimum(recip_lengths[start:stop, None], donor_lengths[None, :])[:, :, None]
+
+        donor_bits = ((donor_masks[None, :, :] & ~recip_block) != 0) & valid
+        recip_bits = ((recip_block & ~donor_masks[None, :, :]) != 0) & valid
+        for level in range(n_levels):
+            counts["updated_mismatches_count"][level, start:stop] = (donor_bits & (donor_levels[None, :, :] > level)).sum(axis=-1)
+            counts["updated_recip_mismatches_count"][level, start:stop] = (recip_bits & (recip_levels[start:stop, None, :] > level)).sum(axis=-1)
+
+    return counts
+
+
+# keys of a class difference, in the order of class_difference_python and filter_by_sas
+SCORE_KEYS = ["donor_diff_score", "recip_diff_score"]
+FILTERED_COUNT_KEYS = ["updated_mismatches_count", "updated_recip_mismatches_count"]
+RESULT_KEYS = ["donor_diff", "recip_diff", "donor_diff_score", "recip_diff_score",
+               "all_donor_diff_counts", "all_donor_diff_ratios", "all_recip_diff_counts", "all_recip_diff_ratios"]
+FILTERED_KEYS = ["updated_mismatches", "updated_mismatches_count", "updated_recip_mismatches", "updated_recip_mismatches_count"]
+
+# number of materialized lazy class differences kept in memory
+DETAILS_CACHE_SIZE = 32
+
+_details_cache = OrderedDict()
+_details_lock = threading.Lock()
+
+
+def _sas_filtered(diff: Union[List, Dict], keep: np.ndarray) -> Union[List, Dict]:
+    """Empty the mismatches at the positions filtered out by solvent accessibility, the positions past keep are kept"""
+    if isinstance(diff, dict):
+        return {index: value for index, value in diff.items() if index >= len(keep) or keep[index]}
+    return [value if value != [] and (index >= len(keep) or keep[index]) else [] for index, value in enumerate(diff)]
+
+
+class LazyClassDifference(Mapping):
+    """
+    Class difference of one donor-recipient pair that only keeps the scores up front.
+
+    It reads like the dict of class_difference_python (plus the filter_by_sas keys once a filter is set),
+    but the per position details (donor_diff, updated_mismatches, counts, ratios, ...) are only computed
+    when one of them is read. The last DETAILS_CACHE_SIZE materialized pairs are cached, so a sweep over
+    all the pairs never holds the details of all of them.
+
+    Attributes:
+        scores (Dict[str, int]): donor_diff_score, recip_diff_score, the length of sparse results
+                                 and, once filtered, the updated counts
+    """
+
+    def __init__(self, scores: Dict[str, int], compute: Callable[[], Dict]):
+        """
+        Parameters:
+            scores (Dict[str, int]): donor_diff_score and recip_diff_score of the pair, plus the length if compute
+                                     returns the sparse representation
+            compute (Callable[[], Dict]): Computes the full class difference of the pair
+        """
+        self.scores = dict(scores)
+        self._compute = compute
+        self._donor_keep = None
+        self._recip_keep = None
+
+    @property
+    def filtered(self) -> bool:
+        return self._donor_keep is not None
+
+    def set_sas_filter(self, donor_keep: np.ndarray, recip_keep: np.ndarray, counts: Optional[Dict[str, int]] = None) -> None:
+        """
+        Set the solvent accessibility filter of the pair (see MHCMatchmaker.filter_by_sas).
+
+        Parameters:
+            donor_keep (np.ndarray): Per position of the donor, False if a mismatch there is filtered out
+            recip_keep (np.ndarray): The same for the recipient
+            counts (Dict[str, int], optional): updated_mismatches_count and updated_recip_mismatches_count,
+                                               computed from the details if not given
+        """
+        self._donor_keep, self._recip_keep = donor_keep, recip_keep
+        self._forget()
+        if counts is None:
+            details = self.details()
+            counts = {key: details[key] for key in FILTERED_COUNT_KEYS}
+        self.scores.update(counts)
+
+    def details(self) -> Dict:
+        """
+        Get the full class difference of the pair as a dict, computing it if it is not cached.
+        The returned dict is shared with the cache and should not be modified.
+        """
+        with _details_lock:
+            cached = _details_cache.get(id(self))
+            if cached is not None:
+                _details_cache.move_to_end(id(self))
+                return cached[1]
+
+        details = self._compute()
+        if self.filtered:
+            updated_mismatches = _sas_filtered(details["donor_diff"], self._donor_keep)
+            updated_recip_mismatches = _sas_filtered(details["recip_diff"], self._recip_keep)
+            details["updated_mismatches"] = updated_mismatches
+            details["updated_mismatches_count"] = count_mismatches(updated_mismatches)
+            details["updated_recip_mismatches"] = updated_recip_mismatches
+            details["updated_recip_mismatches_count"] = count_mismatches(updated_recip_mismatches)
+
+        with _details_lock:
+            # the object is kept in the cache entry, so its id is not reused while it is cached
+            _details_cache[id(self)] = (self, details)
+            while len(_details_cache) > DETAILS_CACHE_SIZE:
+                _details_cache.popitem(last=False)
+        return details
+
+    def _forget(self) -> None:
+        with _details_lock:
+            _details_cache.pop(id(self), None)
+
+    def __getitem__(self, key: str):
+        if key in self.scores:
+            return self.scores[key]
+        if key in RESULT_KEYS or (self.filtered and key in FILTERED_KEYS):
+            return self.details()[key]
+        raise KeyError(key)
+
+    def _keys(self) -> List[str]:
+        keys = RESULT_KEYS + ["length"] if "length" in self.scores else RESULT_KEYS
+        return keys + FILTERED_KEYS if self.filtered else keys
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self) -> int:
+        return len(self._keys())
+
+    def __repr__(self) -> str:
+        return f"LazyClassDifference({self.scores})"
@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# project imports
+from utils.haplotype_cache import HaplotypeCache
+
+logger = logging.getLogger(__name__)
+
+"""
+This module contains a memoization cache for the per class results of donor-recipient pairs.
+Resubmitted and overlapping cohorts compare the same haplotype pairs again, so the class difference,
+the SAS filtered mismatches and the known eplets of a pair are cached across jobs, in memory (LRU)
+and optionally on disk, so a restarted worker starts warm.
+The disk tier is a directory of pickle files and should only be pointed at a directory the worker owns.
+It is bounded in files and bytes, the least recently used files (by modification time, refreshed on every
+disk hit) are deleted beyond the limits.
+"""
+
+# cached values of a pair
+PAIR_FIELDS = ["difference", "filtered", "eplets"]
+
+# environment variable with the directory of the on-disk tier of the shared pair cache
+CACHE_DIR_ENV = "MHC_PAIR_CACHE_DIR"
+
+# environment variables with the limits of the on-disk tier of the shared pair cache
+CACHE_MAX_FILES_ENV = "MHC_PAIR_CACHE_MAX_FILES"
+CACHE_MAX_BYTES_ENV = "MHC_PAIR_CACHE_MAX_BYTES"
+
+# environment variable with the number of keys of the memory tier of the shared pair cache.
+# A key holds the results of a pair of haplotypes of one class: about 90 KB with the dense (default) mismatch
+# vectors, a few KB with the sparse ones. The default of 500 keys is about 45 MB per API worker, kept until
+# the worker exits (or the cache is cleared).
+CACHE_SIZE_ENV = "MHC_PAIR_CACHE_SIZE"
+
+
+def pair_key(db_version: str, allele_class: str, donor_alleles: List[str], recipient_alleles: List[str],
+             rsa_threshold: Optional[float] = None, variant: Tuple = ()) -> Tuple:
+    """
+    Get the cache key of the results of a pair for a class.
+
+    Parameters:
+        db_version (str): Version (fingerprint) of the database
+        allele_class (str): The class
+        donor_alleles (List[str]): Signature of the donor haplotype, its alleles of the class in haplotype order
+        recipient_alleles (List[str]): Signature of the recipient haplotype
+        rsa_threshold (float, optional): The RSA threshold, for the results that depend on it
+        variant (Tuple): Settings that change the representation of the results (engine, sparse, ...)
+    """
+    return (db_version, allele_class, tuple(donor_alleles), tuple(recipient_alleles), rsa_threshold, tuple(variant))
+
+
+class PairCache(HaplotypeCache):
+    """
+    Thread-safe LRU cache of per pair values with an optional on-disk tier.
+    On a memory miss the disk tier is checked before computing, computed values are written to both.
+    The cached values are shared by all users and should not be modified.
+    """
+
+    def __init__(self, maxsize: int = 500, cache_dir: Optional[str] = None, max_disk_files: int = 100000,
+                 max_disk_bytes: int = 2**30):
+        """
+        Parameters:
+            maxsize (int): Maximum number of keys kept in memory, all classes together (a key is a pair of
+                           haplotypes of one class, about 90 KB with dense results), 0 disables the memory tier.
+                           Defaults to 500.
+            cache_dir (str, optional): Directory of the on-disk tier, no disk tier if None
+            max_disk_files (int): Maximum number of files of the disk tier. Defaults to 100000.
+            max_disk_bytes (int): Maximum total size in bytes of the files of the disk tier. Defaults to 1 GiB.
+        """
+        super().__init__(maxsize=maxsize, fields=PAIR_FIELDS)
+        self.cache_dir = cache_dir
+        self.max_disk_files = max_disk_files
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_hits = {field: 0 for field in self.fields}
+        self.disk_evictions = 0
+        # {path: size} of the files of the disk tier, least recently used first
+        self._files = OrderedDict()
+        self._disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan_disk()
+            with self._lock:
+                self._evict_disk()
+
+    def _scan_disk(self) -> None:
+        """Index the files already in the disk tier, oldest modification first"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pkl"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                files.append((info.st_mtime, path, info.st_size))
+        with self._lock:
+            self._files.clear()
+            self._disk_bytes = 0
+            for _, path, size in sorted(files):
+                self._files[path] = size
+                self._disk_bytes += size
+
+    def _evict_disk(self) -> None:
+        """Delete the least recently used files beyond the limits of the disk tier, called with the lock held"""
+        while self._files and (len(self._files) > self.max_disk_files or self._disk_bytes > self.max_disk_bytes):
+            path, size = self._files.popitem(last=False)
+            self._disk_bytes -= size
+            self.disk_evictions += 1
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not delete pair cache file {path}: {e}")
+
+    def _path(self, key: Hashable, field: str) -> str:
+        digest = hashlib.sha1(repr((key, field)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.pkl")
+
+    def lookup(self, key: Hashable, field: str, compute: Callable[[], object], store: bool = True):
+        if self.cache_dir is None:
+            return super().lookup(key, field, compute, store)
+        return super().lookup(key, field, lambda: self._disk_lookup(key, field, compute, store), store)
+
+    def _disk_lookup(self, key: Hashable, field: str, compute: Callable[[], object], store: bool = True):
+        path = self._path(key, field)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            try:
+                # the modification time orders the files for eviction, also after a restart
+                os.utime(path)
+            except OSError:
+                pass
+            with self._lock:
+                self.disk_hits[field] += 1
+                if path in self._files:
+                    self._files.move_to_end(path)
+            return value
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.warning(f"Unreadable pair cache file {path}, recomputing: {e}")
+
+        value = compute()
+        if not store:
+            return value
+        # write to a temporary file first, so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write pair cache file {path}: {e}")
+            return value
+        with self._lock:
+            self._disk_bytes += size - self._files.pop(path, 0)
+            self._files[path] = size
+            self._evict_disk()
+        return value
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        with self._lock:
+            stats["disk_hits"] = dict(self.disk_hits)
+            stats["disk_files"] = len(self._files)
+            stats["disk_bytes"] = self._disk_bytes
+            stats["disk_evictions"] = self.disk_evictions
+        stats["cache_dir"] = self.cache_dir
+        stats["max_disk_files"] = self.max_disk_files
+        stats["max_disk_bytes"] = self.max_disk_bytes
+        return stats
+
+    def clear(self, disk: bool = False) -> None:
+        """Empty the memory tier and reset the counters, and the disk tier if disk is True"""
+        super().clear()
+        with self._lock:
+            self.disk_hits = {field: 0 for field in self.fields}
+            self.disk_evictions = 0
+        if disk and self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(self.cache_dir, name))
+            with self._lock:
+                self._files.clear()
+                self._disk_bytes = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_pair_cache() -> PairCache:
+    """
+    Get the pair cache shared by the process.
+    Its memory tier is bounded by MHC_PAIR_CACHE_SIZE keys (see CACHE_SIZE_ENV for the footprint).
+    Its on-disk tier is enabled by setting the MHC_PAIR_CACHE_DIR environment variable to a directory,
+    and bounded by MHC_PAIR_CACHE_MAX_FILES and MHC_PAIR_CACHE_MAX_BYTES.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                limits = {}
+                if os.environ.get(CACHE_SIZE_ENV):
+                    limits["maxsize"] = int(os.environ[CACHE_SIZE_ENV])
+                if os.environ.get(CACHE_MAX_FILES_ENV):
+                    limits["max_disk_files"] = int(os.environ[CACHE_MAX_FILES_ENV])
+                if os.environ.get(CACHE_MAX_BYTES_ENV):
+                    limits["max_disk_bytes"] = int(os.environ[CACHE_MAX_BYTES_ENV])
+                _cache = PairCache(cache_dir=os.environ.get(CACHE_DIR_ENV), **limits)
+    return _cache
@@ -5,9 +5,6 @@ import argparse
 from typing import NamedTuple
 logger = logging.getLogger(__name__)
 
-# project imports
-from database import get_database
-
 """
 This module contains useful functions to manipulate alleles.
 """
@@ -35,7 +32,9 @@ def convert_to_fasta(alleles: list[str],output_path:str) -> None:
     :param alleles: list of alleles to convert to fasta format
     :param output_path: path to the output fasta file
     """
-    
+    # imported here, the database module depends on this module
+    from database import get_database
+
     seq_data = get_database()
 
     fasta_data = []